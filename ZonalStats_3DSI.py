@@ -15,6 +15,17 @@ PROCESS:
 Results will be appended to bigOutput (.csv, .shp, database*)
 And also saved as .csv (or .shp) individually
 
+Batches of a stack are written to partial stack outputs (see partialPath).
+Only once the last batch is written is the aggregate .csv appended (once,
+from the partial .csv) and the partial outputs renamed into place, so a stack
+that fails partway leaves nothing in the aggregate and no stack .csv that
+would mark it as done. runBatch deletes the partial outputs of a failed stack
+
+runBatch() runs main() for a whole list of stacks (-l) in one process, so 
+imports, the cached index .shp files, ATL08 granule cache and CRS transformers
+stay warm from one stack to the next (see functions/processCache.py). A stack
+that fails is reported and skipped, the rest of the list still runs
+
 NOTES (1/6/23 and on):
 - Untested for 100m segments/footprints .shp may need to be recreated
 
@@ -23,7 +34,10 @@ import os, sys
 #import numpy as np
 import argparse
 import time
-#import platform
+import fcntl
+import shutil
+import traceback
+import platform
 #from functions import calculateElapsedTime
 
 from osgeo import ogr#gdal, osr#, ogr
@@ -40,6 +54,14 @@ from models.ZonalDataFrame import ZonalDataFrame
 
 overwrite = False
 
+# Suffix of stack outputs while the stack is still being written (node and
+# process are added, a stack whose queue claim was lost can still be running
+# next to the new claim)
+PARTIAL_SUFFIX = '__partial'
+
+# Files that make up a .shp output
+SHP_EXTENSIONS = ['.shp', '.shx', '.dbf', '.prj', '.cpg']
+
 def calculateElapsedTime(start, end, unit = 'minutes'):
     
     # start and end = time.time()
@@ -120,6 +142,155 @@ def buildLayerDict(stackObject):
 
     return layerDict
 
+# Add fields/edit columns of a stats batch before writing, and remove rows
+# we do not want in outputs. Same for every batch of a stack
+def addOutputFields(rasterStatsDf, stack, zonalType):
+    
+    #* ADD ANY OTHER FIELDS AT THIS TIME
+    # stackName/Path, others from old code ?
+    rasterStatsDf = rasterStatsDf.assign(rasterStack = stack.baseName) # Same value for all rows so we can use assign
+    
+    # 1/18/23: For disturbance Chris wants date in mmddyyy WV03_20150510_1040010
+    # ALso add/edit a couple other things
+    if zonalType == 'Disturbance':
+        
+        bname = stack.baseName
+        date = '{}{}{}'.format(bname.split('_')[1][4:6], 
+                               bname.split('_')[1][6:8], 
+                               bname.split('_')[1][0:4]).zfill(8)
+        rasterStatsDf = rasterStatsDf.assign(mmddyyyy = date) 
+        
+        # Label stats already have lon/lat/patch size (from the label image,
+        # geometry may be empty), just move them to the same place
+        if 'patchSize_m2' in rasterStatsDf.columns:
+            for col in ['lon', 'lat', 'patchSize_m2']:
+                rasterStatsDf[col] = rasterStatsDf.pop(col)
+        
+        else:
+            # 1/18/23: Also need to get lat/lon! But in decimal degrees
+            # get x then convert to 4326 to avoid warning
+    
+            rasterStatsDf["lon"] = rasterStatsDf.centroid.to_crs(4326).x
+            rasterStatsDf["lat"] = rasterStatsDf.centroid.to_crs(4326).y
+            
+            # ADD patch size
+            rasterStatsDf['patchSize_m2'] = rasterStatsDf.area.astype(int)
+        
+        """        # Will add column name change if stats only contains percentile_XX
+        if 'CHM_sr05_percentile_90' in rasterStatsDf.columns.to_list():
+            rasterStatsDf.rename({'CHM_sr05_percentile_90': 'CHM_sr05_p90'}, 
+                                                 inplace = True, axis='columns')"""
+        # Replace any column with percentile in it
+        for col in rasterStatsDf.columns.to_list():
+            if '_percentile_' in col:
+                newCol = col.replace('_percentile_', '_p')
+                rasterStatsDf.rename({col: newCol}, 
+                                                 inplace = True, axis='columns')
+    
+    # 1/6/23: hardcode conversion of 2 columns to int
+    if stack.stackType() == 'Landsat': # just for Landsat stack type
+        rasterStatsDf['ageYear'] = rasterStatsDf['ageYear'].round().astype('int')
+        rasterStatsDf['ecoreg']  = rasterStatsDf['ecoreg'].round().astype('int')
+
+    # 1/6/23: Go ahead and remove rows where terrapulse data is 0 (nonforest) or nodata (-99 in this case)
+    if stack.stackType() == 'Landsat': # only if Landsat stack
+        rasterStatsDf = rasterStatsDf[(rasterStatsDf['ageYear'] != 0) & 
+                                (rasterStatsDf['ageYear'] != stack.noDataValue)]
+    #elif stack.stackType() == 'SGM': # remove no data or already done?
+    
+    return rasterStatsDf
+
+# Partial version of a stack output, e.g. <name>__partial_<node>_<pid>.csv
+def partialPath(outFile):
+    
+    (base, ext) = os.path.splitext(outFile)
+    
+    return '{}{}_{}_{}{}'.format(base, PARTIAL_SUFFIX, platform.node(), 
+                                                            os.getpid(), ext)
+
+# Raise if the stack's queue claim was lost (claimLost Event is set by the
+# queue Heartbeat, see scripts/run_ZonalStats_3DSI.py). Another worker runs
+# the stack now, so stop before writing anything more
+def checkClaim(claimLost, stackName):
+    
+    if claimLost is not None and claimLost.is_set():
+        raise RuntimeError("Claim on {} was lost, stopping".format(stackName))
+
+# Files of an output: the .csv, or the .shp and its sidecar files
+def outputFiles(outFile):
+    
+    (base, ext) = os.path.splitext(outFile)
+    
+    if ext == '.shp':
+        return [base + e for e in SHP_EXTENSIONS]
+    
+    return [outFile]
+
+# Delete whatever exists of outputs (e.g. partial outputs of a failed stack)
+def removeOutputs(outFiles):
+    
+    for outFile in outFiles:
+        for f in outputFiles(outFile):
+            if os.path.isfile(f):
+                os.remove(f)
+
+# Rename a finished partial output into place
+def publishOutput(partialFile, outFile):
+    
+    for (src, dst) in zip(outputFiles(partialFile), outputFiles(outFile)):
+        if os.path.isfile(src):
+            os.replace(src, dst)
+
+# Write a stats batch to the (partial) stack .csv/.shp. First batch of a 
+# stack (over)writes the outputs, later batches append
+# If writeShp is False, the stack .shp is skipped
+def writeOutputs(rasterStatsDf, stackCsv, stackShp, firstBatch, 
+                                                             writeShp = True):
+    
+    # 1/6/23: Do not write geometry column to csv
+    useCols = [col for col in rasterStatsDf.columns.tolist() if col != 'geometry']
+    
+    # Write output to individual .csv and .shp
+    if firstBatch:
+        print("\nWriting {} rows to {}".format(len(rasterStatsDf.index), stackCsv))
+        rasterStatsDf.to_csv(stackCsv, columns=useCols, index=False)
+        if writeShp:
+            print("\nWriting {} features to {}".format(len(rasterStatsDf.index), stackShp))    
+            rasterStatsDf.to_file(filename=stackShp, driver="ESRI Shapefile")
+    else:
+        print("\nAppending {} rows to {}".format(len(rasterStatsDf.index), stackCsv))
+        rasterStatsDf.to_csv(stackCsv, mode = 'a', index=False, header=False, columns=useCols)
+        if writeShp:
+            print("\nAppending {} features to {}".format(len(rasterStatsDf.index), stackShp))    
+            rasterStatsDf.to_file(filename=stackShp, driver="ESRI Shapefile", mode = 'a')
+        
+    return None
+
+# Append a finished stack .csv (nRows rows) to the aggregate .csv, with the
+# header only if the aggregate is new
+def appendAggregate(stackCsv, aggOutput, nRows):
+
+    # Locked, stacks running in parallel on a node share the aggregate .csv
+    with open('{}.lock'.format(aggOutput), 'a') as lock:
+        
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        
+        newAgg = not os.path.isfile(aggOutput)
+        print("\n{} {} rows to {}".format('Writing' if newAgg else 'Appending',
+                                                           nRows, aggOutput))
+        
+        with open(stackCsv, 'rb') as src, open(aggOutput, 'ab') as dst:
+            
+            header = src.readline()
+            if newAgg:
+                dst.write(header)
+                
+            shutil.copyfileobj(src, dst)
+        
+        #* For now, don't check for duplicates. After running Alaska subset, time how long it takes to check vs. not (make copy of agg .csv first bc without checking dups it will append and write dups)
+        
+    return None
+
 def main(args):
     
     # Unpack arguments   
@@ -129,6 +300,16 @@ def main(args):
     aggOutput  = args['aggregateOutput']
     logOut     = args['logOutput']
     statsType  = args['statsMode']
+    workers    = args['workers']
+    chunkSize  = args['chunkSize']
+    writeShp   = not args['noShp']
+    simplify   = args['simplify']
+    cacheCover = args['coverageCache']
+    columns    = args['columns']
+    
+    # Disturbance patches can be done from a label image instead of polygons
+    useLabels  = args['labelStats'] and zonalType == 'Disturbance' \
+                                                    and statsType == 'zonal'
     
     #* need to sanitize inputs
     
@@ -164,12 +345,21 @@ def main(args):
     stackCsv = os.path.join(outDir, '{}__{}__{}Stats.csv'.format(zonalType, stackName, statsType))
     stackShp = stackCsv.replace('.csv', '.shp') #- done in RasterStats.py
  
+    # Batches go to partial outputs until the stack is done. runBatch deletes
+    # the partial outputs listed in partialOutputs if the stack fails
+    partialCsv = partialPath(stackCsv)
+    partialShp = partialPath(stackShp)
+    
+    if args.get('partialOutputs') is not None:
+        args['partialOutputs'].extend([partialCsv, partialShp])
+ 
     # Start stack-specific log if doing so
     logFile = stackCsv.replace('.csv', '__Log.txt')
-    # First, if overwrite is off, check if Log already exists
+    # First, if overwrite is off, check if the stack .csv already exists
+    # (the log is there for stacks that failed too)
     if not overwrite:
-        if os.path.isfile(logFile):
-            print("\tFile {} already exists. Skipping".format(logFile))
+        if os.path.isfile(stackCsv):
+            print("\tFile {} already exists. Skipping".format(stackCsv))
             return None
     
     if logOut: 
@@ -177,9 +367,23 @@ def main(args):
         sys.stdout = logOutput(logFile, mode = "a")
         sys.stdout.flush()
         
+    # Only load ATL08 shots where the stack has data (SGM strips cover a
+    # small part of their extent). Footprint is saved in outDir for re-runs
+    footprint = None
+    if 'ATL08' in zonalType:
+        footprint = stack.validDataFootprint(cacheFile = os.path.join(outDir, 
+                                          '{}__footprint.wkb'.format(stackName)))
+        
+        if footprint is not None and footprint.is_empty:
+            print("Stack has no valid data. Exiting")
+            return None
+    
     # Create zonal dataframe for vector input
     inZones = ZonalDataFrame(zonalType, stackExtent, stackEpsg, 
-                             tmpDir = stack.tempDir(), region=stack.region())
+                             tmpDir = stack.tempDir(), region=stack.region(),
+                             footprint = footprint, labels = useLabels,
+                             labelGeometry = writeShp, workers = workers,
+                             simplify = simplify, columns = columns)
         
     if inZones.data is None:
         print("0 valid shots over stack. Exiting")
@@ -194,7 +398,8 @@ def main(args):
     print("Output stack .csv: {}".format(stackCsv))
     print("Output aggregate .csv/.shp: {}".format(aggOutput))
     print(" n layers in stack = {}".format(stack.nLayers))
-    print(" n zonal features = {}\n".format(inZones.nFeatures()))
+    print(" n zonal features = {}".format(inZones.nFeatures()))
+    print(" n workers = {}\n".format(workers))
 
     # Get stack key dictionary    
     layerDict = buildLayerDict(stack) # {layerNumber: [layerName, statString]}
@@ -202,99 +407,76 @@ def main(args):
     # Call zonal stats or point query
     #* Pass columns from original dataframe that we want to keep in output
     #* - if Aux, pass All; else, pass None; option to pass a list as well (from atl08)
-    if statsType == 'zonal':
+    if useLabels:
+        
+        # Stats for all patches from the label image, one batch
+        batches = [inZones.labelStats(stack.filePath, layerDict)]
+        
+    elif statsType == 'zonal':
 
         # only convert to polygon for ATL08
         if 'ATL08' in zonalType:
             inZones.pointsToPolygon() # Now inZones.data is gdf with polygons
             
-        rasterStatsDf = inZones.zonalStats(stack.filePath, layerDict)
+        # Optionally cache zone coverage in outDir (one file per stack) so
+        # re-runs of the stack skip rasterizing the zones again
+        coverageCache = None
+        if cacheCover:
+            coverageCache = os.path.join(outDir, 
+                                     '{}__coverage.npz'.format(stackName))
+        
+        # Zonal stats are streamed in batches so memory stays flat no matter
+        # how many zones fall on the stack
+        batches = inZones.zonalStatsChunks(stack.filePath, layerDict, 
+                                           chunkSize = chunkSize,
+                                           coverageCache = coverageCache, 
+                                           workers = workers)
         
     else:
-        rasterStatsDf = inZones.pointStats(stack.filePath, layerDict)
+        batches = [inZones.pointStats(stack.filePath, layerDict, workers)]
         
     #elif statsMode == 'polygon':
         #* We need to convert the points into footprint polygons - see ATL to .shp code
        # rasterStatsDf = ZonalStats(inZones.data, stack.filePath, layerDict)
-    print("\nNumber of rows after zonal stats = {}".format(len(rasterStatsDf)))
-     
-    #* ADD ANY OTHER FIELDS AT THIS TIME
-    # stackName/Path, others from old code ?
-    rasterStatsDf = rasterStatsDf.assign(rasterStack = stack.baseName) # Same value for all rows so we can use assign
-    
-    # 1/18/23: For disturbance Chris wants date in mmddyyy WV03_20150510_1040010
-    # ALso add/edit a couple other things
-    if zonalType == 'Disturbance':
+       
+    # Write each batch to the partial stack .csv/.shp as it comes
+    claimLost = args.get('claimLost')
+    nRows = 0
+    for rasterStatsDf in batches:
         
-        bname = stack.baseName
-        date = '{}{}{}'.format(bname.split('_')[1][4:6], 
-                               bname.split('_')[1][6:8], 
-                               bname.split('_')[1][0:4]).zfill(8)
-        rasterStatsDf = rasterStatsDf.assign(mmddyyyy = date) 
+        checkClaim(claimLost, stackName)
         
-        # 1/18/23: Also need to get lat/lon! But in decimal degrees
-        # get x then convert to 4326 to avoid warning
-
-        rasterStatsDf["lon"] = rasterStatsDf.centroid.to_crs(4326).x
-        rasterStatsDf["lat"] = rasterStatsDf.centroid.to_crs(4326).y
+        print("\nNumber of rows after zonal stats = {}".format(len(rasterStatsDf)))
         
-        # ADD patch size
-        rasterStatsDf['patchSize_m2'] = rasterStatsDf.area.astype(int)
+        rasterStatsDf = addOutputFields(rasterStatsDf, stack, zonalType)
         
-        """        # Will add column name change if stats only contains percentile_XX
-        if 'CHM_sr05_percentile_90' in rasterStatsDf.columns.to_list():
-            rasterStatsDf.rename({'CHM_sr05_percentile_90': 'CHM_sr05_p90'}, 
-                                                 inplace = True, axis='columns')"""
-        # Replace any column with percentile in it
-        for col in rasterStatsDf.columns.to_list():
-            if '_percentile_' in col:
-                newCol = col.replace('_percentile_', '_p')
-                rasterStatsDf.rename({col: newCol}, 
-                                                 inplace = True, axis='columns')
-    
-    # 1/6/23: hardcode conversion of 2 columns to int
-    if stack.stackType() == 'Landsat': # just for Landsat stack type
-        rasterStatsDf['ageYear'] = rasterStatsDf['ageYear'].round().astype('int')
-        rasterStatsDf['ecoreg']  = rasterStatsDf['ecoreg'].round().astype('int')
-
-    # 1/6/23: Do not write geometry column to csv
-    useCols = [col for col in rasterStatsDf.columns.tolist() if col != 'geometry']
-
-    # 1/6/23: Go ahead and remove rows where terrapulse data is 0 (nonforest) or nodata (-99 in this case)
-    if stack.stackType() == 'Landsat': # only if Landsat stack
-        rasterStatsDf = rasterStatsDf[(rasterStatsDf['ageYear'] != 0) & 
-                                (rasterStatsDf['ageYear'] != stack.noDataValue)]
-    #elif stack.stackType() == 'SGM': # remove no data or already done?
-    
-    print("\nNumber of rows after removing NoData/non-forest from ageYear = {}".format(len(rasterStatsDf)))
+        print("\nNumber of rows after removing NoData/non-forest from ageYear = {}".format(len(rasterStatsDf)))
+        
+        if len(rasterStatsDf) == 0:
+            continue
+        
+        writeOutputs(rasterStatsDf, partialCsv, partialShp, 
+                          firstBatch = nRows == 0, writeShp = writeShp)
+        nRows += len(rasterStatsDf.index)
+        
+        del rasterStatsDf
     
-    if len(rasterStatsDf) == 0:
+    if nRows == 0:
         print("  0 rows after more filtering. Exiting")
         return
-
-
-    # Write output to individual .csv and .shp
-    print("\nWriting {} rows to {}".format(len(rasterStatsDf.index), stackCsv))
-    rasterStatsDf.to_csv(stackCsv, columns=useCols, index=False)
-    print("\nWriting {} features to {}".format(len(rasterStatsDf.index), stackShp))    
-    rasterStatsDf.to_file(filename=stackShp, driver="ESRI Shapefile")
-
-    # Write output to aggregate .csv
-   
-    # Test file existence; if DNE, write; otherwise, append
-    if not os.path.isfile(aggOutput):
-        print("\nWriting {} rows to {}".format(len(rasterStatsDf.index), aggOutput))
-        rasterStatsDf.to_csv(aggOutput, index=False, columns=useCols)        
-    else:
-        print("\nAppending {} rows to {}".format(len(rasterStatsDf.index), aggOutput))
-        rasterStatsDf.to_csv(aggOutput, mode = 'a', index=False, header=False, columns=useCols)
-        
-        #* For now, don't check for duplicates. After running Alaska subset, time how long it takes to check vs. not (make copy of agg .csv first bc without checking dups it will append and write dups)
+    
+    # Stack is done: append it to the aggregate once, then put the stack
+    # outputs in place
+    checkClaim(claimLost, stackName)
+    appendAggregate(partialCsv, aggOutput, nRows)
+    
+    publishOutput(partialCsv, stackCsv)
+    if writeShp:
+        publishOutput(partialShp, stackShp)
 
     totalTime = calculateElapsedTime(start, time.time())
     
     #* temp - write n rows to .csv so we can check. 1/6/23: Also write stack name and elapsed time
-    nRows = len(rasterStatsDf.index)
     with open(aggOutput.replace('.csv', '__checkCount.csv'), 'a') as of:
         of.write('{},{},{}\n'.format(stackName, nRows, totalTime))
         
@@ -306,18 +488,72 @@ def main(args):
     # Enable append mode
 
     return
+
+# Run main() for each stack in stackList in this process. args is the same
+# dict as for main() (rasterStack is set for each stack). Per-stack log files
+# are closed and stdout restored after every stack, failures are printed 
+# (to the stack log if logging) and skipped, and their partial outputs are
+# deleted. Returns list of failed stacks
+def runBatch(stackList, args):
+    
+    stdout = sys.stdout
+    failed = []
+    
+    for c, stack in enumerate(stackList):
+        
+        print("\n{}/{}: {}".format(c+1, len(stackList), stack))
+        
+        partialOutputs = []
+        
+        try:
+            main(dict(args, rasterStack = stack, 
+                                             partialOutputs = partialOutputs))
+            
+        except Exception:
+            print("\nFAILED: {}\n".format(stack))
+            traceback.print_exc(file = sys.stdout)
+            removeOutputs(partialOutputs)
+            failed.append(stack)
+            
+        finally:
+            if sys.stdout is not stdout:
+                sys.stdout.close()
+                sys.stdout = stdout
+                
+    print("\nFinished {} stacks, {} failed".format(len(stackList), len(failed)))
+    for stack in failed:
+        print(" {}".format(stack))
+        
+    return failed
     
     
 if __name__ == "__main__":
     
     parser = argparse.ArgumentParser()
-    parser.add_argument("-r", "--rasterStack", type=str, required=True, help="Input raster stack")
+    parser.add_argument("-r", "--rasterStack", type=str, required=False, help="Input raster stack")
+    parser.add_argument("-l", "--stackList", type=str, required=False, help="Text file with one raster stack per line, to run all in one process (instead of -r)")
     parser.add_argument("-z", "--zonalType", type=str, required=True, help="Zonal type (ATL08-20m or ATL08-100m for now")
     parser.add_argument("-o", "--aggregateOutput", type=str, required=True, help="Output for all stacks. Must be a .csv file, .gdb/.shp, or database (coming soon)")
     parser.add_argument("-b", "--baseDir", type=str, required=True, help="Base directory for outputs")
     parser.add_argument("-log", "--logOutput", action='store_true', help="Log the output")
     parser.add_argument("-mode", "--statsMode", type=str, required=True, help="'polygon' for zonal stats (default??) or 'point' for point query")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of processes for zonal/point stats and polygonizing disturbance patches (default 1)")
+    parser.add_argument("-chunk", "--chunkSize", type=int, default=50000, help="Number of zones per zonal stats batch (default 50000)")
+    parser.add_argument("-labels", "--labelStats", action='store_true', help="Disturbance zonal stats from a patch label image instead of polygons (pixels assigned by center)")
+    parser.add_argument("-simplify", "--simplify", type=float, default=None, help="Simplify disturbance patches with this tolerance in pixels, e.g. 1 (default None: no simplifying)")
+    parser.add_argument("-noShp", "--noShp", action='store_true', help="Do not write the stack .shp (with -labels, patches are not polygonized)")
+    parser.add_argument("-columns", "--columns", type=str, default=None, help="Comma-separated ATL08 columns to load and write to outputs (default: all columns)")
+    parser.add_argument("-coverageCache", "--coverageCache", action='store_true', help="Cache zone coverage of each stack in its output directory, for re-runs on the same zones (zonal mode)")
     
     args = vars(parser.parse_args())
-
-    main(args)
\ No newline at end of file
+    
+    if args['columns']:
+        args['columns'] = [c.strip() for c in args['columns'].split(',')]
+
+    if args['stackList']:
+        with open(args['stackList'], 'r') as sl:
+            runBatch([r.strip() for r in sl.readlines() if r.strip()], args)
+    elif args['rasterStack']:
+        main(args)
+    else:
+        parser.error("One of -r or -l is required")
\ No newline at end of file
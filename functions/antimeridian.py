@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+
+Antimeridian handling for stack extents in lat/lon (EPSG:4326)
+
+A stack crossing the antimeridian (Chukotka/Alaska) reprojects to a polygon
+ whose lon goes from about -180 to 180, so bounds based queries pick up every
+ shot across the boreal. splitAntimeridian() cuts such a polygon into its
+ east (lon > 0) and west (lon < 0) parts, and getBoundsList() gives one
+ bounds per part so index/tile/.csv filters can query each part separately
+
+Anything spanning more than 180 degrees of lon is taken to cross, so these
+ only take gdfs in a geographic crs (RuntimeError otherwise)
+"""
+import numpy as np
+import shapely
+
+from shapely.geometry import box
+
+EAST_BOX = box(0, -90, 180, 90)
+WEST_BOX = box(-180, -90, 0, 90)
+
+# Raise RuntimeError if gdf crs is not geographic (lon/lat degrees)
+def checkGeographic(extentGdf):
+
+    if extentGdf.crs is not None and not extentGdf.crs.is_geographic:
+        raise RuntimeError("Antimeridian check needs lat/lon, got {}".format(
+                                                    extentGdf.crs.to_string()))
+
+# True if gdf (lat/lon) spans more than 180 degrees of lon
+def crossesAntimeridian(extentGdf):
+
+    checkGeographic(extentGdf)
+
+    (xmin, ymin, xmax, ymax) = extentGdf.total_bounds
+
+    return (xmax - xmin) > 180
+
+# Split polygon geometry (lat/lon) that wraps the wrong way around the globe
+# into parts on each side of the antimeridian
+def splitGeometry(geom):
+
+    def shiftWest(coords):
+        coords = coords.copy()
+        coords[coords[:, 0] < 0, 0] += 360
+        return coords
+
+    # Make coords continuous across 180, then cut at 180
+    shifted = shapely.transform(geom, shiftWest)
+
+    east = shifted.intersection(EAST_BOX)
+    west = shapely.transform(shifted.intersection(box(180, -90, 360, 90)),
+                                            lambda coords: coords - [360, 0])
+
+    return shapely.union_all([east, west])
+
+# Given gdf in lat/lon, return copy with geometries split at the antimeridian
+# gdf is returned as is if it does not cross
+def splitAntimeridian(extentGdf):
+
+    if not crossesAntimeridian(extentGdf):
+        return extentGdf
+
+    print("\nExtent crosses antimeridian. Splitting into multipolygon\n")
+
+    extentGdf = extentGdf.copy()
+    extentGdf['geometry'] = [splitGeometry(geom) for geom in
+                                                        extentGdf.geometry]
+
+    return extentGdf
+
+# Given gdf in lat/lon, return list of (xmin, ymin, xmax, ymax) to query
+# One bounds normally, one per side of the antimeridian if extent crosses
+def getBoundsList(extentGdf):
+
+    if not crossesAntimeridian(extentGdf):
+        return [tuple(extentGdf.total_bounds)]
+
+    geom = shapely.union_all(np.asarray(extentGdf.geometry))
+
+    parts = [geom.intersection(WEST_BOX), geom.intersection(EAST_BOX)]
+
+    return [tuple(part.bounds) for part in parts if not part.is_empty]
+
+# Given lon/lat arrays and list of bounds, return boolean mask of points
+# within any of the bounds
+def inBoundsMask(x, y, boundsList):
+
+    x = np.asarray(x)
+    y = np.asarray(y)
+
+    mask = np.zeros(len(x), dtype = bool)
+
+    for (xmin, ymin, xmax, ymax) in boundsList:
+        mask |= (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
+
+    return mask
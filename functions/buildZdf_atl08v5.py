@@ -6,17 +6,56 @@ Given a raster extent and corresponding epsg, build a
  
 Function uses the .csv files where ATL08 data was extracted/filtered from .h5,
  and a footprints .shp of the .h5 files
+
+If storeDir is supplied, granules are read from the Parquet store made with
+ scripts/create_atl08_v005_parquet_store.py instead (falls back to the .csv
+ for any granule not in the store). Row groups outside the stack bbox are
+ skipped. If columns is supplied, only those columns plus the ones needed
+ to build segments (KEEP_COLUMNS, lat/lon) are loaded, from either format
+
+If tileDir is supplied and has a tile manifest (made with 
+ scripts/create_atl08_v005_tile_store.py), only the tiles intersecting the
+ stack are read instead of every granule crossing the stack
+
+Parsed .csv granules are kept in an in-process LRU cache (granuleCache, 
+ bounded by GRANULE_CACHE_BYTES) so neighbouring stacks run in the same 
+ process don't re-read the same granules. Use granuleCache.resize() to change
+ budget. .parquet granules/tiles are not cached, their bbox read only loads 
+ the row groups near the stack
+
+If footprint (stack valid data polygon, see RasterStack.validDataFootprint) is
+ supplied, shots are kept only within it (buffered by segLength) rather than 
+ within the whole stack extent
+
+Stacks crossing the antimeridian have their extent split into east/west parts
+ and each part is queried separately, so they only read their neighbourhood
+
+Granules are read concurrently by loadWorkers threads (I/O bound reads from 
+ GPFS). With parseProcesses = True, granules not already cached are read and 
+ parsed in a process pool instead (these are not added to the cache)
 """
 import os
 import time
 import glob
 
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
 import pandas as pd
 import geopandas as gpd
 
 import numpy as np
+import shapely
+
+from shapely.geometry import box
 
-from shapely.geometry import box, MultiPolygon
+from models.GranuleCache import GranuleCache
+
+from functions.clipPoints import pointsInExtentMask
+from functions.antimeridian import splitAntimeridian, getBoundsList, \
+                                                                 inBoundsMask
+from functions.processCache import queryIndex
+from functions.pointsToPolygons_atl08v5 import FOOTPRINT_FIELDS, \
+                                                   TRACK_FIELD, GRANULE_FIELD
 
 #from functions import calculateElapsedTime
 
@@ -30,8 +69,33 @@ warnings.filterwarnings("ignore", category=ShapelyDeprecationWarning)
 # Use scripts/create_atl08_v005_20m_index-footprints.py to create:
 indexShp = '/explore/nobackup/people/mwooten3/3DSI/ZonalStats_2022/ATL08/_fileFootprints/ATL08__boreal_all_20m__footprints.shp'
 
+# Tile manifest .csv in the tile store (tile, path, nShots, bounds)
+TILE_MANIFEST_NAME = 'tile_manifest.csv'
+
+# Memory budget for parsed granules kept between stacks
+GRANULE_CACHE_BYTES = 4 * 1024**3
+
+granuleCache = GranuleCache(GRANULE_CACHE_BYTES)
+
+# Max number of granules read at the same time
+LOAD_WORKERS = 8
+
+# Columns always loaded when a column list is given (segment polygons need
+# the granule/track and, if stored, the footprint columns)
+KEEP_COLUMNS = [GRANULE_FIELD, TRACK_FIELD] + FOOTPRINT_FIELDS
+
 # Given an extent/epsg build a geodataframe of ATL08 shots including attributes
-def buildZdf(rasterExtent, rasterEpsg, zonalDir, segLength = 20):
+# storeDir: optional Parquet store root; columns: optional list of columns to
+#  keep (lat/lon and KEEP_COLUMNS are always loaded). None keeps all columns
+# tileDir: optional tile store for zonalDir, used instead of granules if exists
+# useCache: keep parsed granules in granuleCache for the next stacks
+# loadWorkers: number of granules read at once (1 reads them one by one)
+# parseProcesses: read/parse uncached granules in processes instead of threads
+# footprint: optional shapely polygon of stack valid data, in rasterEpsg
+def buildZdf(rasterExtent, rasterEpsg, zonalDir, segLength = 20, 
+                           storeDir = None, columns = None, tileDir = None,
+                           useCache = True, loadWorkers = LOAD_WORKERS,
+                                     parseProcesses = False, footprint = None):
     
     start = time.time()
     
@@ -39,8 +103,19 @@ def buildZdf(rasterExtent, rasterEpsg, zonalDir, segLength = 20):
     if segLength not in [20, 100]:
         raise RuntimeError("Segment length for ATL08 zonal type must be 20 or 100")
     
+    if columns is not None:
+        columns = list(columns) + [c for c in KEEP_COLUMNS if c not in columns]
+        
     # Get polygon extent in a gdf, in source/csv epsg (default 4326)
     extentPoly = getExtentGdf(rasterExtent, rasterEpsg)
+    
+    # Use the valid data footprint instead, if supplied
+    # Buffer by segment length so segments partly on valid data are kept
+    if footprint is not None:
+        if footprint.is_empty:
+            print("\nStack has no valid data. Exiting")
+            return None
+        extentPoly = getFootprintGdf(footprint, rasterEpsg, buffer = segLength)
     #print("time to make extent polygon gdf:")
     #print(calculateElapsedTime(start, time.time()))
 
@@ -67,19 +142,33 @@ def buildZdf(rasterExtent, rasterEpsg, zonalDir, segLength = 20):
     # do transformations if need be. Should not need this as this function is
     # specific to ATL08 (v005)
     start2 = time.time()
-    inputFiles = getZonalIndexList(indexShp, zonalDir, extentPoly)
+    if tileDir and os.path.isfile(os.path.join(tileDir, TILE_MANIFEST_NAME)):
+        inputFiles = getTileList(tileDir, extentPoly)
+        inputDir = tileDir
+        
+    else:
+        inputFiles = getZonalIndexList(indexShp, zonalDir, extentPoly)
+        inputDir = zonalDir
 
+        # Use the columnar store for granules that have been converted
+        if storeDir:
+            inputFiles = [getStorePath(inFile, storeDir) for inFile in inputFiles]
     
     # Using list of files, build large geodataframe of input zones
-    print("Building gdf with {} inputs in {}".format(len(inputFiles), zonalDir))
+    print("Building gdf with {} inputs in {}".format(len(inputFiles), inputDir))
 
     start3 = time.time()
     
+    cache = granuleCache if useCache else None
+    
     # This assumes input files are .csv with lat/lon            
+    gdfs = loadGranules(inputFiles, loadWorkers, parseProcesses, 
+                        bbox = extentPoly, lonField = lonField, 
+                        latField = latField, drop_20m = drop_20m, 
+                        columns = columns, cache = cache)
+    
     try: # this will throw ValueError if all DFs are empty
-        zdf = pd.concat(map(lambda inFile: csvToGdf(inFile, bbox=extentPoly,
-            lonField = lonField, latField = latField, drop_20m = drop_20m), 
-                                                                   inputFiles))
+        zdf = pd.concat(gdfs)
     
     except ValueError:
         print("\nThere were no valid shots within stack. Exiting")
@@ -89,6 +178,11 @@ def buildZdf(rasterExtent, rasterEpsg, zonalDir, segLength = 20):
     #print(calculateElapsedTime(start3, time.time()))
     
     print(" Created GDF with {} points for stack".format(len(zdf.index)))
+    if useCache:
+        cacheStats = granuleCache.stats()
+        print(" Granule cache: {} hits, {} misses ({} granules, {} MB)".format(
+                      cacheStats['hits'], cacheStats['misses'], 
+                      cacheStats['entries'], cacheStats['nBytes'] // 1024**2))
     end = time.time()
     print(" Elapsed time: {}\n".format(calculateElapsedTime(start, end)))
     
@@ -119,35 +213,99 @@ def getCsvFullPath(bname, zonalDir):
      
     return search[0]
 
+# Get path of .parquet in store for an ATL08 .csv path from the index 
+# Store mirrors the .csv tree: <storeDir>/<zonalDir name>/<yyyy>/<name>.parquet
+# Returns the .csv path if the granule is not in the store
+def getStorePath(csv, storeDir):
+    
+    storePath = os.path.join(storeDir, *csv.split(os.sep)[-3:])
+    storePath = storePath.replace('.csv', '.parquet')
+    
+    if os.path.isfile(storePath):
+        return storePath
+    
+    return csv
+
+# Read ATL08 granule (.csv or .parquet from store) into regular dataframe
+# Only read columns (plus lat/lon) if columns is supplied. Columns the file
+# does not have (e.g. footprints in a .csv) are skipped
+# For .parquet, boundsList = [(xmin, ymin, xmax, ymax), ...] skips row groups
+# outside all of the bounds
+def readGranule(inFile, lonField = 'lon', latField = 'lat', columns = None,
+                                                          boundsList = None):
+    
+    if columns is not None:
+        columns = list(columns) + [c for c in [lonField, latField] 
+                                                          if c not in columns]
+    
+    if inFile.endswith('.parquet'):
+        
+        if columns is not None:
+            import pyarrow.parquet as pq
+            fileColumns = pq.read_schema(inFile).names
+            columns = [c for c in columns if c in fileColumns]
+        
+        # One AND group per bounds, ORed together
+        filters = None
+        if boundsList is not None:
+            filters = [[(lonField, '>=', xmin), (lonField, '<=', xmax),
+                        (latField, '>=', ymin), (latField, '<=', ymax)]
+                                 for (xmin, ymin, xmax, ymax) in boundsList]
+            
+        return pd.read_parquet(inFile, columns = columns, filters = filters)
+    
+    if columns is not None:
+        keep = set(columns)
+        return pd.read_csv(inFile, usecols = lambda c: c in keep)
+    
+    return pd.read_csv(inFile)
+
+# Read granule and remove shots with no data lat/lon
+# Occasionally a lat/lon point will be very large/no data.
+# This should be fixed in extraction code, but for now, remove them
+def parseGranule(inFile, lonField = 'lon', latField = 'lat', columns = None,
+                                                          boundsList = None):
+    
+    df = readGranule(inFile, lonField, latField, columns, boundsList)
+    
+    return df.loc[(df[latField] != 3.402823466385289e+38)]
+
 # Given an ATL08 .csv file with lat/lon fields (EPSG 4326), and an extent or  
 # extent polygon/gdf (optional), return a geodataframe with points as geometry
 # srcEpsg is the projection of the .csv's lat/lon EPSG
+# csv can also be a .parquet from the store and columns a list of columns
+# If cache (GranuleCache) is supplied, a whole parsed .csv granule is cached
+# and filtered to bbox here, so it can be reused for other stacks. A .parquet
+# with a bbox is not cached (that would read all of it instead of the row
+# groups within bbox)
 def csvToGdf(csv, lonField = 'lon', latField = 'lat', bbox = None, 
-                                             srcEpsg = 4326, drop_20m = False):
+                           srcEpsg = 4326, drop_20m = False, columns = None,
+                                                                cache = None):
+    
+    # First, project bbox to match .csv, if need be
+    if bbox is not None and bbox.crs.to_epsg() != srcEpsg:
+        bbox = bbox.to_crs(epsg = srcEpsg)
+        
+    # One bounds per side of antimeridian if bbox crosses it
+    boundsList = None
+    if bbox is not None:
+        boundsList = getBoundsList(bbox)
         
     # Read .csv into regular dataframe - 
     # .csv should have a latitude and longitude columns - default is 'lat'/'lon'
-    df = pd.read_csv(csv)
-          
-    # Occasionally a lat/lon point will be very large/no data.
-    # This should be fixed in extraction code, but for now, remove them
-    df = df.loc[(df[latField] != 3.402823466385289e+38)]
+    if cache is not None and not (csv.endswith('.parquet') and boundsList):
+        df = cache.get(csv, lambda inFile: parseGranule(inFile, lonField, 
+                                              latField, columns), columns)
+    else:
+        df = parseGranule(csv, lonField, latField, columns, boundsList)
     
     # Pre-filter to speed things up
     # If bbox is supplied, go ahead and filter geographically on tabular data 
     
-    # 1/6/23: This won't throw an error, but just will not really work in the 
-    #          rare case that stack extent crosses antimeridian/is multipolygon
-    if bbox is not None:# and bbox.type[0] == 'Polygon':
-        
-        # First, project coords to match .csv, if need be
-        if bbox.crs.to_epsg() != srcEpsg:
-            bbox = bbox.to_crs(epsg = srcEpsg)
+    if bbox is not None:
             
-        # Get bbox extent and pre-filter df
-        (xmin, ymin, xmax, ymax) = bbox.total_bounds
-        df = df.loc[(df[lonField] >= xmin) & (df[lonField] <= xmax) & 
-                    (df[latField] >= ymin) & (df[latField] <= ymax)]
+        # Pre-filter df to bbox extent (each part if split at antimeridian)
+        df = df.loc[inBoundsMask(df[lonField], df[latField], boundsList)]
 
 
     # This might be empty, just return None
@@ -155,6 +313,23 @@ def csvToGdf(csv, lonField = 'lon', latField = 'lat', bbox = None,
         #print("{} empty after pre-filtering".format(csv))
         return None 
     
+    # If bbox is supplied, filter again with point-in-polygon test to remove
+    # rows outside extent that didn't get removed earlier
+    if bbox is not None:
+        mask = pointsInExtentMask(df[lonField], df[latField], bbox)
+        if not mask.all():
+            df = df.loc[mask]
+        
+    if df.empty:
+        #print("{} empty after filtering".format(csv))
+        return None      
+    
+    # Name of the source granule (tiles already have it), so segments can be
+    # built per granule/track after granules are concatenated
+    if GRANULE_FIELD not in df.columns:
+        granule = os.path.splitext(os.path.basename(csv))[0]
+        df = df.assign(**{GRANULE_FIELD: granule})
+    
     geometry = gpd.points_from_xy(np.asarray(df[lonField]), 
                     np.asarray(df[latField]))
     
@@ -164,18 +339,64 @@ def csvToGdf(csv, lonField = 'lon', latField = 'lat', bbox = None,
             gpd.points_from_xy(np.asarray(df[lonField]), 
                     np.asarray(df[latField])), crs = 'EPSG:{}'.format(srcEpsg))
     """    
-    
-    # If bbox is supplied, filter again via geopandas to remove rows outside
-    # extent that didn't get removed earlier
-    if bbox is not None:
-        gdf = gpd.overlay(gdf, bbox, how='intersection')
-        
-    if gdf.empty:
-        #print("{} empty after filtering".format(csv))
-        return None      
 
     return gdf
 
+# Run csvToGdf(inFile, **kwargs) for each input file, loadWorkers at a time,
+# and return the results (gdf or None) in inputFiles order
+# Results fill a preallocated list so they can be concatenated once
+# With parseProcesses, files not in kwargs['cache'] are read in a process
+# pool without the cache (cache can't be shared between processes)
+def loadGranules(inputFiles, loadWorkers = LOAD_WORKERS, 
+                                             parseProcesses = False, **kwargs):
+    
+    gdfs = [None] * len(inputFiles)
+    
+    if loadWorkers <= 1 or len(inputFiles) <= 1:
+        for i, inFile in enumerate(inputFiles):
+            gdfs[i] = csvToGdf(inFile, **kwargs)
+        return gdfs
+    
+    threadFiles = list(range(len(inputFiles)))
+    processFiles = []
+    
+    if parseProcesses:
+        cache = kwargs.get('cache')
+        columns = kwargs.get('columns')
+        
+        if cache is not None:
+            threadFiles = [i for i in threadFiles 
+                                    if cache.has(inputFiles[i], columns)]
+        else:
+            threadFiles = []
+            
+        processFiles = [i for i in range(len(inputFiles)) 
+                                                    if i not in threadFiles]
+        
+    if processFiles:
+        processKwargs = dict(kwargs, cache = None)
+        
+        with ProcessPoolExecutor(max_workers = loadWorkers) as executor:
+            futures = {i: executor.submit(csvToGdf, inputFiles[i], 
+                                         **processKwargs) for i in processFiles}
+            
+            # Cached granules are filtered here while the processes run
+            for i in threadFiles:
+                gdfs[i] = csvToGdf(inputFiles[i], **kwargs)
+                
+            for i in futures:
+                gdfs[i] = futures[i].result()
+                
+        return gdfs
+    
+    with ThreadPoolExecutor(max_workers = loadWorkers) as executor:
+        futures = {i: executor.submit(csvToGdf, inputFiles[i], **kwargs) 
+                                                          for i in threadFiles}
+        for i in futures:
+            gdfs[i] = futures[i].result()
+            
+    return gdfs
+
 # From an extent and projection, get GDF in Lat/Lon coords
 # srcEpsg is the projection of the stack extent representation
 # dstEpsg is the projection of the lat/lon fields from .csv files #* (or )
@@ -193,37 +414,64 @@ def getExtentGdf(extent, srcEpsg, dstEpsg = 4326):
     if extentGdf.crs.to_epsg() != dstEpsg:
         extentGdf = extentGdf.to_crs(epsg = dstEpsg)
         
-    """    
     # 1/6/23: Sometimes a .vrt will cross the antimeridian. If so, need to
     #         make a multipolygon so script won't try to get all icesat shots 
     #         across the boreal. This only works if dstEpsg = 4326 (lat/lon)
-    #    Turns out this doesn't really help when passing this to gpd functions
-    if abs(float(extentGdf.bounds.maxx) - float(extentGdf.bounds.minx)) > 180:
-        return extentGdf
-        import pdb; pdb.set_trace()
-        print("\nStack crosses anti-meridian. Splitting into multipolygon\n")
-        # get polygon portion in Western hemisphere
-        poly1 = box(-180, float(extentGdf.bounds.miny), 
-                    float(extentGdf.bounds.minx), float(extentGdf.bounds.maxy))      
-        # get polygon portion in Eastern hemisphere
-        poly2 = box(float(extentGdf.bounds.maxx), float(extentGdf.bounds.miny), 
-                    180, float(extentGdf.bounds.maxy))
-        
-        multipoly = MultiPolygon([poly1, poly2])
-        extentGdf = gpd.GeoDataFrame({'geometry': [multipoly]},  
-                                             crs='EPSG:{}'.format(dstEpsg))
-    """
+    #         Index/tile/.csv filters then query each part (getBoundsList)
+    if dstEpsg == 4326:
+        extentGdf = splitAntimeridian(extentGdf)
         
     return extentGdf
     
+# From a footprint polygon in srcEpsg, get GDF in Lat/Lon coords
+# Footprint is buffered by buffer (srcEpsg units) and densified before it is
+# reprojected so long straight edges stay in place
+def getFootprintGdf(footprint, srcEpsg, buffer = 0, dstEpsg = 4326):
+    
+    if buffer:
+        footprint = footprint.buffer(buffer)
+        
+    footprint = shapely.segmentize(footprint, max(buffer, 1) * 10)
+    
+    footprintGdf = gpd.GeoDataFrame({'geometry': [footprint]}, 
+                                             crs='EPSG:{}'.format(srcEpsg))
+    
+    if footprintGdf.crs.to_epsg() != dstEpsg:
+        footprintGdf = footprintGdf.to_crs(epsg = dstEpsg)
+        
+    if dstEpsg == 4326:
+        footprintGdf = splitAntimeridian(footprintGdf)
+        
+    return footprintGdf
+    
 # From an index .shp, get list of file basenames and build list of fullpaths to 
 # read into big zonal GDF. Also supply extent in GPD dataframe, in epsg:4326 
 def getZonalIndexList(indexShp, zonalDir, extentPolyGdf):
     
-    # Read index .shp into gdf, using bbox which means no need to intersect
-    indexGdf = gpd.read_file(indexShp, bbox=extentPolyGdf)
+    # Index .shp is read once per process (cached), then queried with its
+    # spatial index. One query per side of antimeridian if extent crosses it
+    indexGdf = queryIndex(indexShp, extentPolyGdf)
+    indexGdf = indexGdf.drop_duplicates(subset = 'ATL08_path')
     
     # ATL_path is now included in .shp as ATL08_path
     return indexGdf.loc[(indexGdf['ATL08_path'] != 'DNE')]['ATL08_path'].tolist()
 
+# From a tile store manifest, get list of tile .parquet files whose shots 
+# intersect the extent. Also supply extent in GPD dataframe, in epsg:4326
+def getTileList(tileDir, extentPolyGdf):
+    
+    manifest = pd.read_csv(os.path.join(tileDir, TILE_MANIFEST_NAME))
+    
+    # Bounds in manifest are the bounds of the shots in the tile
+    # Keep tiles that intersect any part of extent (see getBoundsList)
+    keep = np.zeros(len(manifest.index), dtype = bool)
+    for (xmin, ymin, xmax, ymax) in getBoundsList(extentPolyGdf):
+        keep |= ((manifest['xmax'] >= xmin) & (manifest['xmin'] <= xmax) &
+                 (manifest['ymax'] >= ymin) & (manifest['ymin'] <= ymax)).values
+        
+    manifest = manifest.loc[keep]
+    
+    # Paths in manifest are relative to tileDir
+    return [os.path.join(tileDir, p) for p in manifest['path']]
+
 
@@ -8,10 +8,41 @@ Function uses the Landsat stack footprint file and some conversions to get df
 
 Process:
 - Get list of landsat files from footprints given extent
-- build vrt of Landsat files
-- gdal_calc to remove 0 and 50
-- gdal_polygonize to convert to .shp
-- return geodataframe of .shp
+- build (in-memory) vrt of Landsat files and read it over the stack extent
+- mask 0 and 50 to nodata in memory (same as the old gdal_calc step)
+- polygonize the array with gdal.Polygonize into an in-memory layer. With
+  workers > 1 the array is split into tiles that are polygonized in a process
+  pool, and patches split at tile seams are merged back (mergeSeamPatches)
+- return geodataframe of patches
+
+No subprocesses or intermediate files. Set keepFiles to also write the
+ masked .tif and patch .shp to tmpDir (a patch .shp already in tmpDir is
+ read instead of rebuilding it)
+
+If storeDir is supplied, patches come from the regional patch store instead:
+ every Landsat tile is masked/polygonized once (on its own 10m -tap grid) to
+ <storeDir>/<tile>.parquet, built the first time any stack needs it (or ahead
+ of time with scripts/create_disturbance_patch_store.py). The tile's
+ footprint on that grid (pixels it has data for in a .vrt) goes to
+ <storeDir>/<tile>_footprint.parquet. A stack selects the patches of its
+ tiles with a spatial index query. Where tiles overlap, the .vrt mosaic has
+ the pixels of the last tile, so each tile's patches are cut to the part of
+ its footprint no later tile covers. Patches split at tile seams are merged
+ back (same ageYear, sharing an edge), and the result is cut at the stack
+ extent, so patches are the same as polygonizing the stack array. If a
+ stack's tiles are not all in the same projection, the stack array is
+ polygonized as above (the .vrt resamples them onto one grid)
+
+buildLabelZdf() is the label image version (for RasterStats.LabelStats):
+ connected patches of the masked array are labelled instead of polygonized,
+ and patch lon/lat/area come from the label image. Patch polygons are only
+ made if withGeometry (for the output .shp)
+
+If simplify is supplied (tolerance in pixels), patch outlines are simplified
+ before they are returned (simplifyPatches): far fewer vertices to rasterize,
+ reproject and write. Patches are simplified as a coverage so neighbouring
+ patches still share their edges. The vertex reduction and area change are
+ printed, note patchSize_m2 is the area of the simplified patch
 
 Process looks a lot different from atl08
  
@@ -19,15 +50,27 @@ Process looks a lot different from atl08
 import os
 import time
 
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
 import geopandas as gpd
 
 import numpy as np
+import shapely
 
-from shapely.geometry import box, MultiPolygon
+from osgeo import gdal, ogr, osr
+from shapely.geometry import box
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 
 from models.Raster import Raster 
 
+from functions.clipPoints import pointsInExtentMask
+from functions.antimeridian import splitAntimeridian, getBoundsList, \
+                                                                 inBoundsMask
+from functions.processCache import queryIndex, getTransformer
+
 
 # filter out RuntimeWarnings, due to geopandas/fiona read file spam
 # https://stackoverflow.com/questions/64995369/geopandas-warning-on-read-file
@@ -41,11 +84,31 @@ warnings.filterwarnings("ignore", category=ShapelyDeprecationWarning)
 # Made footprints .shp of Landsat age year .tif files for ea and na
 indexShpDir = '/explore/nobackup/people/mwooten3/3DSI/ZonalStats_2022/_stackFootprints'
 
+# Disturbance raster settings (from the old gdalbuildvrt/gdal_calc commands)
+# -tap -tr 10 10 improves geolocation a ton (see onenote p90)
+AGE_RESOLUTION = 10
+AGE_NODATA     = 255 # Byte output, 0 and 50 are set to this
+AGE_YEAR_FIELD = 'ageYear' # to match log file
+LABEL_FIELD    = 'label'
+SEAM_FIELD     = 'seam' # patch touches the edge of its tile
+
+# Tile size (pixels) when polygonizing in parallel
+POLYGONIZE_TILE_SIZE = 4096
+
+# coverage_simplify needs shapely >= 2.1, otherwise patches are simplified
+# one by one (shared edges are then simplified separately)
+HAS_COVERAGE_SIMPLIFY = hasattr(shapely, 'coverage_simplify')
+
 
 # /explore/nobackup/people/pmontesa/userfs02/data/icesat2/atl08.005/boreal_ea_20m
 
 # Given an extent/epsg build a geodataframe of ATL08 shots including attributes
-def buildZdf(rasterExtent, rasterEpsg, tmpDir, region='na'):
+# keepFiles: also write masked age .tif/patch .shp to tmpDir
+# storeDir: regional patch store to get patches from (built as needed)
+# workers: processes for polygonizing (tiles of the array in parallel)
+# simplify: tolerance (in pixels) to simplify patch outlines with, or None
+def buildZdf(rasterExtent, rasterEpsg, tmpDir, region='na', keepFiles = False,
+                              storeDir = None, workers = 1, simplify = None):
     
     start = time.time()
     
@@ -71,13 +134,24 @@ def buildZdf(rasterExtent, rasterEpsg, tmpDir, region='na'):
     print("Building gdf with {} inputs from {}".format(len(inputFiles), 
                                                                       indexShp))
     
-    # Get disturbance patches within extent from list
-    zdf = generateDisturbancePatches(inputFiles, extentPoly, tmpDir)
+    # Get disturbance patches within extent from list, from the patch store
+    # if we can (None if tiles are not all in one projection)
+    zdf = None
+    if storeDir:
+        zdf = getStorePatches(inputFiles, extentPoly, storeDir, workers)
+        
+    if zdf is None:
+        zdf = generateDisturbancePatches(inputFiles, extentPoly, tmpDir, 
+                                                           keepFiles, workers)
 
     # Check if zdf is empty for nice exit
     if len(zdf.index) == 0:
         print("\nThere were no valid shots within stack. Exiting")
         return None
+    
+    if simplify:
+        zdf = simplifyPatches(zdf, simplify)
+        zdf = zdf[~zdf.geometry.is_empty]
    
     #print("time to make GDF:")
     #print(calculateElapsedTime(start3, time.time()))
@@ -107,76 +181,545 @@ def calculateElapsedTime(start, end, unit = 'minutes'):
 
 # From a list of disturbance .tif files, get gdf of valid patches
 # Hardcode some stuff
-#* This overwrites ? maybe
-def generateDisturbancePatches(inputFiles, extentPoly, tmpDir):
-    
-    ageYearCol = 'ageYear' # to match log file (for polygonize)
+# If keepFiles, masked .tif and patch .shp are also written to tmpDir
+def generateDisturbancePatches(inputFiles, extentPoly, tmpDir, 
+                                               keepFiles = False, workers = 1):
     
-    # To use -te, convert to crs of first inputFile (utm)
-    toCrs = Raster(inputFiles[0]).epsg()
-    (xmin, ymin, xmax, ymax) = extentPoly.to_crs(epsg=toCrs).total_bounds
+    # output filenames (only written if keepFiles)
+    outCalc = os.path.join(tmpDir, 'Landsat_disturbances_age.tif')
+    outShp = outCalc.replace('.tif', '.shp')
     
-    # output filenames
-    outVrt = os.path.join(tmpDir, 'Landsat_age.vrt') # 1
-    outCalc = os.path.join(tmpDir, 'Landsat_disturbances_age.tif') # 2
-    outShp = outCalc.replace('.tif', '.shp') # 3
-    
-    # Check final output file first - twice but fine
+    # Check final output file first
     if os.path.isfile(outShp):
         
         print("\n\t{} already exists".format(outShp))  
         
         return gpd.read_file(outShp)
     
+    # 1. Read Landsat age year over the stack extent (in-memory .vrt)
+    (ageArr, geotransform, projection, srcNoData) = \
+                                          readAgeYear(inputFiles, extentPoly)
     
-    # 1. Build .vrt - cannot name with stack bc stupidity
-    # sometimes UTM proj might not be same for all Landsat tiles
-    # -tap -tr 10 10 doesn't really add time (outside of creating files), and improves geolocation a ton (see onenote p90)
-    if not os.path.isfile(outVrt):
-        cmd = 'gdalbuildvrt -tap -tr 10 10 -allow_projection_difference -te {} {} {} {} {} {}'.format(xmin, ymin, xmax, ymax,
-                                                outVrt, ' '.join(inputFiles))
-        #cmd = 'gdalbuildvrt {} {}'.format(outVrt, ' '.join(inputFiles)) 
-        # -te {} {} {} {} -resolution user -tr 30 30 error was te in 4326 not proj. 
-        print("\n\tCreating {}".format(outVrt))
-        print("\t{}".format(cmd))
-        os.system(cmd)     
-    else:
-        print("\n\t{} already exists".format(outVrt))        
-    
-    # 2. gdal_calc.py to convert 0 and 50 to NoData 
-    ## also specify extent and convert to Byte/255 
-    # **might do int16/-99 if zstat issues (uses -99 prob)
-    outND = 255 # or -99
-    outType = 'Byte' # or 'Int16'
-    
-    if not os.path.isfile(outCalc):
-        cmd = 'gdal_calc.py --quiet --calc="{}*(A==0) + {}*(A==50) + A*((A>0) & (A<50))" -A \
-                {} --outfile={} --type={} --NoDataValue={}'.format(outND, outND, 
-                                                outVrt, outCalc, outType, outND)
+    # 2. Convert 0 and 50 to NoData in memory
+    ageArr = maskAgeYear(ageArr, srcNoData)
+    
+    if keepFiles:
         print("\n\tCreating {}".format(outCalc))
-        print("\t{}".format(cmd))
-        os.system(cmd)
-    else:
-        print("\n\t{} already exists".format(outVrt))
+        arrayToDataset(ageArr, geotransform, projection, 'GTiff', outCalc)
+    
+    # 3. Convert disturbances array into patches
+    patches = polygonizeTiled(ageArr, geotransform, projection, workers)
+    
+    if keepFiles and len(patches.index) > 0:
+        print("\n\tCreating {}".format(outShp))
+        patches.to_file(filename = outShp, driver = "ESRI Shapefile")
+    
+    return patches
+
+# Bounds of extentPoly (any crs) in epsg, expanded to the -tap 10m grid
+# (same as the bounds gdalbuildvrt -te -tap -tr 10 10 ends up with)
+def getAlignedBounds(extentPoly, epsg):
+    
+    (xmin, ymin, xmax, ymax) = extentPoly.to_crs(epsg=epsg).total_bounds
+    
+    res = AGE_RESOLUTION
+    
+    return (np.floor(xmin / res) * res, np.floor(ymin / res) * res,
+            np.ceil(xmax / res) * res, np.ceil(ymax / res) * res)
+
+# Read Landsat age year .tif files over extentPoly (any crs) into an array,
+# on a -tap 10m grid in the crs of the first inputFile (utm)
+# Without extentPoly, all of inputFiles is read (e.g. one tile)
+# Returns (array, geotransform, projection wkt, nodata value of inputs)
+def readAgeYear(inputFiles, extentPoly = None):
+    
+    # To use -te, convert to crs of first inputFile (utm)
+    outputBounds = None
+    if extentPoly is not None:
+        outputBounds = getAlignedBounds(extentPoly, Raster(inputFiles[0]).epsg())
+    
+    # sometimes UTM proj might not be same for all Landsat tiles
+    # Empty path makes .vrt in memory only
+    options = gdal.BuildVRTOptions(outputBounds = outputBounds,
+                                   xRes = AGE_RESOLUTION, yRes = AGE_RESOLUTION,
+                                   targetAlignedPixels = True,
+                                   allowProjectionDifference = True)
+    
+    vrt = gdal.BuildVRT('', inputFiles, options = options)
+    
+    band = vrt.GetRasterBand(1)
+    ageArr = band.ReadAsArray()
+    
+    return (ageArr, vrt.GetGeoTransform(), vrt.GetProjection(), 
+                                                         band.GetNoDataValue())
+
+# Mask age year array like the old gdal_calc.py step:
+#  255*(A==0) + 255*(A==50) + A*((A>0) & (A<50)), as Byte with nodata 255
+#  Input nodata also becomes nodata (gdal_calc does the same)
+def maskAgeYear(ageArr, srcNoData = None):
+    
+    outArr = np.where((ageArr > 0) & (ageArr < 50), ageArr, 0).astype(np.uint8)
+    
+    noData = (ageArr == 0) | (ageArr == 50)
+    if srcNoData is not None:
+        noData |= (ageArr == srcNoData)
         
-    # 3. Convert disturbances .tif into .shps
+    outArr[noData] = AGE_NODATA
+    
+    return outArr
+
+# Put an array into a single band GDAL dataset (MEM by default) with 
+# AGE_NODATA as the nodata value (Byte). outFile is needed for other drivers
+def arrayToDataset(arr, geotransform, projection, driver = 'MEM', 
+                                   outFile = '', dataType = gdal.GDT_Byte,
+                                                        noData = AGE_NODATA):
+    
+    (nRows, nColumns) = arr.shape
     
-    outLyr = os.path.basename(outShp).replace('.shp', '')
+    ds = gdal.GetDriverByName(driver).Create(outFile, nColumns, nRows, 1, 
+                                                                     dataType)
+    ds.SetGeoTransform(geotransform)
+    ds.SetProjection(projection)
     
-    if not os.path.isfile(outShp): # likely not needed, if this did anything we'd be having bigger probs
-        cmd = 'gdal_polygonize.py -q {} {} {} {}'.format(outCalc, outShp, outLyr, ageYearCol)
+    band = ds.GetRasterBand(1)
+    band.SetNoDataValue(noData)
+    band.WriteArray(arr)
+    band.FlushCache()
+    
+    return ds
 
-        print("\n\tCreating {}".format(outShp))
-        print("\t{}".format(cmd))
-        os.system(cmd)
+# Polygonize masked age year array (like gdal_polygonize.py, 4-connected, 
+# nodata pixels skipped) into an in-memory layer and return gdf of patches 
+# with an AGE_YEAR_FIELD column (or fieldName for other arrays, e.g. labels)
+def polygonizeArray(arr, geotransform, projection, fieldName = AGE_YEAR_FIELD,
+                        dataType = gdal.GDT_Byte, noData = AGE_NODATA):
+    
+    ds = arrayToDataset(arr, geotransform, projection, dataType = dataType, 
+                                                              noData = noData)
+    band = ds.GetRasterBand(1)
+    
+    srs = osr.SpatialReference(wkt = projection)
+    
+    outDs = ogr.GetDriverByName('Memory').CreateDataSource('')
+    layer = outDs.CreateLayer('patches', srs = srs, geom_type = ogr.wkbPolygon)
+    layer.CreateField(ogr.FieldDefn(fieldName, ogr.OFTInteger))
+    
+    gdal.Polygonize(band, band.GetMaskBand(), layer, 0, [], callback = None)
+    
+    wkbs, ageYears = [], []
+    for feature in layer:
+        wkbs.append(bytes(feature.GetGeometryRef().ExportToWkb()))
+        ageYears.append(feature.GetField(0))
+        
+    geoms = shapely.from_wkb(np.array(wkbs, dtype = object))
+    
+    return gpd.GeoDataFrame({fieldName: np.array(ageYears, dtype = int)},
+                            geometry = geoms, crs = srs.ExportToWkt())
+
+# Flag patches that touch the edge of an array with geotransform/shape in
+# SEAM_FIELD, i.e. patches that may continue in the next tile
+def flagSeams(patches, geotransform, shape):
+    
+    (nRows, nColumns) = shape
+    (ulx, xres, xskew, uly, yskew, yres) = geotransform
+    tol = AGE_RESOLUTION / 2.0
+    
+    bounds = patches.geometry.bounds
+    patches[SEAM_FIELD] = ((bounds['minx'] < ulx + tol) | 
+                           (bounds['maxx'] > ulx + nColumns * xres - tol) |
+                           (bounds['maxy'] > uly - tol) |
+                           (bounds['miny'] < uly + nRows * yres + tol)).values
+    
+    return patches
+
+# Polygonize array (one tile) and flag its seam patches
+def polygonizeWithSeams(arr, geotransform, projection):
+    
+    patches = polygonizeArray(arr, geotransform, projection)
+    
+    return flagSeams(patches, geotransform, arr.shape)
+
+# Polygonize masked age year array in tileSize x tileSize tiles on workers
+# processes, then merge patches split at tile seams. Same patches as
+# polygonizeArray on the whole array, which is used if workers is 1 or the
+# array is a single tile
+def polygonizeTiled(arr, geotransform, projection, workers = 1, 
+                                           tileSize = POLYGONIZE_TILE_SIZE):
+    
+    (nRows, nColumns) = arr.shape
+    
+    if workers <= 1 or (nRows <= tileSize and nColumns <= tileSize):
+        return polygonizeArray(arr, geotransform, projection)
+    
+    (ulx, xres, xskew, uly, yskew, yres) = geotransform
+    
+    windows = [(r, c) for r in range(0, nRows, tileSize) 
+                                      for c in range(0, nColumns, tileSize)]
+    
+    print("\n\tPolygonizing {} tiles on {} workers".format(len(windows), 
+                                                                     workers))
+    
+    with ProcessPoolExecutor(max_workers = workers) as executor:
+        futures = [executor.submit(polygonizeWithSeams, 
+                                   arr[r:r + tileSize, c:c + tileSize],
+                                   (ulx + c * xres + r * xskew, xres, xskew,
+                                    uly + c * yskew + r * yres, yskew, yres),
+                                   projection) for (r, c) in windows]
+        parts = [future.result().assign(tile = t) 
+                                         for t, future in enumerate(futures)]
+        
+    patches = mergeSeamPatches(pd.concat(parts, ignore_index = True))
+    
+    return patches[[AGE_YEAR_FIELD, 'geometry']].reset_index(drop = True)
+
+# Path of a Landsat tile's patches in the patch store
+def getStorePath(inputFile, storeDir):
+    
+    return os.path.join(storeDir, 
+             os.path.basename(inputFile).replace('.tif', '.parquet'))
+
+# Path of a Landsat tile's footprint, given the path of its patches
+def getFootprintPath(storePath):
+    
+    return storePath.replace('.parquet', '_footprint.parquet')
+
+# True if a tile's patches and footprint are both in the store
+def isStored(storePath):
+    
+    return os.path.isfile(storePath) and \
+                                   os.path.isfile(getFootprintPath(storePath))
+
+# Mask/polygonize one whole Landsat tile on its own 10m -tap grid. Returns gdf
+# of patches (tile crs) with AGE_YEAR_FIELD and SEAM_FIELD (True if patch 
+# touches the edge of the Landsat tile)
+def polygonizeTile(inputFile, workers = 1):
+    
+    (ageArr, geotransform, projection, srcNoData) = readAgeYear([inputFile])
+    ageArr = maskAgeYear(ageArr, srcNoData)
+    
+    if workers > 1:
+        patches = polygonizeTiled(ageArr, geotransform, projection, workers)
+        return flagSeams(patches, geotransform, ageArr.shape)
+    
+    return polygonizeWithSeams(ageArr, geotransform, projection)
+
+# Footprint (polygon, tile crs) of one Landsat tile on its own 10m -tap grid:
+# the pixels the tile has data for in a .vrt. The alpha band of gdalbuildvrt
+# -addalpha is 0 outside the tile and where the tile is nodata, which is 
+# where a .vrt mosaic shows the tiles under it instead
+def tileFootprint(inputFile):
+    
+    options = gdal.BuildVRTOptions(xRes = AGE_RESOLUTION, yRes = AGE_RESOLUTION,
+                                   targetAlignedPixels = True, addAlpha = True)
+    
+    vrt = gdal.BuildVRT('', [inputFile], options = options)
+    
+    alpha = vrt.GetRasterBand(vrt.RasterCount).ReadAsArray()
+    
+    covered = polygonizeArray((alpha > 0).astype(np.uint8), 
+                              vrt.GetGeoTransform(), vrt.GetProjection(),
+                              fieldName = 'covered', noData = 0)
+    
+    return shapely.union_all(np.asarray(covered.geometry))
+
+# Polygonize a Landsat tile into the patch store, with its footprint. Written 
+# to temp files and renamed so other stacks never read a partial file. The
+# footprint is written first, the patch file is what marks a tile as stored
+def writeStoreTile(inputFile, storePath, workers = 1):
+    
+    patches = polygonizeTile(inputFile, workers)
+    footprint = gpd.GeoDataFrame(geometry = [tileFootprint(inputFile)],
+                                                           crs = patches.crs)
+    
+    os.makedirs(os.path.dirname(storePath), exist_ok = True)
+    
+    for (gdf, outPath) in [(footprint, getFootprintPath(storePath)), 
+                           (patches, storePath)]:
+        tmpPath = '{}.{}.tmp'.format(outPath, os.getpid())
+        gdf.to_parquet(tmpPath, index = False)
+        os.replace(tmpPath, outPath)
     
+    return len(patches.index)
+
+# Read a Landsat tile's patches and footprint from the patch store, 
+# polygonizing the tile into the store first if it is not there yet (or was
+# stored without a footprint). Returns (patches gdf, footprint polygon)
+def readStoreTile(inputFile, storeDir, workers = 1):
+    
+    storePath = getStorePath(inputFile, storeDir)
+    
+    if not isStored(storePath):
+        print("\n\tAdding {} to patch store".format(os.path.basename(inputFile)))
+        writeStoreTile(inputFile, storePath, workers)
+        
+    footprint = gpd.read_parquet(getFootprintPath(storePath)).geometry.iloc[0]
+    
+    return (gpd.read_parquet(storePath), footprint)
+
+# Cut patches of one tile to footprint (the part of the tile the mosaic has
+# its pixels for). Patches inside it are kept as they are. Patches cut by its
+# edge may fall apart into several pieces, and are flagged in SEAM_FIELD as
+# they may continue in another tile
+def clipToFootprint(patches, footprint):
+    
+    geoms = np.asarray(patches.geometry)
+    
+    shapely.prepare(footprint)
+    inside = shapely.contains_properly(footprint, geoms)
+    
+    if inside.all():
+        return patches
+    
+    # Cutting can leave collinear vertices on the footprint edge, drop them
+    # like mergeSeamPatches does
+    cut = patches[~inside].copy()
+    cut['geometry'] = shapely.simplify(shapely.intersection(geoms[~inside], 
+                                                                 footprint), 0)
+    cut = cut.explode(index_parts = False)
+    cut = cut[cut.geom_type == 'Polygon']
+    cut[SEAM_FIELD] = True
+    
+    return pd.concat([patches[inside], cut], ignore_index = True)
+
+# Get disturbance patches within extent from the patch store (see top)
+# Returns None if inputFiles are not all in the same projection
+def getStorePatches(inputFiles, extentPoly, storeDir, workers = 1):
+    
+    epsgs = set([Raster(inputFile).epsg() for inputFile in inputFiles])
+    if len(epsgs) > 1:
+        print("\n\tLandsat tiles are in {} projections, not using patch store".format(len(epsgs)))
+        return None
+    
+    clipBounds = getAlignedBounds(extentPoly, epsgs.pop())
+    clipBox = box(*clipBounds)
+    
+    tiles = [readStoreTile(inputFile, storeDir, workers) 
+                                                   for inputFile in inputFiles]
+    
+    # Where tiles overlap the .vrt mosaic has the pixels of the last one, so
+    # going from the last tile back, each tile only keeps what is left of its
+    # footprint. Patches of the tile there are selected with its spatial index
+    parts = []
+    covered = shapely.Polygon()
+    for t in reversed(range(len(tiles))):
+        
+        (tilePatches, footprint) = tiles[t]
+        
+        owned = shapely.difference(shapely.intersection(footprint, clipBox), 
+                                                                      covered)
+        covered = shapely.union(covered, footprint)
+        
+        tilePatches = tilePatches.iloc[tilePatches.sindex.query(owned, 
+                                                       predicate = 'intersects')]
+        
+        parts.insert(0, clipToFootprint(tilePatches, owned).assign(tile = t))
+        
+    patches = mergeSeamPatches(pd.concat(parts, ignore_index = True))
+    
+    # Cut at the stack extent, like polygonizing the stack array. A patch can
+    # fall apart into several pieces there (or just touch the edge)
+    patches['geometry'] = shapely.clip_by_rect(np.asarray(patches.geometry), 
+                                                                  *clipBounds)
+    patches = patches.explode(index_parts = False)
+    patches = patches[patches.geom_type == 'Polygon']
+    
+    return patches[[AGE_YEAR_FIELD, 'geometry']].reset_index(drop = True)
+
+# Merge patches split at tile seams: seam patches from different tiles with 
+# the same ageYear that share an edge (touching at a corner only is not 
+# connected, same as 4-connected polygonize) are unioned into one patch
+# Union leaves vertices where the seams crossed the patch outline, these are
+# collinear and dropped (simplify with 0 tolerance) so merged patches have
+# the same vertices as polygonizing without seams
+def mergeSeamPatches(patches):
+    
+    seam = np.flatnonzero(patches[SEAM_FIELD].values)
+    if len(seam) == 0:
+        return patches
+    
+    geoms = np.asarray(patches.geometry)[seam]
+    ageYears = patches[AGE_YEAR_FIELD].values[seam]
+    tiles = patches['tile'].values[seam]
+    
+    (left, right) = shapely.STRtree(geoms).query(geoms, predicate = 'touches')
+    
+    keep = (left < right) & (ageYears[left] == ageYears[right]) & \
+                                               (tiles[left] != tiles[right])
+    (left, right) = (left[keep], right[keep])
+    
+    shared = shapely.length(shapely.intersection(geoms[left], 
+                                                          geoms[right])) > 0
+    (left, right) = (left[shared], right[shared])
+    
+    if len(left) == 0:
+        return patches
+    
+    # Groups of connected seam patches (chains across several tiles too)
+    graph = coo_matrix((np.ones(len(left)), (left, right)), 
+                                              shape = (len(seam), len(seam)))
+    (nGroups, groups) = connected_components(graph, directed = False)
+    
+    sizes = np.bincount(groups)
+    members = np.flatnonzero(sizes[groups] > 1)
+    members = members[np.argsort(groups[members], kind = 'stable')]
+    memberGroups = np.split(members, 
+                            np.flatnonzero(np.diff(groups[members])) + 1)
+    
+    merged = gpd.GeoDataFrame({AGE_YEAR_FIELD: [ageYears[m[0]] for m in memberGroups],
+                               SEAM_FIELD: True, 'tile': -1},
+                              geometry = [shapely.simplify(shapely.union_all(geoms[m]), 0)
+                                                      for m in memberGroups],
+                              crs = patches.crs)
+    
+    return pd.concat([patches.drop(patches.index[seam[members]]), merged], 
+                                                          ignore_index = True)
+
+# Simplify patch outlines (pixel stair steps) with a tolerance of tolerance
+# pixels. Done as a coverage (topology preserving across patches, no gaps or
+# overlaps between neighbours). Prints vertex reduction and area change
+def simplifyPatches(patches, tolerance, resolution = AGE_RESOLUTION):
+    
+    geoms = np.asarray(patches.geometry)
+    
+    if HAS_COVERAGE_SIMPLIFY:
+        simple = shapely.coverage_simplify(geoms, tolerance * resolution)
     else:
-        print("\n\t{} already exists".format(outShp))  
+        simple = shapely.simplify(geoms, tolerance * resolution, 
+                                                    preserve_topology = True)
+        
+    nBefore = shapely.get_num_coordinates(geoms).sum()
+    nAfter = shapely.get_num_coordinates(simple).sum()
     
+    areaBefore = shapely.area(geoms)
+    areaChange = shapely.area(simple) - areaBefore
     
-    # Read .shp into gdf
-    return gpd.read_file(outShp)
+    print("\n\tSimplified {} patches ({} pixel tolerance): {} --> {} vertices ({}% fewer)".format(
+                len(geoms), tolerance, nBefore, nAfter, 
+                round(100.0 * (nBefore - nAfter) / max(nBefore, 1), 1)))
+    print("\tArea change: {}% total, {}% largest for one patch".format(
+                round(100.0 * areaChange.sum() / max(areaBefore.sum(), 1), 3),
+                round(100.0 * np.max(np.abs(areaChange) / areaBefore, 
+                                                       initial = 0), 1)))
+    
+    patches = patches.copy()
+    patches[patches.geometry.name] = gpd.GeoSeries(simple, 
+                                      index = patches.index, crs = patches.crs)
+    
+    return patches
 
+# Given an extent/epsg build a geodataframe of disturbance patches from a 
+# label image instead of polygons, for RasterStats.LabelStats
+# Returns (gdf, labelDs): gdf has one row per label, in label order (row i 
+# is label i+1), with ageYear/lon/lat/patchSize_m2 columns. Geometry is the 
+# patch polygon if withGeometry, otherwise empty. labelDs is the label image
+# (MEM Int32 dataset, 0 = not a patch). (None, None) if there are no patches
+# simplify: tolerance (in pixels) to simplify patch polygons with, or None
+def buildLabelZdf(rasterExtent, rasterEpsg, tmpDir, region = 'na', 
+                                     withGeometry = True, simplify = None):
+    
+    start = time.time()
+    
+    indexShp = os.path.join(indexShpDir, 'Landsat_ageYear_{}.shp'.format(region))
+    
+    extentPoly = getExtentGdf(rasterExtent, rasterEpsg)
+    
+    inputFiles = getZonalIndexList(indexShp, extentPoly)
+    if len(inputFiles) == 0:
+        print("\nThere were no Landsat files from {} within stack.".format(indexShp))
+        return (None, None)
+    
+    print("Building label image with {} inputs from {}".format(len(inputFiles), 
+                                                                      indexShp))
+    
+    (ageArr, geotransform, projection, srcNoData) = \
+                                          readAgeYear(inputFiles, extentPoly)
+    ageArr = maskAgeYear(ageArr, srcNoData)
+    
+    (labels, ageYears) = labelPatches(ageArr)
+    del ageArr
+    
+    if len(ageYears) == 0:
+        print("\nThere were no disturbance patches within stack. Exiting")
+        return (None, None)
+    
+    zdf = patchTable(labels, ageYears, geotransform, projection)
+    
+    if withGeometry:
+        patches = polygonizeArray(labels, geotransform, projection, 
+                       fieldName = LABEL_FIELD, dataType = gdal.GDT_Int32,
+                                                                 noData = 0)
+        patches = patches.dissolve(by = LABEL_FIELD)
+        zdf = zdf.set_geometry(patches.geometry.reindex(zdf.index).values,
+                                                          crs = zdf.crs)
+        
+        # Only the output polygons change, lon/lat/area are from the labels
+        if simplify:
+            zdf = simplifyPatches(zdf, simplify)
+    
+    labelDs = arrayToDataset(labels, geotransform, projection, 
+                                    dataType = gdal.GDT_Int32, noData = 0)
+    
+    print(" Created label image with {} patches for stack".format(len(zdf.index)))
+    print(" Elapsed time: {}\n".format(calculateElapsedTime(start, time.time())))
+    
+    return (zdf, labelDs)
+
+# Label connected patches in masked age year array: 4-connected pixels with
+# the same age year, same patches as polygonizeArray
+# Returns (labels, ageYears): Int32 label image (0 = nodata) and array with
+# the age year of each label (ageYears[i] is label i+1)
+def labelPatches(ageArr):
+    
+    labels = np.zeros(ageArr.shape, dtype = np.int32)
+    ageYears = [np.zeros(0, dtype = int)]
+    nLabels = 0
+    
+    for ageYear in np.unique(ageArr[ageArr != AGE_NODATA]):
+        
+        # Default structure is 4-connected
+        valueLabels, n = ndimage.label(ageArr == ageYear)
+        
+        inValue = valueLabels > 0
+        labels[inValue] = valueLabels[inValue] + nLabels
+        
+        ageYears.append(np.full(n, ageYear, dtype = int))
+        nLabels += n
+        
+    return labels, np.concatenate(ageYears)
+
+# Patch attributes from label image: ageYear, lon/lat of centroid, and area
+# (patchSize_m2), same as the polygon centroid/area of the patch. Returns 
+# gdf with one row per label (index = label) and empty geometry 
+def patchTable(labels, ageYears, geotransform, projection):
+    
+    nLabels = len(ageYears)
+    
+    (rows, cols) = np.nonzero(labels)
+    patchLabels = labels[rows, cols]
+    
+    counts = np.bincount(patchLabels, minlength = nLabels + 1)[1:]
+    
+    # Centroid of a patch is the mean of its pixel centers
+    rowMean = np.bincount(patchLabels, weights = rows + 0.5, 
+                                        minlength = nLabels + 1)[1:] / counts
+    colMean = np.bincount(patchLabels, weights = cols + 0.5, 
+                                        minlength = nLabels + 1)[1:] / counts
+    
+    (ulx, xres, xskew, uly, yskew, yres) = geotransform
+    x = ulx + colMean * xres + rowMean * xskew
+    y = uly + colMean * yskew + rowMean * yres
+    
+    toLatLon = getTransformer(projection, 4326)
+    lon, lat = toLatLon.transform(x, y)
+    
+    zdf = gpd.GeoDataFrame({AGE_YEAR_FIELD: ageYears, 'lon': lon, 'lat': lat,
+                'patchSize_m2': (counts * abs(xres * yres)).astype(int)},
+                           index = np.arange(1, nLabels + 1),
+                           geometry = gpd.GeoSeries([None] * nLabels, 
+                                        index = np.arange(1, nLabels + 1)),
+                           crs = osr.SpatialReference(wkt = projection).ExportToWkt())
+    
+    return zdf
 
 # Given an .csv file with lat/lon fields (EPSG 4326), and an extent or extent 
 # polygon/gdf (optional), return a geodataframe with points as geometry
@@ -207,17 +750,15 @@ def csvToGdf(csv, lonField = 'lon', latField = 'lat', bbox = None,
     # Pre-filter to speed things up
     # If bbox is supplied, go ahead and filter geographically on tabular data 
     
-    # 1/6/23: This will not really work if stack crosses antimeridian/aka is multipolygon
-    if bbox is not None:# and bbox.type[0] == 'Polygon':
+    if bbox is not None:
         
         # First, project coords to match .csv, if need be
         if bbox.crs.to_epsg() != srcEpsg:
             bbox = bbox.to_crs(epsg = srcEpsg)
             
-        # Get bbox extent and pre-filter df
-        (xmin, ymin, xmax, ymax) = bbox.total_bounds
-        df = df.loc[(df[lonField] >= xmin) & (df[lonField] <= xmax) & 
-                    (df[latField] >= ymin) & (df[latField] <= ymax)]
+        # Pre-filter df to bbox extent (each part if split at antimeridian)
+        df = df.loc[inBoundsMask(df[lonField], df[latField], 
+                                                         getBoundsList(bbox))]
 
 
     # This might be empty, just return None
@@ -225,6 +766,17 @@ def csvToGdf(csv, lonField = 'lon', latField = 'lat', bbox = None,
         #print("{} empty after pre-filtering".format(csv))
         return None 
     
+    # If bbox is supplied, filter again with point-in-polygon test to remove
+    # rows outside extent that didn't get removed earlier
+    if bbox is not None:
+        mask = pointsInExtentMask(df[lonField], df[latField], bbox)
+        if not mask.all():
+            df = df.loc[mask]
+        
+    if df.empty:
+        #print("{} empty after filtering".format(csv))
+        return None 
+    
     geometry = gpd.points_from_xy(np.asarray(df[lonField]), 
                     np.asarray(df[latField]))
     #print(geometry)
@@ -237,15 +789,6 @@ def csvToGdf(csv, lonField = 'lon', latField = 'lat', bbox = None,
             gpd.points_from_xy(np.asarray(df[lonField]), 
                     np.asarray(df[latField])), crs = 'EPSG:{}'.format(srcEpsg))
     """    
-    
-    # If bbox is supplied, filter again via geopandas to remove rows outside
-    # extent that didn't get removed earlier
-    if bbox is not None:
-        gdf = gpd.overlay(gdf, bbox, how='intersection')
-        
-    if gdf.empty:
-        #print("{} empty after filtering".format(csv))
-        return None      
 
     return gdf
 
@@ -269,26 +812,12 @@ def getExtentGdf(extent, srcEpsg, dstEpsg = 4326):
     if extentGdf.crs.to_epsg() != dstEpsg:
         extentGdf = extentGdf.to_crs(epsg = dstEpsg)
         
-    """    
     # 1/6/23: Sometimes a .vrt will cross the antimeridian. If so, need to
     #         make a multipolygon so script won't try to get all icesat shots 
     #         across the boreal. This only works if dstEpsg = 4326 (lat/lon)
-    #    Turns out this doesn't really help when passing this to gpd functions
-    if abs(float(extentGdf.bounds.maxx) - float(extentGdf.bounds.minx)) > 180:
-        return extentGdf
-        import pdb; pdb.set_trace()
-        print("\nStack crosses anti-meridian. Splitting into multipolygon\n")
-        # get polygon portion in Western hemisphere
-        poly1 = box(-180, float(extentGdf.bounds.miny), 
-                    float(extentGdf.bounds.minx), float(extentGdf.bounds.maxy))      
-        # get polygon portion in Eastern hemisphere
-        poly2 = box(float(extentGdf.bounds.maxx), float(extentGdf.bounds.miny), 
-                    180, float(extentGdf.bounds.maxy))
-        
-        multipoly = MultiPolygon([poly1, poly2])
-        extentGdf = gpd.GeoDataFrame({'geometry': [multipoly]},  
-                                             crs='EPSG:{}'.format(dstEpsg))
-    """
+    #         Index/.csv filters then query each part (getBoundsList)
+    if dstEpsg == 4326:
+        extentGdf = splitAntimeridian(extentGdf)
         
     return extentGdf
     
@@ -297,8 +826,10 @@ def getExtentGdf(extent, srcEpsg, dstEpsg = 4326):
 # indexShp is in same proj so just keep it like this/hardcoded for now
 def getZonalIndexList(indexShp, extentPolyGdf):
     
-    # Read index .shp into gdf, using bbox which means no need to intersect
-    indexGdf = gpd.read_file(indexShp, bbox=extentPolyGdf)
+    # Index .shp is read once per process (cached), then queried with its
+    # spatial index. One query per side of antimeridian if extent crosses it
+    indexGdf = queryIndex(indexShp, extentPolyGdf)
+    indexGdf = indexGdf.drop_duplicates(subset = 'location')
 
     # filename is just in location field
     return indexGdf['location'].tolist()
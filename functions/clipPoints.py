@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""
+
+Clip point zones to a stack extent (polygon/multipolygon gdf)
+
+Replaces gpd.overlay(points, extent, how='intersection') for points. Overlay
+ is a general polygon overlay that rebuilds the frame; for points all we need
+ is a point-in-polygon test. The extent is prepared once and tested against
+ all x/y coords at once, and the result is a boolean mask so the original
+ columns and index are kept
+
+Points on the extent boundary are kept, same as overlay intersection
+"""
+import numpy as np
+
+import shapely
+
+# Given x/y coord arrays and an extent gdf in the same crs as the coords,
+# return boolean mask of coords that fall within (or on) the extent
+def pointsInExtentMask(x, y, extentGdf):
+
+    extent = extentGdf.geometry.union_all()
+    shapely.prepare(extent)
+
+    return shapely.intersects_xy(extent, np.asarray(x, dtype = float),
+                                         np.asarray(y, dtype = float))
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 """
-pointsToSegments(gdf, segWidth=11, segLength=100, returnSrcPrj = True):
+pointsToSegments(gdf, segWidth=11, segLength=100, returnSrcPrj = True, 
+                                                              dstEpsg = None):
   Given a pandas geodataframe with ATL08 point geometry, return 
    a geodataframe with polygons representing the ATL08 segments
   
@@ -9,6 +10,10 @@ pointsToSegments(gdf, segWidth=11, segLength=100, returnSrcPrj = True):
    
   returnSrcPrj: default is to return the dataframe in the native projection,
    set False to return the geodataframe in local UTM projection
+   
+  dstEpsg: if supplied and projected (e.g. the raster EPSG), segments are
+   built in dstEpsg (only the points are transformed) and returned in it.
+   Local UTM is only used when dstEpsg is geographic/not supplied
 
 * Couple notes:
 * Input has to have more than one icesat shot (from the same track), otherwise 
@@ -17,11 +22,43 @@ pointsToSegments(gdf, segWidth=11, segLength=100, returnSrcPrj = True):
 * Also note that as of now this should only be used for a group of ATL08 shots
    that are within/near the same UTM zone. Functions rely on UTM/meter 
    projection for calculations
+
+* Headings, corners and polygons are computed for all shots at once with
+   array operations (calculategrounddirection, calculatecornersarray, 
+   getPolyGeoms). getPolyGeom/calculatecorners still work for one shot
+
+addSegmentFootprints(df, ...):
+  Used at ingest (scripts/create_atl08_v005_parquet_store.py and 
+   create_atl08_v005_tile_store.py). Computes heading and rectangle corners
+   (lon/lat) once per track/beam (in along-track order) and adds them as
+   columns. footprintsToSegments(gdf) then builds the polygons straight
+   from those columns, for any stack the shot falls on
 """
 
 import os
 
 import numpy as np
+import pandas as pd
+import shapely
+import geopandas as gpd
+
+from pyproj import CRS
+
+from functions.processCache import getTransformer
+
+# Segment footprint columns added by addSegmentFootprints(). Corners are in
+# lon/lat (EPSG:4326), ordered ul, ur, lr, ll. Heading is in local UTM degrees
+HEADING_FIELD = 'seg_heading'
+FOOTPRINT_X_FIELDS = ['seg_x1', 'seg_x2', 'seg_x3', 'seg_x4']
+FOOTPRINT_Y_FIELDS = ['seg_y1', 'seg_y2', 'seg_y3', 'seg_y4']
+FOOTPRINT_FIELDS = [HEADING_FIELD] + FOOTPRINT_X_FIELDS + FOOTPRINT_Y_FIELDS
+
+# Field with ground track/beam, shots are grouped by it within a granule
+TRACK_FIELD = 'gt'
+
+# Field with the source granule name, for shots from more than one granule
+# (tile store, or granules concatenated for a stack)
+GRANULE_FIELD = 'granule'
 #import pandas as pd
 
 #from osgeo import ogr, osr
@@ -36,31 +73,56 @@ import numpy as np
 # new funcs for using geodataframe
 
 # Convert point gdf to gdf with IS2 segment polygons
-def pointsToSegments(gdf, segWidth = 11, segLength = 100, returnSrcPrj = True):
+def pointsToSegments(gdf, segWidth = 11, segLength = 100, returnSrcPrj = True,
+                                                               dstEpsg = None):
     
     # calculategrounddirection() fails if there is only one footprint in df
     if len(gdf.index) <= 1:
         raise RuntimeError("\n Input df {} has fewer than two rows. Exiting")
         return None
     
-    # Convert gdf to UTM, but first store native proj
+    # Store native proj
     if returnSrcPrj: 
         srcEpsg = gdf.crs.to_epsg()
-    gdf = gdfToUtm(gdf)
+        
+    # If dstEpsg is in meters, build segments there. Only the centroid coords 
+    # are transformed (one vectorized transform), not the gdf
+    if isProjectedEpsg(dstEpsg):
+        segCrs = 'EPSG:{}'.format(int(dstEpsg))
+        toDst = getTransformer(gdf.crs, segCrs)
+        xx, yy = toDst.transform(np.asarray(gdf.geometry.x), 
+                                 np.asarray(gdf.geometry.y))
+        
+        # Segments are returned in dstEpsg instead
+        returnSrcPrj = False
+        
+    # Otherwise convert gdf to UTM
+    else:
+        gdf = gdfToUtm(gdf)
+        segCrs = gdf.crs
+        xx = np.asarray(gdf.geometry.x)
+        yy = np.asarray(gdf.geometry.y)
     
-    # Now with UTM, we can use Eric Guenther's code to do calculations...
+    # Now with meters, we can use Eric Guenther's code to do calculations...
 
     # test write input to shp
     #gdf.to_file('test/point-test.shp')  
 
-    # Generate list of degrees - need lists for this function   
-    xx = np.asarray(gdf.geometry.x)
-    yy = np.asarray(gdf.geometry.y)
-    dd = calculategrounddirection(xx,yy)
+    # Generate list of degrees, per granule/track so a shot's heading never
+    # comes from the shots of another track next to it in the gdf
+    dd = groupedGroundDirection(gdf, xx, yy)
+    
+    # Shots alone on their track have no heading
+    valid = ~np.isnan(dd)
+    if not valid.all():
+        print(" Removing {} shots without a neighbour on their track".format(
+                                                             (~valid).sum()))
+        gdf = gdf.loc[valid]
+        (dd, xx, yy) = (dd[valid], np.asarray(xx)[valid], np.asarray(yy)[valid])
 
     # Make polygons from calcs and store in new column in gdf
-    gdf['polyGeom'] = list(map(lambda d, x, y: \
-                        getPolyGeom(d, x, y, segWidth, segLength), dd, xx, yy))
+    gdf['polyGeom'] = gpd.GeoSeries(getPolyGeoms(dd, xx, yy, segWidth, 
+                                    segLength), index = gdf.index, crs = segCrs)
 
     # try to speed things up?
     """
@@ -92,6 +154,158 @@ def pointsToSegments(gdf, segWidth = 11, segLength = 100, returnSrcPrj = True):
     
     return gdf
     
+# Ground direction of every shot in gdf (xx/yy in meters, in gdf order),
+# calculated separately for the shots of each granule/track (GRANULE_FIELD/
+# TRACK_FIELD, whichever gdf has) in the order they are in the gdf. Shots
+# alone on their granule/track get NaN
+def groupedGroundDirection(gdf, xx, yy):
+    
+    xx = np.asarray(xx, dtype = float)
+    yy = np.asarray(yy, dtype = float)
+    
+    keys = [f for f in [GRANULE_FIELD, TRACK_FIELD] if f in gdf.columns]
+    if not keys:
+        return calculategrounddirection(xx, yy)
+    
+    dd = np.full(len(xx), np.nan)
+    
+    for track in gdf.groupby(keys, sort = False, 
+                                          observed = True).indices.values():
+        if len(track) > 1:
+            dd[track] = calculategrounddirection(xx[track], yy[track])
+            
+    return dd
+
+# Add segment heading/footprint columns to a granule dataframe (not gdf) of
+# ATL08 shots in along-track order. Headings are calculated per track/beam
+# (trackField) in a UTM zone for each track, and corners are converted back
+# to lon/lat. Tracks with only one shot get NaN (see footprintsToSegments)
+def addSegmentFootprints(df, lonField = 'lon_20m', latField = 'lat_20m', 
+                        segWidth = 11, segLength = 20, trackField = TRACK_FIELD):
+    
+    nShots = len(df.index)
+    
+    heading = np.full(nShots, np.nan)
+    cornersX = np.full((nShots, 4), np.nan)
+    cornersY = np.full((nShots, 4), np.nan)
+    
+    # Positions of shots for each track, in granule order
+    if trackField in df.columns:
+        tracks = df.groupby(trackField, sort = False, 
+                                          observed = True).indices.values()
+    else:
+        tracks = [np.arange(nShots)]
+        
+    lon = np.asarray(df[lonField], dtype = float)
+    lat = np.asarray(df[latField], dtype = float)
+    
+    # Skip no data lat/lon shots (see buildZdf_atl08v5.parseGranule)
+    valid = (np.abs(lon) <= 180) & (np.abs(lat) <= 90)
+        
+    for track in tracks:
+        
+        track = track[valid[track]]
+        
+        # calculategrounddirection() needs at least two shots
+        if len(track) <= 1:
+            continue
+        
+        utmEpsg = getUtmEpsgFromLonLat(np.median(lon[track]), 
+                                                       np.median(lat[track]))
+        toUtm = getTransformer(4326, utmEpsg)
+        
+        xx, yy = toUtm.transform(lon[track], lat[track])
+        
+        dd = calculategrounddirection(xx, yy)
+        corners = calculatecornersarray(dd, xx, yy, segWidth, segLength)
+        
+        x, y = toUtm.transform(corners[..., 0].ravel(), 
+                               corners[..., 1].ravel(), direction = 'INVERSE')
+        
+        heading[track] = dd
+        cornersX[track] = np.reshape(x, (-1, 4))
+        cornersY[track] = np.reshape(y, (-1, 4))
+        
+    df = df.copy()
+    df[HEADING_FIELD] = heading
+    for i in range(4):
+        df[FOOTPRINT_X_FIELDS[i]] = cornersX[:, i]
+        df[FOOTPRINT_Y_FIELDS[i]] = cornersY[:, i]
+        
+    return df
+
+# True if gdf has the footprint columns from addSegmentFootprints()
+def hasSegmentFootprints(gdf):
+    
+    return all(f in gdf.columns for f in FOOTPRINT_FIELDS)
+
+# Convert point gdf with footprint columns (see addSegmentFootprints) to gdf 
+# with IS2 segment polygons, in EPSG:4326 or dstEpsg if supplied (corners are 
+# transformed, all at once). Footprint columns are dropped. Shots without a
+# footprint (e.g. from .csv granules not in the store) are built from the
+# shots next to them on their granule/track with pointsToSegments instead
+def footprintsToSegments(gdf, dstEpsg = None, segLength = 20):
+    
+    coords = np.stack([gdf[FOOTPRINT_X_FIELDS].to_numpy(dtype = float),
+                       gdf[FOOTPRINT_Y_FIELDS].to_numpy(dtype = float)], 
+                                                                   axis = -1)
+    
+    valid = ~np.isnan(coords).any(axis = (1, 2))
+    
+    missingGdf = gdf.loc[~valid].drop(columns = FOOTPRINT_FIELDS)
+    gdf = gdf.loc[valid]
+    coords = coords[valid]
+        
+    df = gdf.drop(columns = FOOTPRINT_FIELDS + [gdf.geometry.name])
+    
+    segCrs = 'EPSG:4326'
+    if dstEpsg is not None and int(dstEpsg) != 4326:
+        segCrs = 'EPSG:{}'.format(int(dstEpsg))
+        toDst = getTransformer(4326, segCrs)
+        x, y = toDst.transform(coords[..., 0].ravel(), coords[..., 1].ravel())
+        coords = np.stack([x, y], axis = -1).reshape(coords.shape)
+    
+    segGdf = gpd.GeoDataFrame(df, geometry = gpd.GeoSeries(
+                      shapely.polygons(coords), index = df.index, crs = segCrs))
+    
+    if len(missingGdf.index) == 0:
+        return segGdf
+    
+    print(" Building segments for {} shots without stored footprint".format(
+                                                      len(missingGdf.index)))
+    
+    # pointsToSegments needs at least two shots
+    if len(missingGdf.index) == 1:
+        print(" Removing 1 shot without a neighbour on its track")
+        return segGdf
+    
+    missingGdf = pointsToSegments(missingGdf, segLength = segLength, 
+                                  returnSrcPrj = False, dstEpsg = dstEpsg)
+    missingGdf = missingGdf.rename_geometry(segGdf.geometry.name)
+    
+    if missingGdf.crs != segGdf.crs:
+        missingGdf = missingGdf.to_crs(segGdf.crs)
+    
+    return pd.concat([segGdf, missingGdf[segGdf.columns]])
+    
+# True if epsg is a projected (meter) CRS. False for geographic/None
+def isProjectedEpsg(epsg):
+    
+    if epsg is None:
+        return False
+    
+    return CRS.from_epsg(int(epsg)).is_projected
+    
+# WGS84 UTM zone EPSG for a lon/lat
+def getUtmEpsgFromLonLat(lon, lat):
+    
+    zone = int(np.floor((lon + 180) / 6) % 60) + 1
+    
+    if lat >= 0:
+        return 32600 + zone
+    
+    return 32700 + zone
+
 def gdfToUtm(gdf):
    
     # Be lazy and just get UTM zone that overlaps entire gdf the most for now
@@ -116,6 +330,12 @@ def getPolyGeom(deg, x, y, width=11, length=20):
     coords = calculatecorners(deg, x, y, width, length)
     
     return Polygon([Point(i,j) for i,j in coords])
+
+# Given arrays of meter coords and deg. of rotation, and length/width, return
+# array of Polygon objects (one per shot), built in bulk
+def getPolyGeoms(deg, x, y, width=11, length=20):
+    
+    return shapely.polygons(calculatecornersarray(deg, x, y, width, length))
     
 """
 scripts from code in paul's HRSI
@@ -148,17 +368,24 @@ def calculateangle(x1,x2,y1,y2):
     
     return degree
 
-# calculategrounddirection - Eric
+# calculategrounddirection - Eric, vectorized
+# Angle between the shots before and after each shot (first/last shot use
+# their one neighbour), same as calling calculateangle for each shot
 def calculategrounddirection(xx,yy):
-    degree = np.zeros(len(xx))
-    for i in range(0,len(xx)):
-        if i == 0:
-            degree[i] = calculateangle(xx[i], xx[i+1], yy[i], yy[i+1])
-        elif i == (len(xx))-1:
-            degree[i]  = calculateangle(xx[i-1], xx[i], yy[i-1], yy[i])
-        else:
-            degree[i]  = calculateangle(xx[i-1], xx[i+1], yy[i-1], yy[i+1])
-    return degree
+    xx = np.asarray(xx, dtype = float)
+    yy = np.asarray(yy, dtype = float)
+    
+    # Shifted arrays of previous (1) and next (2) shot for each shot
+    x1 = np.concatenate((xx[:1], xx[:-2], xx[-2:-1]))
+    y1 = np.concatenate((yy[:1], yy[:-2], yy[-2:-1]))
+    x2 = np.concatenate((xx[1:2], xx[2:], xx[-1:]))
+    y2 = np.concatenate((yy[1:2], yy[2:], yy[-1:]))
+    
+    dx = x2 - x1
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        slope = np.where(dx == 0, np.inf, (y2 - y1) / dx)
+        
+    return np.rad2deg(np.arctan(slope))
     
 # rotatepoint - Eric
 def rotatepoint(degree,xpos,ypos):
@@ -200,6 +427,26 @@ def calculatecorners(degree,xcenter,ycenter,width,height):
     #return xul, yul, xur, yur, xll, yll, xlr, ylr
     return [(xul, yul), (xur, yur), (xlr, ylr), (xll, yll)]
 
+# calculatecorners for arrays of shots: return (N, 4, 2) array of corners 
+# (ul, ur, lr, ll) for each shot, same as calculatecorners for each shot
+def calculatecornersarray(degree,xcenter,ycenter,width,height):
+    # Corner values before rotation (ul, ur, lr, ll)
+    corners = np.array([[-width / 2,  height / 2], [width / 2,  height / 2],
+                        [ width / 2, -height / 2], [-width / 2, -height / 2]])
+    
+    # Rotation matrix for each shot, (N, 2, 2), as in rotatepoint
+    angle = np.deg2rad(np.asarray(degree, dtype = float) - 90)
+    cos, sin = np.cos(angle), np.sin(angle)
+    rotation = np.stack([np.stack([cos, -sin], axis = -1),
+                         np.stack([sin,  cos], axis = -1)], axis = -2)
+    
+    # Rotate every corner of every shot, then add to centroid
+    coords = np.einsum('nij,kj->nki', rotation, corners)
+    coords += np.stack([np.asarray(xcenter, dtype = float),
+                        np.asarray(ycenter, dtype = float)], axis = -1)[:, None, :]
+    
+    return coords
+
    
 """
 # createshapefiles - from Eric, with minor additions MW
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+
+In-process caches that stay warm from one stack to the next when several
+ stacks are run in the same process (ZonalStats_3DSI.runBatch)
+
+- readIndex(): index .shp files (ATL08 footprints, Landsat age year) are read
+  in full once, with their spatial index, instead of once per stack. A file
+  is read again if it changes on disk
+- queryIndex(): rows of a cached index that intersect an extent (one query
+  per side of the antimeridian, like gpd.read_file(bbox=...) per bounds)
+- getTransformer(): pyproj Transformers are built once per crs pair
+
+Nothing here is shared between processes, each worker warms its own
+"""
+import os
+
+from functools import lru_cache
+
+import numpy as np
+import geopandas as gpd
+
+from pyproj import Transformer
+from shapely.geometry import box
+
+from functions.antimeridian import getBoundsList
+
+# Index .shp path --> (mtime, gdf)
+indexCache = {}
+
+# Read index .shp into gdf (cached in process). The spatial index is built
+# here so it is only built once too
+def readIndex(indexShp):
+
+    mtime = os.path.getmtime(indexShp)
+
+    if indexShp not in indexCache or indexCache[indexShp][0] != mtime:
+
+        indexGdf = gpd.read_file(indexShp)
+        indexGdf.sindex
+
+        indexCache[indexShp] = (mtime, indexGdf)
+
+    return indexCache[indexShp][1]
+
+# Given index .shp and extent gdf (any crs), return rows of the index that
+# intersect the extent bounds (each side of the antimeridian). Bounds are 
+# taken in lat/lon, a projected extent is reprojected first
+def queryIndex(indexShp, extentPolyGdf):
+
+    indexGdf = readIndex(indexShp)
+    
+    if not extentPolyGdf.crs.is_geographic:
+        extentPolyGdf = extentPolyGdf.to_crs(epsg = 4326)
+
+    boxes = gpd.GeoSeries([box(*bounds) for bounds in
+                           getBoundsList(extentPolyGdf)], crs = extentPolyGdf.crs)
+    if boxes.crs != indexGdf.crs:
+        boxes = boxes.to_crs(indexGdf.crs)
+
+    rows = [indexGdf.sindex.query(geom, predicate = 'intersects')
+                                                            for geom in boxes]
+
+    return indexGdf.iloc[np.unique(np.concatenate(rows).astype(int))]
+
+# pyproj Transformer from srcCrs to dstCrs (x/y order), cached in process
+# Crs can be anything pyproj takes that is hashable (epsg int, wkt, CRS)
+@lru_cache(maxsize = 64)
+def getTransformer(srcCrs, dstCrs):
+
+    return Transformer.from_crs(srcCrs, dstCrs, always_xy = True)
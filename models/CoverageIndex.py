@@ -0,0 +1,452 @@
+# -*- coding: utf-8 -*-
+"""
+CoverageIndex describes which raster pixels each zone covers
+
+For each zone (row of a geodataframe), the flattened pixel indices
+    (row * nColumns + col) it covers are stored CSR-style:
+
+    pixels[offsets[i]:offsets[i+1]] --> pixel indices for zone i
+
+Re-runs of a stack (e.g. for a new percentile) use the same zones, so the
+    index for all zones of a stack can be saved to one file and reused. The
+    file stores a hash of the zone geometries plus the raster grid signature
+    (geotransform, epsg, size) and is only reused on the exact same
+    grid/zones, otherwise it is rebuilt and overwritten (one file per stack)
+
+Zones that are all convex quadrilaterals (ATL08 segment rectangles from
+    pointsToSegments) skip rasterio: covered pixels are found directly for
+    all zones at once with a separating axis test of each candidate pixel in
+    the zone's window against the quad's edges (rasterizeQuads). This is the
+    all_touched rule - every pixel the zone overlaps - for north-up rasters.
+    GDAL's choice of pixels a slanted edge only touches at a corner depends
+    on the edge direction and the window, so zones with an edge through a
+    pixel corner are rasterized instead
+
+On-disk format (.npz):
+    version     - format version (COVERAGE_VERSION)
+    signature   - grid signature string, checked on load
+    zoneHash    - hash of zone geometries (+ allTouched), checked on load
+    shape       - (nRows, nColumns) of the grid
+    offsets     - int64, length nZones + 1
+    pixels      - flattened pixel indices, uint32 unless the grid has more
+                  than 2**32 pixels (then int64)
+"""
+import os
+import math
+import hashlib
+import tempfile
+
+import numpy as np
+import shapely
+
+from affine import Affine
+from rasterio import features
+
+COVERAGE_VERSION = 2
+
+# Zones per chunk in rasterizeQuads, bounds the candidate pixel arrays
+QUAD_CHUNK_SIZE = 50000
+
+# Slack (relative to pixel size) for a slanted quad edge to count as passing
+# through a pixel corner in rasterizeQuads
+TIE_TOLERANCE = 1e-9
+
+#--------------------------------------------------------------------------
+# geomWindow()
+#  Get pixel window (xoff, yoff, xsize, ysize) covering geometry bounds,
+#  clipped to the raster. Returns None if bounds do not overlap the raster
+#--------------------------------------------------------------------------
+def geomWindow(bounds, geotransform, nColumns, nRows):
+
+    (minx, miny, maxx, maxy) = bounds
+    (ulx, xres, xskew, uly, yskew, yres) = geotransform
+
+    # Same full-cover window as rasterstats (floor for start, ceil for stop)
+    colStart = int(math.floor((minx - ulx) / xres))
+    colStop  = int(math.ceil((maxx - ulx) / xres))
+    rowStart = int(math.floor((maxy - uly) / yres))
+    rowStop  = int(math.ceil((miny - uly) / yres))
+
+    # Zones that are narrower than a pixel still need a 1x1 window
+    colStop = max(colStop, colStart + 1)
+    rowStop = max(rowStop, rowStart + 1)
+
+    # Clip to raster. Pixels outside would be nodata anyways
+    colStart, colStop = max(colStart, 0), min(colStop, nColumns)
+    rowStart, rowStop = max(rowStart, 0), min(rowStop, nRows)
+
+    if colStart >= colStop or rowStart >= rowStop:
+        return None
+
+    return (colStart, rowStart, colStop - colStart, rowStop - rowStart)
+
+#--------------------------------------------------------------------------
+# rasterizeZone()
+#  Rasterize one geometry into a boolean mask for the given pixel window
+#--------------------------------------------------------------------------
+def rasterizeZone(geom, window, geotransform, allTouched = True):
+
+    (xoff, yoff, xsize, ysize) = window
+
+    windowAffine = Affine.from_gdal(*geotransform) * \
+                                              Affine.translation(xoff, yoff)
+
+    mask = features.rasterize([(geom, 1)], out_shape = (ysize, xsize),
+                              transform = windowAffine, fill = 0,
+                              dtype = 'uint8', all_touched = allTouched)
+
+    return mask.astype(bool)
+
+#--------------------------------------------------------------------------
+# quadCorners()
+#  If every geometry is a convex 4 corner polygon without holes (e.g. ATL08
+#  segments), return (nZones, 4, 2) array of corners. Otherwise None
+#--------------------------------------------------------------------------
+def quadCorners(geoms):
+
+    geoms = np.asarray(geoms, dtype = object)
+
+    if len(geoms) == 0 or shapely.is_missing(geoms).any():
+        return None
+
+    # 3 = Polygon
+    if (shapely.get_type_id(geoms) != 3).any() or \
+                            (shapely.get_num_interior_rings(geoms) != 0).any():
+        return None
+
+    rings = shapely.get_exterior_ring(geoms)
+    if (shapely.get_num_coordinates(rings) != 5).any():
+        return None
+
+    corners = shapely.get_coordinates(rings).reshape(-1, 5, 2)[:, :4]
+
+    # Convex if it turns the same way at every corner
+    edges = np.roll(corners, -1, axis = 1) - corners
+    nextEdges = np.roll(edges, -1, axis = 1)
+    cross = edges[..., 0] * nextEdges[..., 1] - edges[..., 1] * nextEdges[..., 0]
+
+    if not ((cross > 0).all(axis = 1) | (cross < 0).all(axis = 1)).all():
+        return None
+
+    return corners
+
+#--------------------------------------------------------------------------
+# rasterizeQuads()
+#  Get pixels overlapped by each convex quad (all_touched) on a north-up
+#  grid without rasterizing. Candidates are the pixels in each zone's window
+#  (same as geomWindow); a pixel is kept unless one of the quad's edge
+#  normals separates it from the quad (separating axis test)
+#  Returns (counts, pixels, ties) - pixels per zone and flattened pixel
+#  indices in zone order, row-major within a zone (same order as
+#  rasterizeZone), and True for zones with a slanted edge through a pixel
+#  corner. GDAL takes or leaves such corner pixels depending on the edge
+#  direction and window, so those zones should be rasterized (see build)
+#--------------------------------------------------------------------------
+def rasterizeQuads(corners, geotransform, nColumns, nRows, 
+                                               chunkSize = QUAD_CHUNK_SIZE):
+
+    (ulx, xres, xskew, uly, yskew, yres) = geotransform
+
+    # Corners in pixel space (col, row), where pixel (r, c) is the unit
+    # square [c, c+1] x [r, r+1]
+    quads = np.stack([(corners[..., 0] - ulx) / xres, 
+                      (corners[..., 1] - uly) / yres], axis = -1)
+
+    counts = np.zeros(len(quads), dtype = np.int64)
+    ties = np.zeros(len(quads), dtype = bool)
+    zonePixels = []
+
+    for start in range(0, len(quads), chunkSize):
+
+        q = quads[start:start + chunkSize]
+        n = len(q)
+
+        # Window of each zone, clipped to raster (see geomWindow)
+        colStart = np.floor(q[..., 0].min(axis = 1)).astype(np.int64)
+        colStop  = np.ceil(q[..., 0].max(axis = 1)).astype(np.int64)
+        rowStart = np.floor(q[..., 1].min(axis = 1)).astype(np.int64)
+        rowStop  = np.ceil(q[..., 1].max(axis = 1)).astype(np.int64)
+
+        colStop = np.maximum(colStop, colStart + 1)
+        rowStop = np.maximum(rowStop, rowStart + 1)
+
+        colStart, colStop = np.maximum(colStart, 0), np.minimum(colStop, nColumns)
+        rowStart, rowStop = np.maximum(rowStart, 0), np.minimum(rowStop, nRows)
+
+        width  = np.clip(colStop - colStart, 0, None)
+        height = np.clip(rowStop - rowStart, 0, None)
+        nCandidates = width * height
+
+        # Every candidate pixel of every zone in the chunk, row-major
+        zone = np.repeat(np.arange(n), nCandidates)
+        k = np.arange(nCandidates.sum()) - \
+                      np.repeat(np.cumsum(nCandidates) - nCandidates, nCandidates)
+
+        rows = rowStart[zone] + k // width[zone]
+        cols = colStart[zone] + k % width[zone]
+
+        # Window already overlaps the quad along x/y, so test edge normals
+        edges = np.roll(q, -1, axis = 1) - q
+        keep = np.ones(len(zone), dtype = bool)
+        touch = np.ones(len(zone), dtype = bool)
+
+        for e in range(4):
+
+            nx, ny = -edges[:, e, 1], edges[:, e, 0]
+
+            proj = q[..., 0] * nx[:, None] + q[..., 1] * ny[:, None]
+            (qMin, qMax) = (proj.min(axis = 1), proj.max(axis = 1))
+
+            center = (cols + 0.5) * nx[zone] + (rows + 0.5) * ny[zone]
+            half = 0.5 * (np.abs(nx[zone]) + np.abs(ny[zone]))
+
+            (low, high) = (center - half, center + half)
+            keep &= (low < qMax[zone]) & (high > qMin[zone])
+
+            # Pixels that only touch a slanted edge (within rounding)
+            slanted = ((nx != 0) & (ny != 0))[zone]
+            tol = TIE_TOLERANCE * half
+            touch &= np.where(slanted, (low <= qMax[zone] + tol) & \
+                                       (high >= qMin[zone] - tol),
+                                      (low < qMax[zone]) & (high > qMin[zone]))
+
+        ties[start:start + n] = np.bincount(zone[touch & ~keep], 
+                                                          minlength = n) > 0
+
+        zone, rows, cols = zone[keep], rows[keep], cols[keep]
+
+        counts[start:start + n] = np.bincount(zone, minlength = n)
+        zonePixels.append(rows * nColumns + cols)
+
+    if zonePixels:
+        pixels = np.concatenate(zonePixels)
+    else:
+        pixels = np.zeros(0, dtype = np.int64)
+
+    return counts, pixels, ties
+
+#--------------------------------------------------------------------------
+# gridSignature()
+#  String describing a raster pixel grid: epsg, geotransform and size
+#--------------------------------------------------------------------------
+def gridSignature(rasterObj):
+
+    gt = ','.join(['{!r}'.format(float(g)) for g in rasterObj.ogrGeotransform])
+
+    return 'EPSG:{};GT:{};SIZE:{}x{}'.format(rasterObj.epsg(), gt,
+                                          rasterObj.nColumns, rasterObj.nRows)
+
+#--------------------------------------------------------------------------
+# zoneHash()
+#  Hash of zone geometries (in order) and the rasterization strategy
+#--------------------------------------------------------------------------
+def zoneHash(geoms, allTouched = True):
+
+    h = hashlib.sha1()
+    h.update('allTouched={}'.format(bool(allTouched)).encode())
+
+    for wkb in shapely.to_wkb(np.asarray(geoms, dtype = object)):
+        # Missing geometries still take a slot so row order is kept
+        h.update(b'\x00' if wkb is None else wkb)
+
+    return h.hexdigest()
+
+#--------------------------------------------------------------------------
+# pixelType()
+#  Smallest dtype that holds every flattened pixel index of a grid
+#--------------------------------------------------------------------------
+def pixelType(nRows, nColumns):
+
+    if int(nRows) * int(nColumns) <= np.iinfo(np.uint32).max:
+        return np.uint32
+
+    return np.int64
+
+#--------------------------------------------------------------------------
+# rasterizeZones()
+#  Get pixels overlapped by each geometry by rasterizing it in its window
+#  Returns (counts, pixels) - pixels per zone and flattened pixel indices in
+#  zone order
+#--------------------------------------------------------------------------
+def rasterizeZones(geoms, geotransform, nColumns, nRows, allTouched = True):
+
+    counts = np.zeros(len(geoms), dtype = np.int64)
+    zonePixels = []
+
+    for i, geom in enumerate(geoms):
+
+        if geom is None or geom.is_empty:
+            continue
+
+        window = geomWindow(geom.bounds, geotransform, nColumns, nRows)
+        if window is None: # Zone is off the raster
+            continue
+
+        (xoff, yoff, xsize, ysize) = window
+
+        rows, cols = np.nonzero(rasterizeZone(geom, window, geotransform, 
+                                                                  allTouched))
+
+        pix = (rows.astype(np.int64) + yoff) * nColumns + (cols + xoff)
+
+        zonePixels.append(pix)
+        counts[i] = len(pix)
+
+    if zonePixels:
+        pixels = np.concatenate(zonePixels)
+    else:
+        pixels = np.zeros(0, dtype = np.int64)
+
+    return counts, pixels
+
+#------------------------------------------------------------------------------
+# class CoverageIndex
+#------------------------------------------------------------------------------
+class CoverageIndex(object):
+
+    #--------------------------------------------------------------------------
+    # __init__
+    #--------------------------------------------------------------------------
+    def __init__(self, offsets, pixels, nRows, nColumns, signature = None,
+                                                              zoneHash = None):
+
+        self.offsets   = np.asarray(offsets, dtype = np.int64)
+        self.pixels    = np.asarray(pixels, dtype = pixelType(nRows, nColumns))
+        self.nRows     = int(nRows)
+        self.nColumns  = int(nColumns)
+        self.signature = signature
+        self.zoneHash  = zoneHash
+
+        self.nZones = len(self.offsets) - 1
+
+    #--------------------------------------------------------------------------
+    # build()
+    #  Rasterize every zone onto the raster grid and return CoverageIndex
+    #  Quad zones (ATL08 segments) on a north-up grid use rasterizeQuads
+    #--------------------------------------------------------------------------
+    @classmethod
+    def build(cls, geoms, rasterObj, allTouched = True):
+
+        gt = rasterObj.ogrGeotransform
+        nColumns, nRows = rasterObj.nColumns, rasterObj.nRows
+
+        corners = None
+        if allTouched and gt[2] == 0 and gt[4] == 0:
+            corners = quadCorners(geoms)
+
+        if corners is None:
+            counts, pixels = rasterizeZones(geoms, gt, nColumns, nRows, 
+                                                                  allTouched)
+        else:
+            counts, pixels, ties = rasterizeQuads(corners, gt, nColumns, nRows)
+
+            # Rasterize zones with an edge through a pixel corner, so they
+            # get the same corner pixels as GDAL
+            if ties.any():
+                zonePixels = np.split(pixels, np.cumsum(counts)[:-1])
+
+                tieCounts, tiePixels = rasterizeZones(
+                    np.asarray(geoms, dtype = object)[ties], gt, nColumns, 
+                                                           nRows, allTouched)
+
+                for i, pix in zip(np.flatnonzero(ties),
+                          np.split(tiePixels, np.cumsum(tieCounts)[:-1])):
+                    zonePixels[i] = pix
+
+                counts[ties] = tieCounts
+                pixels = np.concatenate(zonePixels)
+
+        offsets = np.zeros(len(geoms) + 1, dtype = np.int64)
+        np.cumsum(counts, out = offsets[1:])
+
+        return cls(offsets, pixels, nRows, nColumns,
+                   signature = gridSignature(rasterObj),
+                   zoneHash = zoneHash(geoms, allTouched))
+
+    #--------------------------------------------------------------------------
+    # fromCache()
+    #  Load index from cacheFile if it exists and was built for these
+    #  zones/grid. Otherwise None (zones or grid changed, or no file yet)
+    #--------------------------------------------------------------------------
+    @classmethod
+    def fromCache(cls, cacheFile, geoms, rasterObj, allTouched = True):
+
+        if not os.path.isfile(cacheFile):
+            return None
+
+        index = cls.load(cacheFile)
+
+        if index is None or index.signature != gridSignature(rasterObj) or \
+                            index.zoneHash != zoneHash(geoms, allTouched):
+            return None
+
+        return index
+
+    #--------------------------------------------------------------------------
+    # load()
+    #  Returns None if file is from a different format version
+    #--------------------------------------------------------------------------
+    @classmethod
+    def load(cls, inFile):
+
+        with np.load(inFile, allow_pickle = False) as npz:
+
+            if int(npz['version']) != COVERAGE_VERSION:
+                return None
+
+            (nRows, nColumns) = npz['shape']
+
+            return cls(npz['offsets'], npz['pixels'], nRows, nColumns,
+                       signature = str(npz['signature']),
+                       zoneHash = str(npz['zoneHash']))
+
+    #--------------------------------------------------------------------------
+    # save()
+    #  Write to temp file first then rename, so a reader never sees a partial
+    #  index if several processes are filling the same cache
+    #--------------------------------------------------------------------------
+    def save(self, outFile):
+
+        fd, tmpFile = tempfile.mkstemp(suffix = '.npz',
+                                       dir = os.path.dirname(outFile))
+
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, version = COVERAGE_VERSION,
+                     signature = str(self.signature),
+                     zoneHash = str(self.zoneHash),
+                     shape = np.array([self.nRows, self.nColumns]),
+                     offsets = self.offsets, pixels = self.pixels)
+
+        os.replace(tmpFile, outFile)
+
+        return outFile
+
+    #--------------------------------------------------------------------------
+    # subset()
+    #  Return CoverageIndex of the given zones (positions), in that order
+    #--------------------------------------------------------------------------
+    def subset(self, zones):
+
+        zones = np.asarray(zones, dtype = np.int64)
+
+        starts = self.offsets[zones]
+        counts = self.offsets[zones + 1] - starts
+
+        offsets = np.zeros(len(zones) + 1, dtype = np.int64)
+        np.cumsum(counts, out = offsets[1:])
+
+        # Position of every kept pixel in self.pixels
+        idx = np.repeat(starts - offsets[:-1], counts) + np.arange(offsets[-1])
+
+        return CoverageIndex(offsets, self.pixels[idx], self.nRows,
+                             self.nColumns, signature = self.signature)
+
+    #--------------------------------------------------------------------------
+    # zonePixels()
+    #  Return (rows, cols) arrays of pixels covered by zone i
+    #--------------------------------------------------------------------------
+    def zonePixels(self, i):
+
+        pix = self.pixels[self.offsets[i]:self.offsets[i+1]]
+
+        return pix // self.nColumns, pix % self.nColumns
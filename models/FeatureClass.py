@@ -11,7 +11,7 @@ import tempfile
 
 from osgeo import ogr, gdal
 
-from SpatialHelper import SpatialHelper
+from models.SpatialHelper import SpatialHelper
 
 #------------------------------------------------------------------------------
 # class FeatureClass
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+GranuleCache is an in-process, memory-bounded LRU cache of parsed ATL08
+    granule dataframes (see buildZdf_atl08v5)
+
+Neighbouring stacks intersect mostly the same granules, so a process working
+    through a spatially ordered stack list can parse each granule once and
+    reuse it for the next stacks instead of re-reading it from shared storage
+
+Entries are keyed by (path, mtime, columns) so a granule that is rewritten
+    on disk is read again. When the total size of the cached dataframes goes
+    over maxBytes, least recently used entries are dropped
+
+Cached dataframes are shared - callers must not modify them in place
+
+The cache can be used from several threads (see buildZdf loadWorkers). A
+    granule missed by two threads at once may be read twice, but only one
+    copy is kept
+"""
+import os
+import threading
+
+from collections import OrderedDict
+
+#------------------------------------------------------------------------------
+# class GranuleCache
+#------------------------------------------------------------------------------
+class GranuleCache(object):
+
+    #--------------------------------------------------------------------------
+    # __init__
+    #--------------------------------------------------------------------------
+    def __init__(self, maxBytes):
+
+        self.maxBytes = int(maxBytes)
+
+        self.entries = OrderedDict() # key: (df, nBytes)
+        self.nBytes  = 0
+
+        self.hits   = 0
+        self.misses = 0
+
+        self.lock = threading.Lock()
+
+    #--------------------------------------------------------------------------
+    # key()
+    #--------------------------------------------------------------------------
+    @staticmethod
+    def key(path, columns = None):
+
+        if columns is not None:
+            columns = tuple(columns)
+
+        return (path, os.path.getmtime(path), columns)
+
+    #--------------------------------------------------------------------------
+    # get()
+    #  Return cached dataframe for path/columns, or reader(path) if not cached
+    #  reader must return a dataframe. Reader results are cached
+    #--------------------------------------------------------------------------
+    def get(self, path, reader, columns = None):
+
+        key = self.key(path, columns)
+
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key][0]
+
+            self.misses += 1
+
+        # Read outside the lock so other threads can keep reading granules
+        df = reader(path)
+
+        self.put(key, df)
+
+        return df
+
+    #--------------------------------------------------------------------------
+    # has()
+    #  True if path/columns is cached. Does not count as a hit or a miss
+    #--------------------------------------------------------------------------
+    def has(self, path, columns = None):
+
+        key = self.key(path, columns)
+
+        with self.lock:
+            return key in self.entries
+
+    #--------------------------------------------------------------------------
+    # put()
+    #--------------------------------------------------------------------------
+    def put(self, key, df):
+
+        nBytes = int(df.memory_usage(deep = True).sum())
+
+        # Don't let one big granule flush the whole cache
+        if nBytes > self.maxBytes:
+            return None
+
+        with self.lock:
+
+            # Another thread read the same granule first
+            if key in self.entries:
+                return None
+
+            # Old version of same granule (different mtime) is never hit again
+            for oldKey in [k for k in self.entries if k[0] == key[0]
+                                                          and k[1] != key[1]]:
+                self.remove(oldKey)
+
+            self.entries[key] = (df, nBytes)
+            self.nBytes += nBytes
+
+            self.evict()
+
+    #--------------------------------------------------------------------------
+    # remove()
+    #--------------------------------------------------------------------------
+    def remove(self, key):
+
+        (df, nBytes) = self.entries.pop(key)
+        self.nBytes -= nBytes
+
+    #--------------------------------------------------------------------------
+    # evict()
+    #  Drop least recently used entries until under maxBytes
+    #--------------------------------------------------------------------------
+    def evict(self):
+
+        while self.nBytes > self.maxBytes and self.entries:
+            self.remove(next(iter(self.entries)))
+
+    #--------------------------------------------------------------------------
+    # resize()
+    #--------------------------------------------------------------------------
+    def resize(self, maxBytes):
+
+        with self.lock:
+            self.maxBytes = int(maxBytes)
+            self.evict()
+
+    #--------------------------------------------------------------------------
+    # clear()
+    #--------------------------------------------------------------------------
+    def clear(self):
+
+        with self.lock:
+            self.entries.clear()
+            self.nBytes = 0
+
+    #--------------------------------------------------------------------------
+    # stats()
+    #--------------------------------------------------------------------------
+    def stats(self):
+
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self.entries), 'nBytes': self.nBytes,
+                'maxBytes': self.maxBytes}
@@ -11,7 +11,7 @@ import tempfile
 
 from osgeo import gdal, osr, gdal_array
 
-from SpatialHelper import SpatialHelper
+from models.SpatialHelper import SpatialHelper
 
 import numpy as np
 
@@ -20,12 +20,27 @@ RasterStack inherits the following from Raster:
     extent(self)
     extractBand(self, bandN, outTif = None)
     toArray(self) 
+
+validDataFootprint() gives a simplified polygon of where the stack actually
+    has data (SGM strips only fill a small part of their extent), so zones
+    can be dropped before stats rather than after
 """
 
 import os
 
+import numpy as np
+import shapely
+
+from affine import Affine
+from shapely.geometry import shape
+from osgeo import gdal
+from rasterio import features
+
 from models.Raster import Raster
 
+# Longest side (pixels) of the low resolution read used for the footprint
+FOOTPRINT_MAX_SIZE = 1024
+
 #------------------------------------------------------------------------------
 # class RasterStack
 #------------------------------------------------------------------------------
@@ -47,6 +62,8 @@ class RasterStack(Raster):
         
         self.stackName = self.baseName.strip('_stack')  
         self.filePath  = filePath
+        
+        self.footprint = None # See validDataFootprint()
 
     #--------------------------------------------------------------------------
     # noDataLayer()
@@ -61,6 +78,104 @@ class RasterStack(Raster):
         else:
             return None
         
+    #--------------------------------------------------------------------------
+    # validDataFootprint()
+    #  Simplified polygon (shapely, stack projection) of the stack's valid data
+    #  From mask.tif (0 = valid, 1 where data is removed) if there is one,
+    #  otherwise valid where any band has data (zones with data in any band
+    #  are kept, same as without a footprint). Made at low resolution 
+    #  (longest side maxSize) where a low resolution pixel is valid if any 
+    #  pixel under it is, then buffered and simplified by one low resolution
+    #  pixel so edges are kept. Empty polygon if the stack has no valid data
+    #  Computed once, and loaded from/saved to cacheFile (.wkb) if supplied. 
+    #  cacheFile is made again if the mask (or stack) is newer than it
+    #  Returns None if there is no mask, or a band has no nodata value
+    #--------------------------------------------------------------------------
+    def validDataFootprint(self, cacheFile = None, 
+                                               maxSize = FOOTPRINT_MAX_SIZE):
+        
+        if self.footprint is not None:
+            return self.footprint
+        
+        maskLayer = self.noDataLayer()
+        sourceFile = maskLayer if maskLayer else self.filePath
+        
+        if cacheFile and os.path.isfile(cacheFile) and \
+                  os.path.getmtime(cacheFile) >= os.path.getmtime(sourceFile):
+            with open(cacheFile, 'rb') as f:
+                self.footprint = shapely.from_wkb(f.read())
+            return self.footprint
+        
+        if maskLayer:
+            dataset = gdal.Open(maskLayer, gdal.GA_ReadOnly)
+        else:
+            dataset = self.dataset
+            
+        bands = range(1, dataset.RasterCount + 1)
+        noDataValues = [dataset.GetRasterBand(b).GetNoDataValue() 
+                                                               for b in bands]
+        
+        # A band without nodata is valid everywhere, so is the stack
+        if not maskLayer and None in noDataValues:
+            return None
+        
+        # Size of the low resolution grid
+        scale = max(1.0, max(dataset.RasterXSize, 
+                             dataset.RasterYSize) / float(maxSize))
+        bufX = max(1, int(round(dataset.RasterXSize / scale)))
+        bufY = max(1, int(round(dataset.RasterYSize / scale)))
+        
+        # Any valid pixel makes the low resolution pixel valid: min of the
+        # mask (0 = valid), or max of each band (nodata pixels of the band 
+        # are left out, so only all nodata stays nodata). Nearest would skip 
+        # narrow strips. Nodata is per band (not UNIFIED_SRC_NODATA), so a 
+        # band's nodata is never part of its max
+        lowResDs = gdal.Warp('', dataset, format = 'MEM', width = bufX, 
+                             height = bufY, 
+                             resampleAlg = 'min' if maskLayer else 'max',
+                             warpOptions = ['UNIFIED_SRC_NODATA=NO'])
+        
+        # Valid where any band is valid
+        valid = np.zeros((bufY, bufX), dtype = bool)
+        for (b, noDataValue) in zip(bands, noDataValues):
+            
+            arr = lowResDs.GetRasterBand(b).ReadAsArray()
+            
+            bandValid = np.ones(arr.shape, dtype = bool)
+            if maskLayer:
+                bandValid &= (arr == 0)
+            if noDataValue is not None:
+                if np.isnan(noDataValue):
+                    bandValid &= ~np.isnan(arr)
+                else:
+                    bandValid &= (arr != noDataValue)
+                    
+            valid |= bandValid
+        
+        transform = Affine.from_gdal(*lowResDs.GetGeoTransform())
+        pixelSize = max(abs(transform.a), abs(transform.e))
+        
+        lowResDs = None
+        
+        if valid.any():
+            polygons = [shape(geom) for (geom, value) in 
+                        features.shapes(valid.astype(np.uint8), mask = valid, 
+                                                      transform = transform)]
+        
+            footprint = shapely.union_all(polygons)
+            footprint = footprint.buffer(pixelSize).simplify(pixelSize)
+            
+        else:
+            footprint = shapely.Polygon()
+        
+        if cacheFile:
+            with open(cacheFile, 'wb') as f:
+                f.write(shapely.to_wkb(footprint))
+        
+        self.footprint = footprint
+        
+        return footprint
+        
     #--------------------------------------------------------------------------
     # outDir()
     #--------------------------------------------------------------------------
@@ -12,6 +12,12 @@ Cribbed RasterStats name from rasterstats package because it's the only name
     - https://github.com/perrygeo/python-rasterstats
     - This code mainly wraps around rasterstats package but does a few extra
       things to return a nice geopandas dataframe rather than dict/etc
+    - ZonalStats uses ZonalEngine to do all bands in one pass over the zones
+      (same stats/semantics as rasterstats.zonal_stats)
+    - PointStats uses ZonalEngine to sample all bands in one pass, by raster
+      block (same values as rasterstats.point_query with 'nearest')
+    - LabelStats does zonal stats from a label image instead of polygons
+      (disturbance patches), each raster pixel goes to the label at its center
     - Also adds some methods/options for writing to .csv/.shp
     - Specific for 3DSI work
     
@@ -21,11 +27,15 @@ NOTE:
 """
 import os
 
-import geopandas as gpd
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
 
-from rasterstats import zonal_stats, point_query
+import numpy as np
+import geopandas as gpd
 
 from models.Raster import Raster
+from models.ZonalEngine import zonalStatsMultiBand, pointValuesMultiBand, \
+                                              labelStatsMultiBand, zoneCoverage
 
 #* TD TO DO
 # Add optional arguments dict e.g. allTouched, columnsToKeep, etc.
@@ -56,6 +66,37 @@ def getDefaultLayerDict(nLayers):
         
     return layerDict
 
+#--------------------------------------------------------------------------
+# getLayerList
+#--------------------------------------------------------------------------
+# Gather (layerN, layerName, statsList) for all layers in layerDict so every
+# band can be computed in a single pass over the zones
+def getLayerList(layerDict):
+    
+    layers = []
+    for layerN in layerDict:
+        
+        layerName = layerDict[layerN][0]
+
+        # If layerDict was created with default or in 3DSI code, this will work.
+        # But if layerDict was passed, and there are no stats in layerDict
+        try:
+            statsList = layerDict[layerN][1]
+            
+        except IndexError:
+            statsList = DEFAULT_STATS
+            
+        # statsList could just be string, in which case we need to make it a list
+        ## putting this here allows flexibility for default stats to be a string
+        if isinstance(statsList, str):
+            statsList = [statsList]
+
+        print("\n Layer {} ({}): {}".format(layerN, layerName, statsList))
+        
+        layers.append((layerN, layerName, statsList))
+        
+    return layers
+
 #--------------------------------------------------------------------------
 # checkArgs
 #--------------------------------------------------------------------------
@@ -72,8 +113,9 @@ def checkArgs(inGdf, inRaster):
 #  Given a geodataframe with point geometry/other possible attributes
 #  and an overlapping raster, return a geodataframe with the raster value
 #  for each row in a new column (one column per layer/band of raster)
+#  workers > 1 samples spatially compact shards of points in parallel
 #--------------------------------------------------------------------------
-def PointStats(zonalDf, raster, layerDict = None):
+def PointStats(zonalDf, raster, layerDict = None, workers = 1):
     
     checkArgs(zonalDf, raster)
     
@@ -99,22 +141,29 @@ def PointStats(zonalDf, raster, layerDict = None):
     
     outDf = zonalDf.copy() # Make copy for output to prevent pandas slicing error
 
-    # Iterate through layers, run zonal stats and add columns to dataframe 
+    # Iterate through layers to get (layerN, layerName) for each band
     # layerDict is now --> key: [layerName, statsString]
-    newColumns = [] # For list of new columns added to the dataframe
+    layers = []
     for layerN in layerDict:
         
         layerName = layerDict[layerN][0]
-        newColumns.append(layerName)
 
         print("\n Layer/band {} ({})".format(layerN, layerName))
         
-        # Compute point stats and add them to dataframe
-        # 1/6/23: For whatever reason, if you don't set interpolate to 
-        #         nearest, pq will return averages/weird/wrong values
-        outDf[layerName] = point_query(zonalDf, raster, band=layerN,
-                                         nodata=rasterObj.noDataValue, 
-                                                interpolate='nearest')
+        layers.append((layerN, layerName))
+        
+    # Sample all bands at once, reading each raster block once
+    # 1/6/23: Must be nearest pixel (like point_query interpolate='nearest'),
+    #         otherwise we get averages/weird/wrong values
+    pointValues = pointValuesMultiBand(zonalDf, raster, layers, 
+                                           nodata = rasterObj.noDataValue,
+                                           workers = workers)
+    
+    newColumns = [] # For list of new columns added to the dataframe
+    for (layerN, layerName) in layers:
+        
+        newColumns.append(layerName)
+        outDf[layerName] = pointValues[layerName]
     
     del zonalDf
    
@@ -138,8 +187,29 @@ def PointStats(zonalDf, raster, layerDict = None):
 #  Given a geodataframe with polygon geometry/other possible attributes
 #  and an overlapping raster, return a geodataframe with the raster stats
 #  for each row in a new column (one column per band per raster/stat combo)
+#  If coverageCache (.npz path) is supplied, zone-to-pixel coverage of all
+#  zones is cached there so later runs on the same zones/raster grid skip
+#  rasterization
+#  workers > 1 processes spatially compact shards of zones in parallel
+#--------------------------------------------------------------------------
+def ZonalStats(zonalDf, raster, layerDict = None, coverageCache = None, 
+                                                                 workers = 1):
+    
+    # Same as streaming version, but all zones are done in one chunk
+    batches = ZonalStatsChunks(zonalDf, raster, layerDict, chunkSize = None,
+                           coverageCache = coverageCache, workers = workers)
+    
+    return next(batches)
+
+#--------------------------------------------------------------------------
+# ZonalStatsChunks()
+#  Generator version of ZonalStats. Zones are processed chunkSize rows at a
+#  time (in input order) and each finished geodataframe batch is yielded,
+#  so only one chunk's worth of copies/stat columns is ever in memory
+#  chunkSize = None does all zones in one chunk (one batch is yielded)
 #--------------------------------------------------------------------------
-def ZonalStats(zonalDf, raster, layerDict = None):
+def ZonalStatsChunks(zonalDf, raster, layerDict = None, chunkSize = 50000,
+                                        coverageCache = None, workers = 1):
     
     checkArgs(zonalDf, raster)
     
@@ -153,66 +223,130 @@ def ZonalStats(zonalDf, raster, layerDict = None):
     if not layerDict:
         layerDict = getDefaultLayerDict(rasterObj.nLayers)
     
-    # Convert df to raster projection if need be
+    # Check if df needs to be converted to raster projection (done per chunk)
     srcGdfEpsg = zonalDf.crs.to_epsg()
     if int(srcGdfEpsg) != int(rasterEpsg):
         print("Converting input zonal df to stack extent (EPSG:{})\n".format(rasterEpsg))
-        zonalDf = zonalDf.to_crs(epsg = rasterEpsg)    
     
     print("Computing zonal statistics using:")
     print(" Input Raster: {}".format(raster))
     print(" Input Vector: {}".format(zonalDf))
     print("") #* TD print other args/info
     
-    outDf = zonalDf.copy() # Make copy for output to ignore pandas slicing error
-    
-    newColumns = [] # For list of new columns added to the dataframe
-    for layerN in layerDict:
+    layers = getLayerList(layerDict)
         
-        layerName = layerDict[layerN][0]
+    nZones = len(zonalDf.index)
+    if not chunkSize:
+        chunkSize = max(nZones, 1)
+        
+    # One process pool for every chunk of the stack (none if workers = 1)
+    pool = ProcessPoolExecutor(max_workers = workers) if workers > 1 \
+                                                           else nullcontext()
+    with pool as executor:
+        
+        # Cached coverage covers all zones of the stack (one file, no matter
+        # how the zones are chunked/sharded), each chunk takes its rows
+        coverage = None
+        if coverageCache:
+            if int(srcGdfEpsg) != int(rasterEpsg):
+                zoneGeoms = zonalDf.geometry.to_crs(epsg = rasterEpsg)
+                zoneGeoms = zoneGeoms.to_frame()
+            else:
+                zoneGeoms = zonalDf.geometry.to_frame()
+            coverage = zoneCoverage(zoneGeoms, raster, 
+                                    allTouched = allTouched,
+                                    cacheFile = coverageCache, 
+                                    workers = workers, executor = executor)
+            del zoneGeoms
+        
+        # range() still gives one (empty) chunk if there are no zones
+        for start in range(0, max(nZones, 1), chunkSize):
+        
+            stop = min(start + chunkSize, nZones)
+            if chunkSize < nZones:
+                print("\n Zones {}-{} of {}".format(start + 1, stop, nZones))
+        
+            # Make copy for output to ignore pandas slicing error
+            if int(srcGdfEpsg) != int(rasterEpsg):
+                outDf = zonalDf.iloc[start:stop].to_crs(epsg = rasterEpsg)
+            else:
+                outDf = zonalDf.iloc[start:stop].copy()
 
-        # If layerDict was created with default or in 3DSI code, this will work.
-        # But if layerDict was passed, and there are no stats in layerDict
-        try:
-            statsList = layerDict[layerN][1]
-            
-        except IndexError:
-            statsList = DEFAULT_STATS
-            
-        # statsList could just be string, in which case we need to make it a list
-        ## putting this here allows flexibility for default stats to be a string
-        if isinstance(statsList, str):
-            statsList = [statsList]
+            chunkCoverage = None
+            if coverage is not None:
+                chunkCoverage = coverage.subset(np.arange(start, stop))
 
-        print("\n Layer {} ({}): {}".format(layerN, layerName, statsList))
+            # Rasterize each zone and read its window once for all bands
+            # This returns dict where key = '{layerName}_{stat}' and value = array
+            zonalStats = zonalStatsMultiBand(outDf, raster, layers, 
+                                             allTouched = allTouched, 
+                                             nodata = rasterObj.noDataValue,
+                                             coverage = chunkCoverage,
+                                             workers = workers, 
+                                             executor = executor)
+        
+            # Add columns to dataframe in layer/stat order
+            newColumns = list(zonalStats.keys()) # For list of new columns added to the dataframe
+            for colName in newColumns:
+                outDf[colName] = zonalStats[colName]
+        
+            del zonalStats
+        
+            # Remove any rows whose columns from the PQ were ALL NaN (IOW don't get rid 
+            # of row just because one column/layer was NaN), only if they all are NaN
+            outDf = outDf.dropna(how = 'all', subset = newColumns)
+        
+            # Replace all NaN with our NoData value
+            if rasterObj.noDataValue:
+                outDf = outDf.fillna(rasterObj.noDataValue)
+                                                   
+            # Lastly convert back to initial projection
+            if int(srcGdfEpsg) != int(outDf.crs.to_epsg()):
+                outDf = outDf.to_crs(epsg = srcGdfEpsg)  
+        
+            yield outDf
 
-        # try hardcoding NoData val of -99
-        zonalStats = zonal_stats(zonalDf, raster, all_touched = allTouched,
-                                                   stats=statsList, band=layerN, 
-                                                   nodata=rasterObj.noDataValue)
+#--------------------------------------------------------------------------
+# LabelStats()
+#  Given a geodataframe with one row per label (row i is label i+1, e.g. from
+#  buildZdf_disturbance.buildLabelZdf), the label image dataset and an
+#  overlapping raster, return a geodataframe with the raster stats for each
+#  label in new columns (same columns as ZonalStats). Rows do not need a
+#  geometry. Each raster pixel is assigned to the label at its center
+#  Output stays in the crs of zonalDf
+#--------------------------------------------------------------------------
+def LabelStats(zonalDf, labelDs, raster, layerDict = None):
+    
+    checkArgs(zonalDf, raster)
+    
+    rasterObj = Raster(raster)
+    
+    if not layerDict:
+        layerDict = getDefaultLayerDict(rasterObj.nLayers)
         
-        # This returns a list of dictionaries, with a where key = stat and value = layer
-        # Iterate through stats and add columns to dataframe
-        for stat in statsList:
-            
-            colName = '{}_{}'.format(layerName, stat)
-            newColumns.append(colName)
-            
-            outDf[colName] = [d[stat] for d in zonalStats]
-            
-    del zonalDf
+    print("Computing label image statistics using:")
+    print(" Input Raster: {}".format(raster))
+    print(" Input Labels: {} labels".format(len(zonalDf.index)))
+    print("")
     
-    # Remove any rows whose columns from the PQ were ALL NaN (IOW don't get rid 
-    # of row just because one column/layer was NaN), only if they all are NaN
+    layers = getLayerList(layerDict)
+    
+    outDf = zonalDf.copy()
+    
+    labelStats = labelStatsMultiBand(labelDs, len(outDf.index), raster, 
+                                     layers, nodata = rasterObj.noDataValue)
+    
+    newColumns = list(labelStats.keys())
+    for colName in newColumns:
+        outDf[colName] = labelStats[colName]
+        
+    del labelStats
+    
+    # Remove any rows whose stat columns were ALL NaN
     outDf = outDf.dropna(how = 'all', subset = newColumns)
     
-    # Replace all NaN with our NoData value
+    # Replace NaN stats with our NoData value (geometry may be empty here)
     if rasterObj.noDataValue:
-        outDf = outDf.fillna(rasterObj.noDataValue)
-                                               
-    # Lastly convert back to initial projection
-    if int(srcGdfEpsg) != int(outDf.crs.to_epsg()):
-        print("\nConverting input zonal df back to original extent (EPSG:{})\n".format(srcGdfEpsg))
-        outDf = outDf.to_crs(epsg = srcGdfEpsg)  
-    
+        outDf[newColumns] = outDf[newColumns].fillna(rasterObj.noDataValue)
+        
     return outDf
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+StackQueue is a work queue of raster stacks kept in an SQLite file on the
+    shared filesystem, so any number of nodes can work through one stack list
+
+Instead of splitting the list among a fixed set of nodes up front, each worker
+    claims the next pending stack when it is ready for one. A node that draws
+    cheap stacks just claims more of them, and nodes can join (or leave) at
+    any time
+
+    - claim() takes the next pending stack in list order, in one write
+      transaction so two workers never get the same stack
+    - while a stack runs, its worker sends heartbeats (heartbeat(), or the
+      Heartbeat thread from beat())
+    - a claimed stack whose last heartbeat is older than claimTimeout (worker
+      died, node rebooted, ...) goes back to pending for someone else, or to
+      failed once it has been claimed maxAttempts times
+    - finish() marks the stack done or failed
+    - if the Heartbeat thread finds the claim was lost, it sets its lost
+      Event, so the stack can stop instead of finishing next to the new claim
+
+Every worker adds the stack list with addStacks() (stacks already in the queue
+    are left as they are), so there is no separate step to fill the queue
+
+The rollback journal is used (not WAL, which needs shared memory and does not
+    work across nodes), so the filesystem must support POSIX locks. Heartbeat
+    times are compared across nodes, so node clocks should be in sync. An
+    SQLite file on local disk works the same for testing on one machine
+"""
+import time
+import sqlite3
+import threading
+
+# Seconds between heartbeats of a running stack
+HEARTBEAT_SECONDS = 60
+
+# Claimed stacks with no heartbeat for this long are taken back
+CLAIM_TIMEOUT = 600
+
+# Claims of a stack before it is marked failed instead of taken back
+MAX_ATTEMPTS = 3
+
+#------------------------------------------------------------------------------
+# class StackQueue
+#------------------------------------------------------------------------------
+class StackQueue(object):
+
+    #--------------------------------------------------------------------------
+    # __init__
+    #--------------------------------------------------------------------------
+    def __init__(self, dbPath, claimTimeout = CLAIM_TIMEOUT,
+                                                 maxAttempts = MAX_ATTEMPTS):
+
+        self.dbPath       = dbPath
+        self.claimTimeout = claimTimeout
+        self.maxAttempts  = maxAttempts
+
+        # Autocommit, transactions are started explicitly. Wait on locks held
+        # by other workers instead of failing right away
+        self.connection = sqlite3.connect(dbPath, timeout = 120,
+                                                      isolation_level = None)
+        self.connection.execute('PRAGMA journal_mode = DELETE')
+
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS stacks (
+                stack     TEXT PRIMARY KEY,
+                status    TEXT NOT NULL DEFAULT 'pending',
+                worker    TEXT,
+                claimed   REAL,
+                heartbeat REAL,
+                attempts  INTEGER NOT NULL DEFAULT 0,
+                finished  REAL)""")
+
+    #--------------------------------------------------------------------------
+    # transaction()
+    #  Run function(cursor) in a write transaction (BEGIN IMMEDIATE takes the
+    #  write lock up front, so reads and writes inside are atomic)
+    #--------------------------------------------------------------------------
+    def transaction(self, function):
+
+        cursor = self.connection.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+
+        try:
+            result = function(cursor)
+        except:
+            cursor.execute('ROLLBACK')
+            raise
+
+        cursor.execute('COMMIT')
+
+        return result
+
+    #--------------------------------------------------------------------------
+    # addStacks()
+    #  Add stacks to the queue as pending, in order. Stacks already in the
+    #  queue are left as they are. Returns number of stacks added
+    #--------------------------------------------------------------------------
+    def addStacks(self, stacks):
+
+        def add(cursor):
+            cursor.executemany('INSERT OR IGNORE INTO stacks (stack) VALUES (?)',
+                                              [(stack,) for stack in stacks])
+            return cursor.rowcount
+
+        return self.transaction(add)
+
+    #--------------------------------------------------------------------------
+    # claim()
+    #  Take back expired claims, then claim the next pending stack for worker
+    #  Returns stack, or None if there are no pending stacks left
+    #--------------------------------------------------------------------------
+    def claim(self, worker):
+
+        def claimNext(cursor):
+
+            now = time.time()
+            expired = now - self.claimTimeout
+
+            cursor.execute("""UPDATE stacks SET status = 'failed', finished = ?
+                              WHERE status = 'claimed' AND heartbeat < ?
+                              AND attempts >= ?""",
+                                            (now, expired, self.maxAttempts))
+            cursor.execute("""UPDATE stacks SET status = 'pending', worker = NULL
+                              WHERE status = 'claimed' AND heartbeat < ?""",
+                                                                  (expired,))
+
+            row = cursor.execute("""SELECT stack FROM stacks
+                                    WHERE status = 'pending'
+                                    ORDER BY rowid LIMIT 1""").fetchone()
+            if row is None:
+                return None
+
+            cursor.execute("""UPDATE stacks SET status = 'claimed', worker = ?,
+                              claimed = ?, heartbeat = ?,
+                              attempts = attempts + 1 WHERE stack = ?""",
+                                                    (worker, now, now, row[0]))
+
+            return row[0]
+
+        return self.transaction(claimNext)
+
+    #--------------------------------------------------------------------------
+    # heartbeat()
+    #  Tell the queue worker is still running stack. Returns False if the
+    #  claim was lost (taken back after timing out)
+    #--------------------------------------------------------------------------
+    def heartbeat(self, stack, worker):
+
+        cursor = self.connection.execute("""UPDATE stacks SET heartbeat = ?
+                         WHERE stack = ? AND worker = ? AND status = 'claimed'""",
+                                                  (time.time(), stack, worker))
+
+        return cursor.rowcount == 1
+
+    #--------------------------------------------------------------------------
+    # finish()
+    #  Mark stack done (or failed) if worker still holds the claim. Returns
+    #  False if the claim was lost
+    #--------------------------------------------------------------------------
+    def finish(self, stack, worker, ok = True):
+
+        status = 'done' if ok else 'failed'
+
+        cursor = self.connection.execute("""UPDATE stacks SET status = ?,
+                         finished = ? WHERE stack = ? AND worker = ?
+                         AND status = 'claimed'""",
+                                        (status, time.time(), stack, worker))
+
+        return cursor.rowcount == 1
+
+    #--------------------------------------------------------------------------
+    # counts()
+    #  Number of stacks per status, e.g. {'pending': 10, 'done': 3}
+    #--------------------------------------------------------------------------
+    def counts(self):
+
+        rows = self.connection.execute("""SELECT status, COUNT(*) FROM stacks
+                                          GROUP BY status""").fetchall()
+
+        return dict(rows)
+
+    #--------------------------------------------------------------------------
+    # beat()
+    #  Start a Heartbeat thread for stack/worker, use as context manager:
+    #   with queue.beat(stack, worker):
+    #       (run stack)
+    #--------------------------------------------------------------------------
+    def beat(self, stack, worker, seconds = HEARTBEAT_SECONDS):
+
+        return Heartbeat(self.dbPath, stack, worker, seconds)
+
+#------------------------------------------------------------------------------
+# class Heartbeat
+#  Thread that sends a heartbeat for a claimed stack every seconds until
+#  stopped. Has its own connection (sqlite connections are per thread)
+#  Sets lost and stops if the claim was lost
+#------------------------------------------------------------------------------
+class Heartbeat(threading.Thread):
+
+    def __init__(self, dbPath, stack, worker, seconds = HEARTBEAT_SECONDS):
+
+        super(Heartbeat, self).__init__(daemon = True)
+
+        self.dbPath  = dbPath
+        self.stack   = stack
+        self.worker  = worker
+        self.seconds = seconds
+
+        self.stopped = threading.Event()
+        self.lost    = threading.Event()
+
+    def run(self):
+
+        queue = StackQueue(self.dbPath)
+
+        while not self.stopped.wait(self.seconds):
+
+            try:
+                if not queue.heartbeat(self.stack, self.worker):
+                    print("\nLost claim on {}".format(self.stack))
+                    self.lost.set()
+                    return
+            except sqlite3.OperationalError as e:
+                # Busy/locked for too long, try again next time
+                print("\nHeartbeat for {} failed: {}".format(self.stack, e))
+
+    def __enter__(self):
+
+        self.start()
+
+        return self
+
+    def __exit__(self, *args):
+
+        self.stopped.set()
+        self.join()
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+StackScheduler runs several stacks at once on one node, with the number of
+    stacks running at a time set by memory rather than a fixed job count
+
+Each stack has a memory estimate (see run_ZonalStats_3DSI.estimateStackMemory,
+    shot count x band count). A stack is started when its estimate fits in
+    the memory that is left: the smaller of memLimit minus what running
+    stacks use (their RSS, or their estimate while RSS is still below it) and
+    MemAvailable minus what running stacks are still expected to grow by.
+    Pending stacks are tried in order, so smaller stacks fill the gaps left
+    by a big one. If nothing is running the next stack is started anyway so
+    a stack bigger than the limit still runs (alone)
+
+When the RSS of the running stacks goes over backoffFraction of memLimit no
+    new stack is started until it drops back down. Running stacks are never
+    killed (they append to the aggregate .csv as they go)
+
+Each stack runs in its own forked process (imports are inherited from the
+    parent, memory is given back when the stack finishes). Memory is read
+    from /proc, so this is Linux only
+"""
+import os
+import time
+
+import multiprocessing
+
+# Fraction of MemAvailable used as the memory limit if none is given
+MEM_FRACTION = 0.8
+
+# Stop starting stacks when RSS of running stacks is over this much of limit
+BACKOFF_FRACTION = 0.9
+
+#------------------------------------------------------------------------------
+# class StackScheduler
+#------------------------------------------------------------------------------
+class StackScheduler(object):
+
+    #--------------------------------------------------------------------------
+    # __init__
+    #--------------------------------------------------------------------------
+    # memLimit: bytes for all running stacks (default MEM_FRACTION of
+    #  MemAvailable when the scheduler is made)
+    # maxProcesses: most stacks running at once, even if memory is left
+    def __init__(self, memLimit = None, maxProcesses = None,
+                      pollSeconds = 5, backoffFraction = BACKOFF_FRACTION):
+
+        if not memLimit:
+            memLimit = MEM_FRACTION * StackScheduler.memAvailable()
+
+        if not maxProcesses:
+            maxProcesses = max(1, os.cpu_count() - 1)
+
+        self.memLimit        = int(memLimit)
+        self.maxProcesses    = int(maxProcesses)
+        self.pollSeconds     = pollSeconds
+        self.backoffFraction = backoffFraction
+
+        self.context = multiprocessing.get_context('fork')
+
+    #--------------------------------------------------------------------------
+    # memAvailable()
+    #  MemAvailable from /proc/meminfo, in bytes
+    #--------------------------------------------------------------------------
+    @staticmethod
+    def memAvailable():
+
+        with open('/proc/meminfo', 'r') as mi:
+            for line in mi:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+
+        raise RuntimeError("Could not get MemAvailable from /proc/meminfo")
+
+    #--------------------------------------------------------------------------
+    # processRss()
+    #  Resident memory of a process, in bytes (0 if it has already exited)
+    #--------------------------------------------------------------------------
+    @staticmethod
+    def processRss(pid):
+
+        try:
+            with open('/proc/{}/status'.format(pid), 'r') as ps:
+                for line in ps:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) * 1024
+        except (IOError, OSError):
+            pass
+
+        return 0
+
+    #--------------------------------------------------------------------------
+    # run()
+    #  Run function(stack, *args) for every stack in its own process, as many
+    #  at once as memory allows. estimates is a list of bytes, one per stack
+    #  Returns list of stacks whose process did not exit cleanly (e.g. killed
+    #  for memory). Exceptions should be handled by function itself, which
+    #  should exit non-zero (sys.exit(1)) for a stack that failed
+    #--------------------------------------------------------------------------
+    def run(self, function, stacks, estimates, *args):
+
+        pending = list(zip(stacks, estimates))
+        running = [] # (process, stack, estimate)
+        failed  = []
+
+        print("\nRunning {} stacks, memory limit {} GB, at most {} at once".format(
+                 len(pending), round(self.memLimit / 1024.0**3, 1),
+                                                          self.maxProcesses))
+
+        while pending or running:
+
+            # Reap finished stacks
+            for (process, stack, estimate) in [r for r in running
+                                                    if not r[0].is_alive()]:
+                process.join()
+                if process.exitcode != 0:
+                    print("\nStack {} exited with code {}".format(stack,
+                                                           process.exitcode))
+                    failed.append(stack)
+                running.remove((process, stack, estimate))
+
+            rss = [self.processRss(process.pid) for (process, s, e) in running]
+            totalRss = sum(rss)
+
+            # Running stacks count as their estimate until they grow past it
+            committed = sum([max(r, e) for r, (p, s, e) in zip(rss, running)])
+            growth = sum([max(e - r, 0) for r, (p, s, e) in zip(rss, running)])
+            headroom = min(self.memLimit - committed,
+                           self.memAvailable() - growth)
+
+            backoff = totalRss > self.backoffFraction * self.memLimit
+
+            # Start whatever fits, in order
+            while pending and len(running) < self.maxProcesses and not backoff:
+
+                fits = [i for i, (s, e) in enumerate(pending) if e <= headroom]
+                if not running:
+                    fits = fits or [0]
+                if not fits:
+                    break
+
+                (stack, estimate) = pending.pop(fits[0])
+
+                process = self.context.Process(target = function,
+                                               args = (stack,) + args)
+                process.start()
+
+                print("\nStarted {} (estimate {} GB, {} running, {} pending)".format(
+                        stack, round(estimate / 1024.0**3, 2),
+                        len(running) + 1, len(pending)))
+
+                running.append((process, stack, estimate))
+                headroom -= estimate
+
+            if pending or running:
+                time.sleep(self.pollSeconds)
+
+        return failed
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+StatKernels computes zonal statistics for all zones at once from a flat array
+    of pixel values and CSR-style zone offsets (see CoverageIndex):
+
+    values[offsets[i]:offsets[i+1]] --> pixel values for zone i
+
+Instead of one dict of stats per zone, every stat is one array (one value
+    per zone) computed with grouped NumPy reductions:
+    - count/sum/mean/std with bincount (std is two-pass, like numpy)
+    - min/max/median/percentile_XX from a single segmented sort, so asking
+      for percentile_90 next to median costs almost nothing extra
+    - majority/minority/unique with bincount for integer layers with a small
+      value range (e.g. Landsat ageYear/ecoreg), otherwise from runs of equal
+      values in the sorted array
+
+Stat names and semantics follow rasterstats:
+    - pixels equal to nodata (and NaN for float rasters) are excluded
+    - zones with no valid pixels get NaN (the None of rasterstats) for every
+      stat, except count which is 0
+    - percentiles use linear interpolation (np.percentile default)
+    - majority/minority ties go to the smallest value
+"""
+import numpy as np
+
+from rasterstats.utils import get_percentile
+
+# Max number of (zone, value) cells for the bincount majority path, and the
+# most memory the (int64) count matrix takes (see estimateStackMemory in
+# scripts/run_ZonalStats_3DSI.py)
+MAX_BINCOUNT_CELLS = 5000000
+MAX_BINCOUNT_BYTES = MAX_BINCOUNT_CELLS * np.dtype(np.int64).itemsize
+
+#--------------------------------------------------------------------------
+# percentileFromSorted()
+#  Linear interpolated percentile q (0-100) for each zone of a sorted array
+#  starts = start of each zone in sorted array, counts = n values in zone
+#  Only call with zones where counts > 0
+#--------------------------------------------------------------------------
+def percentileFromSorted(sortedValues, starts, counts, q):
+
+    pos = (q / 100.0) * (counts - 1)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.minimum(lo + 1, counts - 1)
+
+    vLo = sortedValues[starts + lo].astype(np.float64)
+    vHi = sortedValues[starts + hi].astype(np.float64)
+
+    return vLo + (vHi - vLo) * (pos - lo)
+
+#--------------------------------------------------------------------------
+# countStats()
+#  Return (majority, minority, unique) arrays for zones with counts > 0
+#--------------------------------------------------------------------------
+def countStats(values, zoneIds, nZones, sortedValues = None, starts = None,
+                                                               counts = None):
+
+    # Integer layers with a small value range: count every (zone, value)
+    if np.issubdtype(values.dtype, np.integer) and values.size > 0:
+
+        vMin, vMax = int(values.min()), int(values.max())
+        nBins = vMax - vMin + 1
+
+        if nBins * nZones <= MAX_BINCOUNT_CELLS:
+
+            binCounts = np.bincount(zoneIds * nBins + (values.astype(np.int64) - vMin),
+                          minlength = nZones * nBins).reshape(nZones, nBins)
+
+            majority = np.argmax(binCounts, axis = 1) + vMin
+            unique = (binCounts > 0).sum(axis = 1)
+
+            # Values not in zone can't be the minority (set in place, no
+            # second copy of the matrix)
+            binCounts[binCounts == 0] = np.iinfo(binCounts.dtype).max
+            minority = np.argmin(binCounts, axis = 1) + vMin
+
+            return majority, minority, unique
+
+    # Otherwise, use runs of equal values in the zone-sorted array
+    if sortedValues is None:
+        order = np.lexsort((values, zoneIds))
+        sortedValues = values[order]
+        counts = np.bincount(zoneIds, minlength = nZones)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    sortedZones = np.repeat(np.arange(nZones), counts)
+
+    newRun = np.ones(len(sortedValues), dtype = bool)
+    newRun[1:] = (sortedValues[1:] != sortedValues[:-1]) | \
+                 (sortedZones[1:] != sortedZones[:-1])
+
+    runStarts = np.flatnonzero(newRun)
+    runLengths = np.diff(np.append(runStarts, len(sortedValues)))
+    runZones = sortedZones[runStarts]
+    runValues = sortedValues[runStarts]
+
+    unique = np.bincount(runZones, minlength = nZones)
+
+    # Sort runs by zone, then count (desc for majority), then value (asc) so
+    # the first run of each zone is the answer and ties go to smallest value
+    firstRun = np.concatenate(([0], np.cumsum(unique)[:-1]))
+    hasRuns = unique > 0
+
+    majority = np.zeros(nZones, dtype = sortedValues.dtype)
+    order = np.lexsort((runValues, -runLengths, runZones))
+    majority[hasRuns] = runValues[order][firstRun[hasRuns]]
+
+    minority = np.zeros(nZones, dtype = sortedValues.dtype)
+    order = np.lexsort((runValues, runLengths, runZones))
+    minority[hasRuns] = runValues[order][firstRun[hasRuns]]
+
+    return majority, minority, unique
+
+#--------------------------------------------------------------------------
+# groupedStats()
+#  Given flat pixel values, CSR offsets (len nZones + 1) and stats list,
+#  return dict of {stat: array with one value per zone}
+#--------------------------------------------------------------------------
+def groupedStats(values, offsets, statsList, nodata = None):
+
+    values = np.asarray(values)
+    offsets = np.asarray(offsets, dtype = np.int64)
+    nZones = len(offsets) - 1
+
+    zoneIds = np.repeat(np.arange(nZones), np.diff(offsets))
+
+    # Mask nodata and NaN, same as rasterstats
+    isNoData = np.zeros(values.shape, dtype = bool)
+    if nodata is not None:
+        isNoData = (values == nodata)
+
+    isNan = np.zeros(values.shape, dtype = bool)
+    if np.issubdtype(values.dtype, np.floating):
+        isNan = np.isnan(values)
+
+    valid = ~(isNoData | isNan)
+    validValues = values[valid]
+    validZones = zoneIds[valid]
+
+    counts = np.bincount(validZones, minlength = nZones)
+    hasData = counts > 0
+
+    stats = {}
+
+    # Everything except count is NaN for zones without valid pixels
+    def emptyStat():
+        return np.full(nZones, np.nan)
+
+    if 'count' in statsList:
+        stats['count'] = counts
+
+    needSum = [s for s in statsList if s in ('sum', 'mean', 'std')]
+    if needSum:
+
+        sums = np.bincount(validZones, weights = validValues,
+                                                         minlength = nZones)
+        means = np.zeros(nZones)
+        means[hasData] = sums[hasData] / counts[hasData]
+
+        if 'sum' in statsList:
+            stats['sum'] = emptyStat()
+            stats['sum'][hasData] = sums[hasData]
+
+        if 'mean' in statsList:
+            stats['mean'] = emptyStat()
+            stats['mean'][hasData] = means[hasData]
+
+        if 'std' in statsList:
+            dev = validValues - means[validZones]
+            var = np.bincount(validZones, weights = dev * dev,
+                                                         minlength = nZones)
+            stats['std'] = emptyStat()
+            stats['std'][hasData] = np.sqrt(var[hasData] / counts[hasData])
+
+    # One segmented sort serves min/max/range/median/percentiles
+    needSort = [s for s in statsList if s in ('min', 'max', 'range', 'median')
+                                          or s.startswith('percentile_')]
+    needCount = [s for s in statsList if s in
+                                         ('majority', 'minority', 'unique')]
+
+    sortedValues, starts = None, None
+    if needSort or (needCount and
+                    not np.issubdtype(validValues.dtype, np.integer)):
+
+        order = np.lexsort((validValues, validZones))
+        sortedValues = validValues[order]
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    zStarts, zCounts = None, None
+    if sortedValues is not None:
+        zStarts, zCounts = starts[hasData], counts[hasData]
+
+    for stat in needSort:
+
+        stats[stat] = emptyStat()
+
+        if stat == 'min':
+            stats[stat][hasData] = sortedValues[zStarts]
+        elif stat == 'max':
+            stats[stat][hasData] = sortedValues[zStarts + zCounts - 1]
+        elif stat == 'range':
+            stats[stat][hasData] = \
+                        sortedValues[zStarts + zCounts - 1].astype(np.float64) \
+                                     - sortedValues[zStarts].astype(np.float64)
+        elif stat == 'median':
+            stats[stat][hasData] = percentileFromSorted(sortedValues,
+                                                        zStarts, zCounts, 50.0)
+        else:
+            stats[stat][hasData] = percentileFromSorted(sortedValues,
+                                      zStarts, zCounts, get_percentile(stat))
+
+    if needCount:
+
+        majority, minority, unique = countStats(validValues, validZones,
+                                    nZones, sortedValues, starts, counts)
+
+        for stat, result in zip(('majority', 'minority', 'unique'),
+                                                (majority, minority, unique)):
+            if stat in statsList:
+                stats[stat] = emptyStat()
+                stats[stat][hasData] = result[hasData]
+
+    # These count masked pixels so are filled even for empty zones
+    if 'nodata' in statsList:
+        stats['nodata'] = np.bincount(zoneIds, weights = isNoData,
+                                                     minlength = nZones)
+    if 'nan' in statsList:
+        stats['nan'] = np.bincount(zoneIds, weights = isNan,
+                                                     minlength = nZones)
+
+    return stats
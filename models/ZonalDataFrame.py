@@ -34,7 +34,8 @@ import geopandas as gpd
 
 from rasterstats import zonal_stats
 
-from models.RasterStats import ZonalStats
+from models.RasterStats import ZonalStats, ZonalStatsChunks, LabelStats, \
+                                                                    PointStats
 from models.FeatureClass import FeatureClass
 from models.Raster import Raster
 
@@ -55,8 +56,19 @@ class ZonalDataFrame(object):
     #--------------------------------------------------------------------------
     # __init__
     #--------------------------------------------------------------------------
+    # footprint: optional valid data polygon of raster (in extentEpsg), 
+    #  ATL08 zones outside it are not loaded
+    # labels: for Disturbance, build a label image of the patches instead of
+    #  polygons (see labelStats()). Patch polygons are only made if 
+    #  labelGeometry (e.g. if a .shp will be written)
+    # workers: processes for building (Disturbance polygonizing)
+    # simplify: for Disturbance, tolerance (in pixels) to simplify patches with
+    # columns: for ATL08, list of attribute columns to load (None for all)
     def __init__(self, zonalType, extent, extentEpsg, tmpDir=None, region='na', 
-                                                            existingGdf = None):
+                                          existingGdf = None, footprint = None,
+                                          labels = False, labelGeometry = True,
+                                          workers = 1, simplify = None,
+                                          columns = None):
         
         # First ensure passed zonal name is valid
         if zonalType not in ZonalDataFrame.VALID_ZONAL_TYPES:
@@ -75,12 +87,37 @@ class ZonalDataFrame(object):
             elif self.region == 'ea':
                 self.zonalDir = '/explore/nobackup/people/pmontesa/userfs02/data/icesat2/atl08.005/boreal_ea_20m'
 
+            # Parquet store of the same .csv files, see 
+            # scripts/create_atl08_v005_parquet_store.py. If a granule is
+            # not in the store, the .csv is read instead
+            self.storeDir = '/explore/nobackup/people/mwooten3/3DSI/ZonalStats_2022/ATL08/_parquetStore'
+
+            # Shots from the same .csv files in 1x1 degree tiles, see 
+            # scripts/create_atl08_v005_tile_store.py. Used over the granules 
+            # if the tile manifest exists
+            self.tileDir = os.path.join('/explore/nobackup/people/mwooten3/3DSI/ZonalStats_2022/ATL08/_tileStore',
+                                                  os.path.basename(self.zonalDir))
+
+        # Disturbance patches of every Landsat tile, polygonized once and 
+        # shared by all stacks in the region (see buildZdf_disturbance)
+        elif self.zonalType == 'Disturbance':
+            self.storeDir = os.path.join('/explore/nobackup/people/mwooten3/3DSI/ZonalStats_2022/Disturbance/_patchStore',
+                                                                  self.region)
+
         self.rasterExtent = extent # Extent of the ZDF = raster we are interested in
         self.rasterEpsg   = extentEpsg
+        self.footprint    = footprint
+        
+        self.labels        = labels
+        self.labelGeometry = labelGeometry
+        self.labelDs       = None # Set by build if labels
+        self.workers       = workers
+        self.simplify      = simplify
+        self.columns       = columns
         
         # Does it make since to automatically build dataframe upon instantiation?
         # If one is not passed, build it
-        if not existingGdf:
+        if existingGdf is None:
             self.data = self.buildZonalDataFrame()
         # If one is passed, check to see if it's GDF
         # This is stupid right? lol who knows
@@ -106,16 +143,32 @@ class ZonalDataFrame(object):
         
         if self.zonalType == 'ATL08-20m':
             from functions.buildZdf_atl08v5 import buildZdf
-            return buildZdf(self.rasterExtent, self.rasterEpsg, self.zonalDir, segLength = 20)
+            return buildZdf(self.rasterExtent, self.rasterEpsg, self.zonalDir, 
+                                   segLength = 20, storeDir = self.storeDir,
+                                   columns = self.columns, 
+                                   tileDir = self.tileDir,
+                                   footprint = self.footprint)
         
         elif self.zonalType == 'ATL08-100m':
             from functions.buildZdf_atl08v5 import buildZdf
-            return buildZdf(self.rasterExtent, self.rasterEpsg, self.zonalDir, segLength = 100)
+            return buildZdf(self.rasterExtent, self.rasterEpsg, self.zonalDir, 
+                                segLength = 100, columns = self.columns,
+                                footprint = self.footprint)
+        
+        elif self.zonalType == 'Disturbance' and self.labels:
+            from functions.buildZdf_disturbance import buildLabelZdf
+            (gdf, self.labelDs) = buildLabelZdf(self.rasterExtent, 
+                                    self.rasterEpsg, self.tempDir, self.region,
+                                    withGeometry = self.labelGeometry,
+                                    simplify = self.simplify)
+            return gdf
         
         elif self.zonalType == 'Disturbance':
             from functions.buildZdf_disturbance import buildZdf
             return buildZdf(self.rasterExtent, self.rasterEpsg, self.tempDir, 
-                                                                    self.region)
+                                    self.region, storeDir = self.storeDir,
+                                    workers = self.workers, 
+                                    simplify = self.simplify)
          
         else:
             print("Build function for {} does not yet exist.".format(self.zonalType))
@@ -143,25 +196,37 @@ class ZonalDataFrame(object):
     # pointsToPolygon()
     #  Convert the point geodataframe to polygons
     #  Method depends on what we are converting
+    #  20m segments use the footprints stored with the points at ingest, if 
+    #  they are there, instead of rebuilding them (shots from .csv granules 
+    #  not in the store are still built from the points)
+    #  Segments are made in the raster projection if it is projected, so 
+    #  ZonalStats doesn't have to reproject them (otherwise local UTM)
     #--------------------------------------------------------------------------
     def pointsToPolygon(self):
         
-        from functions.pointsToPolygons_atl08v5 import pointsToSegments
+        from functions.pointsToPolygons_atl08v5 import pointsToSegments, \
+                   footprintsToSegments, hasSegmentFootprints, GRANULE_FIELD
         
-        # keep utm projected gdf for both
+        # keep raster (or utm) projected gdf for both
         if self.zonalType == 'ATL08-20m':
-            gdf = pointsToSegments(self.data, segLength = 20, 
-                                                          returnSrcPrj = False)
+            if hasSegmentFootprints(self.data):
+                gdf = footprintsToSegments(self.data, segLength = 20,
+                                                  dstEpsg = self.rasterEpsg)
+            else:
+                gdf = pointsToSegments(self.data, segLength = 20, 
+                             returnSrcPrj = False, dstEpsg = self.rasterEpsg)
 
         elif self.zonalType == 'ATL08-100m':
             gdf = pointsToSegments(self.data, segLength = 100, 
-                                                          returnSrcPrj = False)
+                             returnSrcPrj = False, dstEpsg = self.rasterEpsg)
  
         else:
             print("toPolygon function for {} does not yet exist.".format(self.zonalType))
             return None
         
-        self.data = gdf
+        # Granule name was only needed to build segments per granule/track, 
+        # outputs keep the columns of the ATL08 .csv's
+        self.data = gdf.drop(columns = GRANULE_FIELD, errors = 'ignore')
         
         # Reset other attributes:
         #* TD remove from init
@@ -172,24 +237,53 @@ class ZonalDataFrame(object):
     # pointStats()
     #  Given a raster, get point stats for each vector feature in ZDF
     #--------------------------------------------------------------------------
-    def pointStats(self, raster, layerDict = None):
+    def pointStats(self, raster, layerDict = None, workers = 1):
         
-        from RasterStats import PointStats
+        from functions.pointsToPolygons_atl08v5 import GRANULE_FIELD
         
-        pointStatsDf = PointStats(self.data, raster, layerDict)
+        # Granule name (ATL08) is not an output column
+        pointStatsDf = PointStats(self.data.drop(columns = GRANULE_FIELD, 
+                           errors = 'ignore'), raster, layerDict, workers)
         
         return pointStatsDf
 
     #--------------------------------------------------------------------------
     # zonalStats()
     #  Given a raster, get zonal stats for each vector feature in ZDF
+    #  Optionally cache zone coverage in coverageCache (see CoverageIndex)
+    #  and process shards of zones on several workers
     #--------------------------------------------------------------------------
-    def zonalStats(self, raster, layerDict = None):
+    def zonalStats(self, raster, layerDict = None, coverageCache = None, 
+                                                                 workers = 1):
         
-        zonalStatsDf = ZonalStats(self.data, raster, layerDict)
+        zonalStatsDf = ZonalStats(self.data, raster, layerDict, coverageCache,
+                                                                     workers)
         
         return zonalStatsDf
 
+    #--------------------------------------------------------------------------
+    # zonalStatsChunks()
+    #  Same as zonalStats() but yields result geodataframes chunkSize zones
+    #  at a time, so outputs can be written as they are computed
+    #--------------------------------------------------------------------------
+    def zonalStatsChunks(self, raster, layerDict = None, chunkSize = 50000,
+                                          coverageCache = None, workers = 1):
+        
+        return ZonalStatsChunks(self.data, raster, layerDict, chunkSize, 
+                                                  coverageCache, workers)
+
+    #--------------------------------------------------------------------------
+    # labelStats()
+    #  Given a raster, get zonal stats for each patch of a ZDF that was built
+    #  with labels, from the label image (no zone rasterization)
+    #--------------------------------------------------------------------------
+    def labelStats(self, raster, layerDict = None):
+        
+        if self.labelDs is None:
+            raise RuntimeError("labelStats requires a ZDF built with labels")
+        
+        return LabelStats(self.data, self.labelDs, raster, layerDict)
+
     def nFeatures(self):
         
         return len(self.data.index)
@@ -0,0 +1,472 @@
+# -*- coding: utf-8 -*-
+"""
+ZonalEngine computes zonal statistics for every requested band of a raster
+    stack in a single pass over the zones
+
+rasterstats.zonal_stats only works on one band at a time, so calling it once
+    per layer reopens the stack, re-rasterizes every zone and re-reads the same
+    windows for every band. Here each zone is rasterized once and its window
+    is read once (all requested bands in one RasterIO call), then stats are
+    computed for every band from that one read, for all zones at once with
+    the grouped kernels in StatKernels
+
+Zones are rasterized into a CoverageIndex (flattened pixel indices per zone).
+    The index for all zones of a stack can be cached in one file
+    (zoneCoverage), so re-runs on the same grid/zones only gather pixel values
+
+Stat names and semantics follow rasterstats so output columns are identical:
+    - https://pythonhosted.org/rasterstats/manual.html#statistics
+    - pixels equal to nodata (and NaN for float rasters) are excluded
+    - zones with no valid pixels get NaN for every stat (0 for count)
+    - the 'nodata' stat only counts pixels inside the raster (rasterstats also
+      counts the part of a zone hanging off the raster edge)
+
+pointValuesMultiBand does the same for point mode: all points are turned into
+    row/col with one inverse geotransform, grouped by raster block, and each
+    block is read once for all bands (instead of one point_query per point per
+    band)
+
+labelStatsMultiBand is the label image version of zonal mode (disturbance
+    patches): instead of rasterizing zone polygons, a label image (one int
+    label per zone, 0 = none) is resampled onto the raster grid in row chunks
+    (nearest), and every raster pixel goes to the label at its center. Values
+    are grouped by label into the same CSR layout and the same kernels are
+    used. Pixels are assigned by their center, not all_touched, so edge pixels
+    of a patch can differ from the polygon (zonalStatsMultiBand) result
+
+Zonal/point modes can run in parallel (workers > 1): zones are split into
+    spatially compact shards (ordered by the raster block their center falls
+    in), shards are processed in a process pool where each worker opens its
+    own GDAL handle, and results are merged back in the original row order.
+    Callers that make several calls for one stack (e.g. one per chunk) create
+    the pool once and pass it in as executor
+
+NOTE:
+    layers expects a list of (layerN, layerName, statsList) tuples, which is
+    built from the layerDict in RasterStats.ZonalStats. For point mode,
+    layers is a list of (layerN, layerName) tuples
+"""
+import math
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from osgeo import gdal, gdal_array
+from rasterstats.utils import check_stats
+
+from models.Raster import Raster
+from models.CoverageIndex import CoverageIndex, gridSignature, zoneHash
+from models.StatKernels import groupedStats
+
+# Shards per worker when running in parallel. More shards than workers so a
+# worker that draws a cheap part of the raster picks up another shard
+SHARDS_PER_WORKER = 4
+
+# Raster rows per chunk when resampling a label image onto the raster grid
+LABEL_CHUNK_ROWS = 1024
+
+#--------------------------------------------------------------------------
+# readWindow()
+#  Read all requested bands for a pixel window with one RasterIO call
+#  Returns array shaped (nBands, ysize, xsize), of GDAL type bufType if
+#  supplied (e.g. a type that holds every band of a mixed type stack)
+#--------------------------------------------------------------------------
+def readWindow(dataset, window, bands, bufType = None):
+
+    (xoff, yoff, xsize, ysize) = window
+
+    arr = dataset.ReadAsArray(xoff, yoff, xsize, ysize, band_list = bands,
+                                                          buf_type = bufType)
+
+    # GDAL drops the band axis when only one band is read
+    return arr.reshape(len(bands), ysize, xsize)
+
+#--------------------------------------------------------------------------
+# gatherValues()
+#  Read the pixel values covered by every zone of a CoverageIndex, all bands
+#  at once. Returns array shaped (nBands, nPixels) aligned with
+#  coverage.pixels, i.e. values[:, offsets[i]:offsets[i+1]] is zone i
+#--------------------------------------------------------------------------
+def gatherValues(dataset, coverage, bands):
+
+    values = None
+
+    # Visit zones in pixel order so neighbouring reads are served from 
+    # GDAL's block cache
+    nonEmpty = np.flatnonzero(np.diff(coverage.offsets) > 0)
+    firstPixel = coverage.pixels[coverage.offsets[nonEmpty]]
+
+    for i in nonEmpty[np.argsort(firstPixel, kind = 'stable')]:
+
+        rows, cols = coverage.zonePixels(i)
+
+        # Read bounding window of the zone's pixels for all bands
+        (rowStart, colStart) = (rows.min(), cols.min())
+        window = (int(colStart), int(rowStart), 
+                  int(cols.max() - colStart + 1), 
+                  int(rows.max() - rowStart + 1))
+        
+        arr = readWindow(dataset, window, bands)
+
+        if values is None:
+            values = np.zeros((len(bands), len(coverage.pixels)), 
+                                                             dtype = arr.dtype)
+
+        values[:, coverage.offsets[i]:coverage.offsets[i+1]] = \
+                                      arr[:, rows - rowStart, cols - colStart]
+
+    # No zone touched the raster
+    if values is None:
+        values = np.zeros((len(bands), 0))
+
+    return values
+
+#--------------------------------------------------------------------------
+# shardZones()
+#  Split zones into nShards spatially compact groups of about equal size.
+#  Zones are ordered by the raster block their center falls in (block rows,
+#  then block columns) so each shard reads a compact set of blocks
+#  Returns list of arrays of row positions in zonalDf
+#--------------------------------------------------------------------------
+def shardZones(zonalDf, rasterObj, nShards):
+
+    bounds = zonalDf.geometry.bounds.fillna(0)
+
+    rows, cols = pointToPixel((bounds['minx'] + bounds['maxx']) / 2.0,
+                              (bounds['miny'] + bounds['maxy']) / 2.0,
+                              rasterObj.ogrGeotransform)
+
+    (xBlock, yBlock) = rasterObj.dataset.GetRasterBand(1).GetBlockSize()
+
+    order = np.lexsort((cols // xBlock, rows // yBlock))
+
+    return [shard for shard in np.array_split(order, nShards) if len(shard)]
+
+#--------------------------------------------------------------------------
+# runShards()
+#  Run function(shardDf, raster, **kwargs) for each shard in a process pool
+#  and merge the returned column dicts back into the original row order
+#  shardKwargs is an optional list of extra kwargs, one dict per shard
+#  If executor (process pool) is None, a pool of workers is made for this call
+#--------------------------------------------------------------------------
+def runShards(function, zonalDf, raster, shards, workers, executor = None, 
+                                               shardKwargs = None, **kwargs):
+
+    if executor is None:
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+            return runShards(function, zonalDf, raster, shards, workers,
+                             executor, shardKwargs, **kwargs)
+
+    if shardKwargs is None:
+        shardKwargs = [{}] * len(shards)
+
+    futures = [executor.submit(function, zonalDf.iloc[shard], raster,
+                               **dict(kwargs, **extra))
+                           for (shard, extra) in zip(shards, shardKwargs)]
+    results = [future.result() for future in futures]
+
+    order = np.concatenate(shards)
+
+    columns = {}
+    for key in results[0]:
+
+        merged = np.concatenate([result[key] for result in results])
+
+        columns[key] = np.empty_like(merged)
+        columns[key][order] = merged
+
+    return columns
+
+#--------------------------------------------------------------------------
+# shardCoverage()
+#  Build the CoverageIndex of a shard of zones, returned as a column dict
+#  ({'counts', 'pixels'}) for runShards. Pixels are split per zone so the
+#  merged 'pixels' column can be put back in row order
+#--------------------------------------------------------------------------
+def shardCoverage(zonalDf, raster, allTouched = True):
+
+    coverage = CoverageIndex.build(list(zonalDf.geometry), Raster(raster), 
+                                                                   allTouched)
+
+    pixels = np.empty(coverage.nZones, dtype = object)
+    pixels[:] = np.split(coverage.pixels, coverage.offsets[1:-1])
+
+    return {'counts': np.diff(coverage.offsets), 'pixels': pixels}
+
+#--------------------------------------------------------------------------
+# zoneCoverage()
+#  Get the CoverageIndex of every zone in a geodataframe (already in the
+#  raster projection). If cacheFile is supplied, the index is loaded from
+#  there if it was built for the same zones/grid, otherwise it is built and
+#  written there. If workers > 1, shards of zones are rasterized in a
+#  process pool (executor, or one made for this call)
+#--------------------------------------------------------------------------
+def zoneCoverage(zonalDf, raster, allTouched = True, cacheFile = None,
+                                               workers = 1, executor = None):
+
+    rasterObj = Raster(raster)
+    geoms = list(zonalDf.geometry)
+
+    if cacheFile:
+        coverage = CoverageIndex.fromCache(cacheFile, geoms, rasterObj, 
+                                                                   allTouched)
+        if coverage is not None:
+            return coverage
+
+    if workers > 1 and len(zonalDf) > workers:
+        shards = shardZones(zonalDf, rasterObj, workers * SHARDS_PER_WORKER)
+        parts = runShards(shardCoverage, zonalDf, raster, shards, workers,
+                                  executor, allTouched = allTouched)
+        
+        offsets = np.r_[0, np.cumsum(parts['counts'])].astype(np.int64)
+        if len(parts['pixels']):
+            pixels = np.concatenate(list(parts['pixels']))
+        else:
+            pixels = np.zeros(0, dtype = np.int64)
+            
+        coverage = CoverageIndex(offsets, pixels, rasterObj.nRows, 
+                                 rasterObj.nColumns, 
+                                 signature = gridSignature(rasterObj),
+                                 zoneHash = zoneHash(geoms, allTouched))
+    else:
+        coverage = CoverageIndex.build(geoms, rasterObj, allTouched)
+
+    if cacheFile:
+        coverage.save(cacheFile)
+
+    return coverage
+
+#--------------------------------------------------------------------------
+# zonalStatsMultiBand()
+#  Given a geodataframe (already in the raster projection), raster and
+#  list of (layerN, layerName, statsList), return dict where
+#  key = '{layerName}_{stat}' and value = array of stat values (one per row)
+#
+#  If coverage (CoverageIndex of the rows of zonalDf, e.g. from
+#  zoneCoverage) is supplied, zones are not rasterized again
+#  If workers > 1, shards of zones are processed in a process pool
+#  (executor, or one made for this call)
+#--------------------------------------------------------------------------
+def zonalStatsMultiBand(zonalDf, raster, layers, allTouched = True,
+                        nodata = None, coverage = None, workers = 1, 
+                                                             executor = None):
+
+    rasterObj = Raster(raster)
+
+    # Validate stats up front, same as rasterstats would for each band
+    for (layerN, layerName, statsList) in layers:
+        check_stats(statsList, False)
+        
+    if workers > 1 and len(zonalDf) > workers:
+        shards = shardZones(zonalDf, rasterObj, workers * SHARDS_PER_WORKER)
+        shardKwargs = None
+        if coverage is not None:
+            shardKwargs = [{'coverage': coverage.subset(shard)} 
+                                                          for shard in shards]
+        return runShards(zonalStatsMultiBand, zonalDf, raster, shards, 
+                         workers, executor, shardKwargs, layers = layers, 
+                         allTouched = allTouched, nodata = nodata)
+
+    bands = [int(layerN) for (layerN, layerName, statsList) in layers]
+
+    columns = {}
+
+    # Get pixels covered by each zone (rasterizes each zone once)
+    if coverage is None:
+        coverage = CoverageIndex.build(list(zonalDf.geometry), rasterObj, 
+                                                                   allTouched)
+
+    # Gather pixel values for every zone into flat arrays aligned with the
+    # coverage index --> values[b, offsets[i]:offsets[i+1]] for zone i/band b
+    values = gatherValues(rasterObj.dataset, coverage, bands)
+
+    # Then compute each stat for all zones at once, band by band
+    for b, (layerN, layerName, statsList) in enumerate(layers):
+
+        stats = groupedStats(values[b], coverage.offsets, statsList, nodata)
+
+        for stat in statsList:
+            columns['{}_{}'.format(layerName, stat)] = stats[stat]
+
+    return columns
+
+#--------------------------------------------------------------------------
+# labelStatsMultiBand()
+#  Given a label image dataset (int labels 1..nLabels, 0 = no zone), raster
+#  and list of (layerN, layerName, statsList), return dict where
+#  key = '{layerName}_{stat}' and value = array of stat values (one per
+#  label, i.e. row i is label i+1). The label image is resampled onto the
+#  raster grid chunkRows rows at a time (nearest), so only one chunk of the
+#  resampled labels/values is in memory before grouping. Assumes a north-up
+#  raster grid
+#--------------------------------------------------------------------------
+def labelStatsMultiBand(labelDs, nLabels, raster, layers, nodata = None,
+                                            chunkRows = LABEL_CHUNK_ROWS):
+
+    rasterObj = Raster(raster)
+    dataset = rasterObj.dataset
+
+    for (layerN, layerName, statsList) in layers:
+        check_stats(statsList, False)
+
+    bands = [int(layerN) for (layerN, layerName, statsList) in layers]
+
+    (ulx, xres, xskew, uly, yskew, yres) = rasterObj.ogrGeotransform
+    nColumns = rasterObj.nColumns
+
+    labelParts = []
+    valueParts = []
+
+    for rowStart in range(0, rasterObj.nRows, chunkRows):
+
+        nChunkRows = min(chunkRows, rasterObj.nRows - rowStart)
+
+        top = uly + rowStart * yres
+        bounds = (ulx, top + nChunkRows * yres, ulx + nColumns * xres, top)
+
+        chunkDs = gdal.Warp('', labelDs, format = 'MEM',
+                            outputBounds = bounds, width = nColumns,
+                            height = nChunkRows, 
+                            dstSRS = dataset.GetProjection(),
+                            resampleAlg = 'near', srcNodata = 0, 
+                            dstNodata = 0)
+        chunkLabels = chunkDs.ReadAsArray()
+        chunkDs = None
+
+        inZone = chunkLabels > 0
+        if not inZone.any():
+            continue
+
+        arr = readWindow(dataset, (0, rowStart, nColumns, nChunkRows), bands)
+
+        labelParts.append(chunkLabels[inZone])
+        valueParts.append(arr[:, inZone])
+
+    if labelParts:
+        labels = np.concatenate(labelParts)
+        values = np.concatenate(valueParts, axis = 1)
+    else:
+        labels = np.zeros(0, dtype = np.int64)
+        values = np.zeros((len(bands), 0))
+
+    del labelParts, valueParts
+
+    # Group pixels by label --> values[b, offsets[i]:offsets[i+1]] is label i+1
+    order = np.argsort(labels, kind = 'stable')
+    counts = np.bincount(labels, minlength = nLabels + 1)[1:nLabels + 1]
+    offsets = np.r_[0, np.cumsum(counts)]
+
+    values = values[:, order]
+
+    columns = {}
+    for b, (layerN, layerName, statsList) in enumerate(layers):
+
+        stats = groupedStats(values[b], offsets, statsList, nodata)
+
+        for stat in statsList:
+            columns['{}_{}'.format(layerName, stat)] = stats[stat]
+
+    return columns
+
+#--------------------------------------------------------------------------
+# pointToPixel()
+#  Convert arrays of x/y coordinates to row/col indices with one inverse
+#  geotransform. Uses floor, same as rasterstats point_query 'nearest'
+#--------------------------------------------------------------------------
+def pointToPixel(xx, yy, geotransform):
+
+    (ulx, xres, xskew, uly, yskew, yres) = geotransform
+
+    cols = np.floor((np.asarray(xx, dtype = float) - ulx) / xres)
+    rows = np.floor((np.asarray(yy, dtype = float) - uly) / yres)
+
+    return rows.astype(np.int64), cols.astype(np.int64)
+
+#--------------------------------------------------------------------------
+# pointValuesMultiBand()
+#  Given a point geodataframe (already in the raster projection), raster and
+#  list of (layerN, layerName), return dict where key = layerName and
+#  value = array of pixel values (one per row). Points are grouped by raster
+#  block and each block is read once for all bands. Points on nodata/NaN or
+#  outside the raster get NaN, same as None from rasterstats point_query
+#  If workers > 1, shards of points are processed in a process pool
+#  (executor, or one made for this call)
+#--------------------------------------------------------------------------
+def pointValuesMultiBand(zonalDf, raster, layers, nodata = None, 
+                                               workers = 1, executor = None):
+
+    rasterObj = Raster(raster)
+    dataset = rasterObj.dataset
+    
+    if workers > 1 and len(zonalDf) > workers:
+        shards = shardZones(zonalDf, rasterObj, workers * SHARDS_PER_WORKER)
+        return runShards(pointValuesMultiBand, zonalDf, raster, shards, 
+                         workers, executor, layers = layers, nodata = nodata)
+
+    bands = [int(layerN) for (layerN, layerName) in layers]
+
+    rows, cols = pointToPixel(zonalDf.geometry.x, zonalDf.geometry.y,
+                                                    rasterObj.ogrGeotransform)
+
+    nPoints = len(rows)
+    inside = (rows >= 0) & (rows < rasterObj.nRows) & \
+             (cols >= 0) & (cols < rasterObj.nColumns)
+
+    # Bands of a stack can have different types: values are read in a type
+    # that holds all of them, then masked where invalid
+    typeCodes = [gdal_array.GDALTypeCodeToNumericTypeCode(
+                         dataset.GetRasterBand(b).DataType) for b in bands]
+    commonType = np.result_type(*typeCodes)
+    bufType = gdal_array.NumericTypeCodeToGDALTypeCode(commonType)
+    
+    values = np.zeros((len(bands), nPoints), dtype = commonType)
+    valid = inside.copy()
+
+    # Group points by block so each block is read once for all bands
+    (xBlock, yBlock) = dataset.GetRasterBand(bands[0]).GetBlockSize()
+    nxBlocks = int(math.ceil(rasterObj.nColumns / float(xBlock)))
+
+    idx = np.nonzero(inside)[0]
+    blockIds = (rows[idx] // yBlock) * nxBlocks + (cols[idx] // xBlock)
+
+    order = np.argsort(blockIds, kind = 'stable')
+    idx, blockIds = idx[order], blockIds[order]
+
+    # Start of each run of points that share a block
+    starts = np.flatnonzero(np.r_[True, blockIds[1:] != blockIds[:-1]])
+    if len(idx) == 0:
+        starts = starts[:0]
+    stops  = np.r_[starts[1:], len(idx)]
+
+    for start, stop in zip(starts, stops):
+
+        blockIdx = idx[start:stop]
+        blockRow, blockCol = divmod(int(blockIds[start]), nxBlocks)
+
+        xoff, yoff = blockCol * xBlock, blockRow * yBlock
+        window = (xoff, yoff, min(xBlock, rasterObj.nColumns - xoff),
+                              min(yBlock, rasterObj.nRows - yoff))
+
+        arr = readWindow(dataset, window, bands, bufType)
+
+        values[:, blockIdx] = arr[:, rows[blockIdx] - yoff,
+                                     cols[blockIdx] - xoff]
+
+    columns = {}
+    for b, (layerN, layerName) in enumerate(layers):
+
+        bandValid = valid.copy()
+        if nodata is not None:
+            bandValid &= (values[b] != nodata)
+        if np.issubdtype(commonType, np.floating):
+            bandValid &= ~np.isnan(values[b])
+
+        # Keep the band's own dtype (e.g. int layers) when every point is 
+        # valid
+        if bandValid.all():
+            columns[layerName] = values[b].astype(typeCodes[b])
+        else:
+            columns[layerName] = np.where(bandValid, values[b], np.nan)
+
+    return columns
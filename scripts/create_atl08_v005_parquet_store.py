@@ -0,0 +1,161 @@
+#! /usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+# Given a directory with extracted/filtered ATL08 v5 .csv files, convert
+#  the .csv files into a columnar (Parquet) store so that buildZdf can read
+#  just the columns/rows it needs instead of parsing every .csv in full
+
+# PROCESS:
+## 1. Run through all .csv files in a given directory (<indir>/<yyyy>/*.csv)
+## 2. Read .csv and add 20m segment heading/footprint corners (per 
+##    track/beam, see pointsToPolygons_atl08v5.addSegmentFootprints) so 
+##    segment polygons don't have to be rebuilt for every stack
+## 3. Convert columns to compact dtypes (smallest int, category for repeated
+##    strings). Floats stay float64 so outputs match the .csv source, unless
+##    -float32 is passed (lat/lon/corner fields are always kept as float64)
+## 4. Write to <outdir>/<basename(indir)>/<yyyy>/<name>.parquet in small row
+##    groups, so min/max lat/lon statistics let readers skip most of a granule
+
+# The output dir mirrors the .csv tree, e.g.:
+#   boreal_na_20m/2019/ATL08_....csv --> <outdir>/boreal_na_20m/2019/ATL08_....parquet
+# so buildZdf_atl08v5.getStorePath() can find the .parquet for a .csv path
+# from the footprints index. Run once each for boreal_na_20m and boreal_ea_20m
+
+# Requires pyarrow
+
+import os, glob
+
+import argparse
+
+import time
+
+import numpy as np
+import pandas as pd
+
+from functions.pointsToPolygons_atl08v5 import addSegmentFootprints, \
+                                  FOOTPRINT_X_FIELDS, FOOTPRINT_Y_FIELDS
+
+# Rows per Parquet row group. ATL08 rows are ordered along track, so small
+# row groups have tight lat/lon ranges and can be skipped when filtering
+ROW_GROUP_SIZE = 20000
+
+# Fields that must keep full precision (float32 is ~1m in lat/lon)
+COORD_FIELDS = ['lat', 'lon', 'lat_20m', 'lon_20m'] + \
+                                        FOOTPRINT_X_FIELDS + FOOTPRINT_Y_FIELDS
+
+def calculateElapsedTime(start, end, unit = 'minutes'):
+
+    # start and end = time.time()
+
+    if unit == 'minutes':
+        elapsedTime = round((time.time()-start)/60, 4)
+    elif unit == 'hours':
+        elapsedTime = round((time.time()-start)/60/60, 4)
+    else:
+        elapsedTime = round((time.time()-start), 4)
+        unit = 'seconds'
+
+    print("Elapsed time: {} {}".format(elapsedTime, unit))
+
+    return None
+
+# Convert dataframe columns to compact dtypes. Integers and strings are
+# stored without loss, floats are only cast to float32 if float32
+def compactDtypes(df, float32 = False):
+
+    for col in df.columns:
+
+        if col in COORD_FIELDS:
+            continue
+
+        if pd.api.types.is_float_dtype(df[col]):
+            if float32:
+                df[col] = df[col].astype(np.float32)
+
+        elif pd.api.types.is_integer_dtype(df[col]):
+            df[col] = pd.to_numeric(df[col], downcast = 'integer')
+
+        # Repeated strings (e.g. beam/gt) are much smaller as categories
+        elif pd.api.types.is_object_dtype(df[col]):
+            if df[col].nunique() < 0.5 * len(df.index):
+                df[col] = df[col].astype('category')
+
+    return df
+
+# Convert one .csv to .parquet. Write to temp file and rename so a partially
+# written file is never picked up by buildZdf
+def csvToParquet(incsv, outParquet, float32 = False):
+
+    df = addSegmentFootprints(pd.read_csv(incsv))
+    df = compactDtypes(df, float32)
+
+    os.system('mkdir -p {}'.format(os.path.dirname(outParquet)))
+
+    tmpParquet = '{}.tmp'.format(outParquet)
+    df.to_parquet(tmpParquet, index = False, row_group_size = ROW_GROUP_SIZE)
+    os.replace(tmpParquet, outParquet)
+
+    return len(df.index)
+
+def create_atl08_store(args):
+
+    print("\nBegin: {}\n".format(time.strftime("%m-%d-%y %I:%M:%S %p")))
+
+    # Start clock
+    start = time.time()
+
+    indir = args.input.rstrip('/')
+    outdir = os.path.join(args.output, os.path.basename(indir))
+
+    overwrite = args.overwrite
+
+    #* NOTE: we expect .csv files to be structured like <indir>/<yyyy>/*csv
+    incsvs = glob.glob(os.path.join(indir, '*', 'ATL08*.csv'))
+    print("Converting {} .csv files to .parquet".format(len(incsvs)))
+    print("Output store: {}\n".format(outdir))
+
+    nRows = 0
+    nSkip = 0
+    for c, incsv in enumerate(incsvs):
+
+        yearDir = os.path.basename(os.path.dirname(incsv))
+        outParquet = os.path.join(outdir, yearDir,
+                      os.path.basename(incsv).replace('.csv', '.parquet'))
+
+        if os.path.isfile(outParquet) and not overwrite:
+            nSkip += 1
+            continue
+
+        try:
+            nRows += csvToParquet(incsv, outParquet, args.float32)
+        except (pd.errors.ParserError, pd.errors.EmptyDataError) as e:
+            print("   Problem converting file {}: {}".format(incsv, e))
+            continue
+
+        if (c+1) % 500 == 0:
+            print(" {}/{}".format(c+1, len(incsvs)))
+
+    print("\nWrote {} rows. Skipped {} existing files".format(nRows, nSkip))
+    print("\nEnd: {}\n".format(time.strftime("%m-%d-%y %I:%M:%S %p")))
+
+    calculateElapsedTime(start, time.time(), 'seconds')
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", type=str, required=True,
+                         help="Specify the input directory with the .csv files")
+    parser.add_argument("-o", "--output", type=str, required=True,
+                                 help="Specify the output store directory")
+    parser.add_argument("-overwrite", "--overwrite", action='store_true',
+                                help="Overwrite existing .parquet files")
+    parser.add_argument("-float32", "--float32", action='store_true',
+          help="Store non-coordinate floats as float32 (smaller, but values no longer match the .csv exactly)")
+
+    args = parser.parse_args()
+
+    create_atl08_store(args)
+
+if __name__ == "__main__":
+    main()
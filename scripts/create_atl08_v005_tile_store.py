@@ -0,0 +1,214 @@
+#! /usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+# Given a directory with ATL08 v5 granules (.csv or .parquet from
+#  create_atl08_v005_parquet_store.py), re-partition the shots into a fixed
+#  geographic tile grid (TILE_SIZE x TILE_SIZE degrees) so that buildZdf only
+#  reads the shots near a stack instead of whole granules (which are long
+#  ground tracks across the boreal)
+
+# PROCESS:
+## 1. Run through all granules in a given directory (<indir>/<yyyy>/ATL08*)
+##    Granules without segment footprints (.csv) get them added first, while
+##    shots are still in along-track order (see addSegmentFootprints)
+## 2. Assign each shot to a tile using floor(lat/lon) of the 20m lat/lon
+##    and write one part per granule per tile: <outdir>/<tile>/parts/*.parquet
+##    Each shot keeps its granule name (GRANULE_FIELD)
+## 3. Compact the parts of each tile into <outdir>/<tile>.parquet, one
+##    granule after another with shots in along-track order (as in the
+##    granule), and remove the parts. Segments can still be built from
+##    neighbouring shots of a granule/track (pointsToSegments)
+##    The store is always built from scratch (-overwrite to rebuild)
+## 4. Write tile manifest .csv (tile, path, nShots, xmin, ymin, xmax, ymax)
+##    buildZdf_atl08v5.getTileList() uses this to find tiles for a stack
+
+# Tile names look like N52W118 (lower left corner of tile)
+# Run once each for boreal_na_20m and boreal_ea_20m. Requires pyarrow
+
+import os, glob
+import shutil
+
+import argparse
+
+import time
+
+import numpy as np
+import pandas as pd
+
+from functions.pointsToPolygons_atl08v5 import addSegmentFootprints, \
+                                         hasSegmentFootprints, GRANULE_FIELD
+
+# Tile size in degrees
+TILE_SIZE = 1
+
+# Fields used to assign shots to tiles
+LON_FIELD, LAT_FIELD = 'lon_20m', 'lat_20m'
+
+ROW_GROUP_SIZE = 20000
+
+MANIFEST_NAME = 'tile_manifest.csv'
+
+def calculateElapsedTime(start, end, unit = 'minutes'):
+
+    # start and end = time.time()
+
+    if unit == 'minutes':
+        elapsedTime = round((time.time()-start)/60, 4)
+    elif unit == 'hours':
+        elapsedTime = round((time.time()-start)/60/60, 4)
+    else:
+        elapsedTime = round((time.time()-start), 4)
+        unit = 'seconds'
+
+    print("Elapsed time: {} {}".format(elapsedTime, unit))
+
+    return None
+
+# Name of tile with lower left corner (lon, lat)
+def tileName(lon, lat):
+
+    ns = 'N' if lat >= 0 else 'S'
+    ew = 'E' if lon >= 0 else 'W'
+
+    return '{}{:02d}{}{:03d}'.format(ns, abs(int(lat)), ew, abs(int(lon)))
+
+def readGranule(inFile):
+
+    if inFile.endswith('.parquet'):
+        return pd.read_parquet(inFile)
+
+    return pd.read_csv(inFile)
+
+# Split one granule into tile parts. Returns number of shots written
+def granuleToTiles(inFile, outdir):
+
+    df = readGranule(inFile)
+
+    # Footprints are made per track of the whole granule, before tiling
+    if not hasSegmentFootprints(df):
+        df = addSegmentFootprints(df, LON_FIELD, LAT_FIELD)
+
+    # Remove no data lat/lon (see buildZdf_atl08v5.csvToGdf)
+    df = df.loc[(df[LAT_FIELD] != 3.402823466385289e+38)]
+    df = df.loc[(df[LAT_FIELD].abs() <= 90) & (df[LON_FIELD].abs() <= 180)]
+
+    if df.empty:
+        return 0
+
+    tileLon = (np.floor(df[LON_FIELD] / TILE_SIZE) * TILE_SIZE).astype(int)
+    tileLat = (np.floor(df[LAT_FIELD] / TILE_SIZE) * TILE_SIZE).astype(int)
+
+    # Lon = 180 belongs in last tile
+    tileLon = tileLon.clip(upper = 180 - TILE_SIZE)
+
+    granule = os.path.splitext(os.path.basename(inFile))[0]
+    partName = '{}.parquet'.format(granule)
+    
+    df[GRANULE_FIELD] = granule
+
+    for (lon, lat), tileDf in df.groupby([tileLon, tileLat]):
+
+        partDir = os.path.join(outdir, tileName(lon, lat), 'parts')
+        os.system('mkdir -p {}'.format(partDir))
+
+        tileDf.to_parquet(os.path.join(partDir, partName), index = False)
+
+    return len(df.index)
+
+# Combine the parts of a tile into one file and return manifest row
+def compactTile(tileDir):
+
+    tile = os.path.basename(tileDir)
+    parts = sorted(glob.glob(os.path.join(tileDir, 'parts', '*.parquet')))
+
+    outParquet = '{}.parquet'.format(tileDir)
+
+    # Parts are whole granules in along-track order, so they are not sorted
+    # by lat/lon (that would mix up the shots of different tracks)
+    df = pd.concat([pd.read_parquet(p) for p in parts], ignore_index = True)
+
+    tmpParquet = '{}.tmp'.format(outParquet)
+    df.to_parquet(tmpParquet, index = False, row_group_size = ROW_GROUP_SIZE)
+    os.replace(tmpParquet, outParquet)
+
+    shutil.rmtree(tileDir)
+
+    # Path is relative to the tile store so the store can be moved
+    return {'tile': tile, 'path': os.path.basename(outParquet), 'nShots': len(df.index),
+            'xmin': df[LON_FIELD].min(), 'ymin': df[LAT_FIELD].min(),
+            'xmax': df[LON_FIELD].max(), 'ymax': df[LAT_FIELD].max()}
+
+def create_atl08_tiles(args):
+
+    print("\nBegin: {}\n".format(time.strftime("%m-%d-%y %I:%M:%S %p")))
+
+    # Start clock
+    start = time.time()
+
+    indir = args.input.rstrip('/')
+    outdir = os.path.join(args.output, os.path.basename(indir))
+
+    # Tiles are built from scratch, so a granule is never tiled twice
+    if os.path.isdir(outdir):
+        if not args.overwrite:
+            print("Tile store {} already exists. Use -overwrite".format(outdir))
+            return None
+        shutil.rmtree(outdir)
+
+    #* NOTE: we expect granules to be structured like <indir>/<yyyy>/ATL08*
+    inFiles = glob.glob(os.path.join(indir, '*', 'ATL08*.parquet'))
+    if len(inFiles) == 0:
+        inFiles = glob.glob(os.path.join(indir, '*', 'ATL08*.csv'))
+
+    print("Tiling {} granules into {} degree tiles".format(len(inFiles),
+                                                                  TILE_SIZE))
+    print("Output store: {}\n".format(outdir))
+
+    # 1. Split granules into tile parts
+    nShots = 0
+    for c, inFile in enumerate(inFiles):
+
+        try:
+            nShots += granuleToTiles(inFile, outdir)
+        except (pd.errors.ParserError, pd.errors.EmptyDataError) as e:
+            print("   Problem reading file {}: {}".format(inFile, e))
+            continue
+
+        if (c+1) % 500 == 0:
+            print(" {}/{}".format(c+1, len(inFiles)))
+
+    # 2. Compact each tile into one file
+    tileDirs = [d for d in glob.glob(os.path.join(outdir, '*'))
+                                                        if os.path.isdir(d)]
+    print("\nCompacting {} tiles".format(len(tileDirs)))
+
+    rows = [compactTile(tileDir) for tileDir in tileDirs]
+
+    # 3. Write manifest
+    manifestCsv = os.path.join(outdir, MANIFEST_NAME)
+    pd.DataFrame(rows, columns = ['tile', 'path', 'nShots', 'xmin', 'ymin',
+                             'xmax', 'ymax']).to_csv(manifestCsv, index = False)
+
+    print("\nWrote {} shots to {} tiles".format(nShots, len(tileDirs)))
+    print(" Manifest: {}".format(manifestCsv))
+    print("\nEnd: {}\n".format(time.strftime("%m-%d-%y %I:%M:%S %p")))
+
+    calculateElapsedTime(start, time.time())
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", type=str, required=True,
+              help="Specify the input directory with the .csv/.parquet files")
+    parser.add_argument("-o", "--output", type=str, required=True,
+                                 help="Specify the output tile store directory")
+    parser.add_argument("-overwrite", "--overwrite", action='store_true',
+                                help="Remove and rebuild existing tile store")
+
+    args = parser.parse_args()
+
+    create_atl08_tiles(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+#! /usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+# Given a region (na or ea), mask and polygonize every Landsat age year tile
+#  in Landsat_ageYear_<region>.shp once into the regional disturbance patch
+#  store, so overlapping SGM stacks select their patches from the store
+#  instead of polygonizing the same Landsat pixels again
+
+# PROCESS:
+## 1. Get Landsat tiles from the location field of the index .shp
+## 2. For each tile not in the store, read it on its own 10m -tap grid, mask
+##    0/50/nodata and polygonize (buildZdf_disturbance.polygonizeTile)
+## 3. Write patches (ageYear, seam, geometry) to <outdir>/<region>/<tile>.parquet
+##    and the tile's footprint to <outdir>/<region>/<tile>_footprint.parquet
+
+# Tiles missing from the store are also added by buildZdf the first time a
+# stack needs them, so this only has to be run to build the store up front
+
+# Requires pyarrow
+
+import os
+
+import argparse
+
+import time
+
+import geopandas as gpd
+
+from functions.buildZdf_disturbance import indexShpDir, getStorePath, \
+                                                    isStored, writeStoreTile
+
+def calculateElapsedTime(start, end, unit = 'minutes'):
+
+    # start and end = time.time()
+
+    if unit == 'minutes':
+        elapsedTime = round((time.time()-start)/60, 4)
+    elif unit == 'hours':
+        elapsedTime = round((time.time()-start)/60/60, 4)
+    else:
+        elapsedTime = round((time.time()-start), 4)
+        unit = 'seconds'
+
+    print("Elapsed time: {} {}".format(elapsedTime, unit))
+
+    return None
+
+def create_patch_store(args):
+
+    print("\nBegin: {}\n".format(time.strftime("%m-%d-%y %I:%M:%S %p")))
+
+    # Start clock
+    start = time.time()
+
+    indexShp = os.path.join(indexShpDir,
+                            'Landsat_ageYear_{}.shp'.format(args.region))
+    outdir = os.path.join(args.output, args.region)
+
+    inputFiles = gpd.read_file(indexShp)['location'].drop_duplicates().tolist()
+    print("Polygonizing {} Landsat tiles from {}".format(len(inputFiles),
+                                                                     indexShp))
+    print("Output store: {}\n".format(outdir))
+
+    nPatches = 0
+    nSkip = 0
+    for c, inputFile in enumerate(inputFiles):
+
+        storePath = getStorePath(inputFile, outdir)
+
+        if isStored(storePath) and not args.overwrite:
+            nSkip += 1
+            continue
+
+        nPatches += writeStoreTile(inputFile, storePath, args.workers)
+
+        if (c+1) % 50 == 0:
+            print(" {}/{}".format(c+1, len(inputFiles)))
+
+    print("\nWrote {} patches. Skipped {} existing tiles".format(nPatches,
+                                                                      nSkip))
+    print("\nEnd: {}\n".format(time.strftime("%m-%d-%y %I:%M:%S %p")))
+
+    calculateElapsedTime(start, time.time(), 'seconds')
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-r", "--region", type=str, required=True,
+                                             help="Specify the region (na or ea)")
+    parser.add_argument("-o", "--output", type=str,
+        default='/explore/nobackup/people/mwooten3/3DSI/ZonalStats_2022/Disturbance/_patchStore',
+                                  help="Specify the output store directory")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                     help="Number of processes for polygonizing each tile")
+    parser.add_argument("-overwrite", "--overwrite", action='store_true',
+                                help="Overwrite existing .parquet files")
+
+    args = parser.parse_args()
+
+    create_patch_store(args)
+
+if __name__ == "__main__":
+    main()
@@ -8,8 +8,25 @@ From a zonal type and stack type, run ZonalStats
 Inputs: 
     stackType [SGM, LVIS, GLiHT, Landsat, Auxiliary for now]
     zoneType  [ATL08-v5, GLAS for now]
+
+Stacks are run one after another in this process (ZonalStats_3DSI.runBatch)
+    rather than one python call per stack, so imports and in-process caches
+    are only paid for once. A failed stack does not stop the rest
+
+With -par, several stacks run at once on the node (models/StackScheduler.py),
+    each in its own process. How many run at once depends on free memory and
+    a memory estimate per stack (estimateStackMemory) instead of a fixed
+    number of jobs
+
+With -q, nodes do not split the list up front (getNodeFiles). Instead the
+    stack list goes into a shared queue (models/StackQueue.py, an SQLite file
+    under mainDir/_queues by default, or the path given) and every node that
+    runs the script claims the next stack until none are left. Stacks of a
+    worker that stops sending heartbeats are taken back by the others. Run
+    the script once per worker wanted on a node (-q does not go with -par)
 """
 import os
+import sys
 import time
 import argparse
 import platform
@@ -17,11 +34,27 @@ import platform
 import numpy as np
 
 from models.RasterStack import RasterStack
-from models.FeatureClass import FeatureClass
+from models.StackScheduler import StackScheduler
+from models.StackQueue import StackQueue
+from models.StatKernels import MAX_BINCOUNT_BYTES
+
+from functions.buildZdf_atl08v5 import getExtentGdf, getZonalIndexList, \
+                                               indexShp as atl08IndexShp
+from functions.buildZdf_disturbance import AGE_RESOLUTION
+
+from ZonalStats_3DSI import runBatch
 
 # Some global vars
 mainDir = '/explore/nobackup/people/mwooten3/3DSI/ZonalStats_2022'
-runScript = '/home/mwooten3/code/3DSI_ZonalStats_v3/ZonalStats_3DSI.py'
+
+# Per-stack memory estimate for parallel mode (rough, err on the high side):
+#  BASE_STACK_BYTES + nZones * (BYTES_PER_ZONE + nBands * BYTES_PER_ZONE_BAND)
+#  + the majority/minority count matrix of each stats worker
+BASE_STACK_BYTES    = 1.5 * 1024**3 # imports, caches, stack reads
+BYTES_PER_ZONE      = 2000          # zone row (attributes + geometry)
+BYTES_PER_ZONE_BAND = 200           # pixel values/stats per zone per band
+BEAMS_PER_GRANULE   = 6             # ATL08 shots: granules x beams x height/segLength
+PIXELS_PER_PATCH    = 50            # Disturbance patches: 10m pixels per patch
 
 #validStackTypes = ['GLiHT', 'Auxiliary', 'Landsat', 'GLiHT-old', 'LVIS-old']#, 'SGM', 'LVIS']
 validStackTypes = ['Landsat', 'SGM']
@@ -136,6 +169,85 @@ def getStackList(inTxtList, nodeRange, nodeBase, splitList):
         
     return runFiles
     
+# Rough memory (bytes) a stack will need: number of zones from the stack size 
+# (and ATL08 granules crossing it) x number of bands, plus the largest count
+# matrix (StatKernels) of each of the stack's workers
+def estimateStackMemory(stack, zonalType, workers = 1):
+    
+    rs = RasterStack(stack)
+    (xmin, ymin, xmax, ymax) = rs.extent()
+    
+    if 'ATL08' in zonalType:
+        segLength = 20 if zonalType == 'ATL08-20m' else 100
+        nGranules = len(getZonalIndexList(atl08IndexShp, None,
+                                        getExtentGdf(rs.extent(), rs.epsg())))
+        nZones = nGranules * BEAMS_PER_GRANULE * (ymax - ymin) / segLength
+        
+    else:
+        nZones = (xmax - xmin) * (ymax - ymin) / AGE_RESOLUTION**2 / \
+                                                              PIXELS_PER_PATCH
+        
+    return int(BASE_STACK_BYTES + workers * MAX_BINCOUNT_BYTES +
+               nZones * (BYTES_PER_ZONE + rs.nLayers * BYTES_PER_ZONE_BAND))
+
+# Run one stack (in a scheduler process). runBatch catches errors, so exit
+# with 1 if the stack failed for the scheduler to count it as failed
+def runStack(stack, stackArgs):
+    
+    sys.exit(1 if runBatch([stack], stackArgs) else 0)
+
+# Default shared queue .sqlite for a zonal/stack type/region/stats run
+def getQueuePath(zonalType, stackType, region, statsType):
+    
+    return os.path.join(mainDir, '_queues', '{}__{}-{}__{}Stats.sqlite'.format(
+                                    zonalType, stackType, region, statsType))
+
+# Work through the shared queue: claim the next stack, run it while sending
+# heartbeats, then mark it done/failed. Stops when no stacks are pending
+def runQueue(queue, stackArgs):
+    
+    worker = '{}:{}'.format(platform.node(), os.getpid())
+    
+    nRun = 0
+    while True:
+        
+        stack = queue.claim(worker)
+        if stack is None:
+            break
+        
+        print("\n{} claimed {}".format(worker, stack))
+        
+        # If the claim is lost, the stack stops at its next batch and 
+        # nothing goes to the aggregate (see ZonalStats_3DSI.main)
+        with queue.beat(stack, worker) as heartbeat:
+            failed = runBatch([stack], dict(stackArgs, 
+                                                   claimLost = heartbeat.lost))
+            
+        if not queue.finish(stack, worker, ok = not failed):
+            print("\nClaim on {} was taken back before it finished".format(stack))
+            
+        nRun += 1
+        
+    print("\n{} ran {} stacks. Queue: {}".format(worker, nRun, queue.counts()))
+
+# Arguments for ZonalStats_3DSI.main(), same for every stack (rasterStack is
+# set per stack by runBatch)
+def getStackArgs(args, varsDict):
+    
+    logging = True #* TD add as arg
+    
+    columns = None
+    if args['columns']:
+        columns = [c.strip() for c in args['columns'].split(',')]
+    
+    return {'zonalType': args['zonalType'], 
+            'aggregateOutput': varsDict['aggregateOutput'], 
+            'baseDir': mainDir, 'logOutput': logging, 
+            'statsMode': args['statsType'], 'workers': args['workers'], 
+            'chunkSize': args['chunkSize'], 'labelStats': args['labelStats'], 
+            'simplify': args['simplify'], 'noShp': args['noShp'],
+            'coverageCache': args['coverageCache'], 'columns': columns}
+    
 # Unpack and validate input arguments
 def unpackValidateArgs(args):
     
@@ -146,6 +258,7 @@ def unpackValidateArgs(args):
     nodeRange  = args['nodeRange']
     region     = args['region']
     noSplit    = args['noSplit'] # do not split list if passed
+    queue      = args['queue'] # shared queue instead of splitting
 #    nodeBase   = args['nodeBase']
 #    runPar     = args['parallel']
 
@@ -181,8 +294,11 @@ def unpackValidateArgs(args):
         
     # 1/6/23 configure split
     split = True # default
-    if noSplit:
+    if noSplit or queue:
         split = False        
+        
+    if queue and args['parallel']:
+        raise RuntimeError("-q and -par cannot be used together. Run the script more than once on a node for more queue workers")
     
     # Only return vars that are referenced more than once in main()
     return stackType, zonalType, statsType, region, split
@@ -199,77 +315,70 @@ def main(args):
     stackList = getStackList(varsDict['inList'], args['nodeRange'], \
                              args['nodeBase'], split)
     
-    # Get node-specific output .gdb
-    #* TBD whether doing this or not. And it will be .csv not .gdb
-    #outGdb = varsDict['outCsv'].replace('.csv', '-{}.gpkg'.format(platform.node()))
+    # Check stack's output csv's, and skip if it exists and overwrite is False
+    runList = []
+    for stack in stackList:
 
-    #* This is untested/will not work as of now for v3
-    if args['parallel']: # If running in parallel
+        rs = RasterStack(stack)
+        check = os.path.join(mainDir, zonalType, stackType, region, rs.stackName,
+          '{}__{}__{}Stats.csv'.format(zonalType, rs.stackName, statsType))
         
-        # Get list of output shp's that we are expecting based off stackList
-        shps = [os.path.join(mainDir, zonalType, stackType, RasterStack(stack).stackName, 
-                '{}__{}__zonalStats.shp'.format(zonalType, RasterStack(stack).stackName)) 
-                                                        for stack in stackList]
-
-        # Prepare inputs for parallel call:
-        call = "lscpu | awk '/^Socket.s.:/ {sockets=$NF} END {print sockets}'"
-        ncpu = os.popen(call).read().strip()
-        ncpu = int(ncpu) - 1 # all CPUs minus 1
+        if not overwrite:
+            if os.path.isfile(check):
+                print("\nOutputs for {} already exist\n".format(rs.stackName))
+                continue
+            
+        runList.append(stack)
+        
+    # 1/6/23: zonalType not zonalDir now
+    stackArgs = getStackArgs(args, varsDict)
     
-        parList = ' '.join(stackList)
+    if args['queue']: # Claim stacks from the shared queue
+        
+        queuePath = args['queue']
+        if queuePath == 'default':
+            queuePath = getQueuePath(zonalType, stackType, region, statsType)
+        os.system('mkdir -p {}'.format(os.path.dirname(os.path.abspath(queuePath))))
+        
+        queue = StackQueue(queuePath)
+        nAdded = queue.addStacks(runList)
+        
+        print("\nAdded {} stacks to queue {}: {}".format(nAdded, queuePath, 
+                                                              queue.counts()))
+        
+        runQueue(queue, stackArgs)
+    
+    elif args['parallel']: # If running in parallel
+        
+        # Several stacks at once, as many as memory allows
+        estimates = [estimateStackMemory(stack, zonalType, args['workers']) 
+                                                         for stack in runList]
         
-        print("\nProcessing {} stack files in parallel...\n".format(len(stackList)))
-
-        # Do not supply output GDB, just supply .csv
-        parCall = '{} -rs '.format(runScript) + '{1} -z {2} -o {3} -log'
-        cmd = "parallel --progress -j {} --delay 1 '{}' ::: {} ::: {} ::: {}". \
-                format(ncpu, parCall, parList, varsDict['zonalDir'], 
-                                                           varsDict['outCsv'])
-
-        os.system(cmd)       
-
-        # And update node-specific GDB if shp exists
-        print("\n\nCreating {} with completed shapefiles ({})...".format(outGdb, 
-                                           time.strftime("%m-%d-%y %I:%M:%S")))   
-        for shp in shps:
-            if os.path.isfile(shp):
-                fc = FeatureClass(shp)
-                if fc.nFeatures > 0: fc.addToFeatureClass(outGdb)        
+        memLimit = None
+        if args['memLimit']:
+            memLimit = args['memLimit'] * 1024**3
+        
+        scheduler = StackScheduler(memLimit = memLimit, 
+                                   maxProcesses = args['maxProcesses'])
+        
+        print("\nProcessing {} stacks in parallel on {}...".format(len(runList), 
+                                                              platform.node()))
+        
+        failed = scheduler.run(runStack, runList, estimates, stackArgs)
+        
+        print("\nFinished {} stacks ({})".format(len(runList), 
+                                           time.strftime("%m-%d-%y %I:%M:%S")))
+        for stack in failed:
+            print(" Process failed: {}".format(stack))
                 
     # Do not run in parallel
     else:   
-        
-        # Iterate through stacks and call
-        print("\nProcessing {} stacks on {}...".format(len(stackList), 
+            
+        print("\nProcessing {} stacks on {}...".format(len(runList), 
                                                               platform.node()))
         
-        c = 0
-        for stack in stackList:
-            
-            c+=1
-            print("\n{}/{}:".format(c, len(stackList)))
-
-            # Check stack's output csv's, and skip if it exists and overwrite is False
-            rs = RasterStack(stack)
-            check = os.path.join(mainDir, zonalType, stackType, region, rs.stackName,
-              '{}__{}__{}Stats.csv'.format(zonalType, rs.stackName, statsType))
-            
-            if not overwrite:
-                if os.path.isfile(check):
-                    print("\nOutputs for {} already exist\n".format(rs.stackName))
-                    continue
-            
-            # Not running in parallel
-            # 1/6/23: zonalType not zonalDir now
-            cmd = 'python {} -r {} -z {} -o {} -b {} -mode {}'.format( \
-                          runScript, stack, args['zonalType'],     \
-                          varsDict['aggregateOutput'], mainDir, args['statsType'])
-            logging = True #* TD add as arg
-            if logging:
-                cmd += ' -log'
-            
-            print(cmd)
-            os.system(cmd) 
+        # Run all stacks in this process
+        runBatch(runList, stackArgs)
         
         
 if __name__ == "__main__":
@@ -289,9 +398,24 @@ if __name__ == "__main__":
                         help="Node range (i.e. 201-201 or 201-210 (default))",
                                                             required=False)
     parser.add_argument("-par", "--parallel", action='store_true', 
-                        help="Run in parallel")
+                        help="Run several stacks at once (as memory allows)")
+    parser.add_argument("-mem", "--memLimit", type=float, required=False,
+                        help="Memory limit (GB) for parallel stacks (default 80%% of available)")
+    parser.add_argument("-maxp", "--maxProcesses", type=int, required=False,
+                        help="Most stacks at once in parallel (default n CPUs - 1)")
     parser.add_argument("-noSplit", "--noSplit", action='store_true', 
                         help="Do not split input files among passed nodes")
+    parser.add_argument("-q", "--queue", type=str, nargs='?', const='default',
+                        help="Claim stacks from a shared queue .sqlite instead of splitting among nodes (default under mainDir/_queues, or path)")
+    
+    # Passed on to ZonalStats_3DSI for every stack
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of processes for zonal/point stats and polygonizing disturbance patches (default 1)")
+    parser.add_argument("-chunk", "--chunkSize", type=int, default=50000, help="Number of zones per zonal stats batch (default 50000)")
+    parser.add_argument("-labels", "--labelStats", action='store_true', help="Disturbance zonal stats from a patch label image instead of polygons (pixels assigned by center)")
+    parser.add_argument("-simplify", "--simplify", type=float, default=None, help="Simplify disturbance patches with this tolerance in pixels, e.g. 1 (default None: no simplifying)")
+    parser.add_argument("-noShp", "--noShp", action='store_true', help="Do not write the stack .shp (with -labels, patches are not polygonized)")
+    parser.add_argument("-columns", "--columns", type=str, default=None, help="Comma-separated ATL08 columns to load and write to outputs (default: all columns)")
+    parser.add_argument("-coverageCache", "--coverageCache", action='store_true', help="Cache zone coverage of each stack in its output directory, for re-runs on the same zones (zonal mode)")
     
     args = vars(parser.parse_args())
 
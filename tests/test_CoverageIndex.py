@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for models/CoverageIndex.py
+
+The cache file has to load back to the same index, and only for the same
+    zones and grid (fromCache)
+
+The quad fast path (rasterizeQuads) has to give the same pixels as
+    rasterio all_touched in the zone's window (geomWindow), which is what the
+    rasterize path and rasterstats do. GDAL's pick of pixels touched only at
+    a corner can change with the window origin, so the reference rasterizes
+    in the window rather than on the whole grid
+"""
+import numpy as np
+import shapely
+
+from affine import Affine
+from rasterio import features
+
+from models.CoverageIndex import CoverageIndex, quadCorners, rasterizeQuads, \
+                                                         geomWindow, pixelType
+
+GEOTRANSFORM = (1000.0, 2.0, 0.0, 5000.0, 0.0, -2.0)
+N_COLUMNS, N_ROWS = 60, 50
+
+#------------------------------------------------------------------------------
+# Raster stand-in with what CoverageIndex reads from a Raster object
+#------------------------------------------------------------------------------
+class GridRaster(object):
+
+    def __init__(self, geotransform = GEOTRANSFORM, nColumns = N_COLUMNS,
+                                                            nRows = N_ROWS):
+
+        self.ogrGeotransform = geotransform
+        self.nColumns = nColumns
+        self.nRows    = nRows
+
+    def epsg(self):
+        return 32618
+
+#------------------------------------------------------------------------------
+# Pixels of each geometry from rasterio all_touched in the geometry's window
+#------------------------------------------------------------------------------
+def gdalPixels(geoms):
+
+    zonePixels = []
+
+    for geom in geoms:
+
+        window = geomWindow(geom.bounds, GEOTRANSFORM, N_COLUMNS, N_ROWS)
+        if window is None:
+            zonePixels.append(np.zeros(0, dtype = np.int64))
+            continue
+
+        (xoff, yoff, xsize, ysize) = window
+        transform = Affine.from_gdal(*GEOTRANSFORM) * \
+                                                Affine.translation(xoff, yoff)
+
+        mask = features.rasterize([(geom, 1)], out_shape = (ysize, xsize),
+                                  transform = transform, fill = 0,
+                                  dtype = 'uint8', all_touched = True)
+
+        (rows, cols) = np.nonzero(mask)
+        zonePixels.append((rows + yoff) * N_COLUMNS + cols + xoff)
+
+    return zonePixels
+
+def indexPixels(index):
+
+    return [index.pixels[index.offsets[i]:index.offsets[i+1]].astype(np.int64)
+                                                  for i in range(index.nZones)]
+
+def assertParity(geoms):
+
+    assert quadCorners(geoms) is not None
+
+    index = CoverageIndex.build(geoms, GridRaster())
+
+    for geom, expected, got in zip(geoms, gdalPixels(geoms), indexPixels(index)):
+        np.testing.assert_array_equal(got, expected, err_msg = geom.wkt)
+
+def rotatedRectangles(n, seed = 0):
+
+    rng = np.random.default_rng(seed)
+    geoms = []
+
+    for _ in range(n):
+        (cx, cy) = (rng.uniform(990, 1130), rng.uniform(4890, 5010))
+        (w, l) = (rng.uniform(1, 15), rng.uniform(2, 40))
+        a = rng.uniform(0, np.pi)
+
+        corners = np.array([[-w, -l], [w, -l], [w, l], [-w, l]]) / 2
+        rotation = np.array([[np.cos(a), -np.sin(a)], [np.sin(a), np.cos(a)]])
+
+        geoms.append(shapely.Polygon(corners @ rotation.T + [cx, cy]))
+
+    return geoms
+
+def test_random_quads():
+
+    assertParity(rotatedRectangles(500))
+
+def test_random_quads_no_ties():
+
+    corners = quadCorners(rotatedRectangles(200, seed = 1))
+    (counts, pixels, ties) = rasterizeQuads(corners, GEOTRANSFORM, N_COLUMNS,
+                                                                       N_ROWS)
+    assert not ties.any()
+
+def test_axis_aligned_on_pixel_lines():
+
+    rng = np.random.default_rng(2)
+    (i, j, w, h) = (rng.integers(0, 25, (4, 200)) + [[0], [0], [1], [1]])
+
+    geoms = [shapely.box(1000 + 2*c, 4950 - 2*r, 1000 + 2*(c + dc),
+                         4950 - 2*(r - dr)) for c, r, dc, dr in zip(i, j, w, h)]
+
+    assertParity(geoms)
+
+def test_axis_aligned_off_pixel_lines():
+
+    rng = np.random.default_rng(3)
+    (x, y) = (rng.uniform(990, 1130, 300), rng.uniform(4890, 5010, 300))
+    (w, h) = (rng.uniform(0.1, 9, 300), rng.uniform(0.1, 9, 300))
+
+    assertParity([shapely.box(*b) for b in zip(x, y, x + w, y + h)])
+
+def test_slanted_edges_through_pixel_corners():
+
+    # Diamonds and parallelograms with corners on pixel corners, so every
+    # edge passes exactly through pixel corners
+    rng = np.random.default_rng(4)
+    geoms = []
+
+    for (c, r, k, s) in rng.integers(1, 25, (200, 4)):
+        (x, y, h) = (1000 + 2*c, 5000 - 2*r, 2*k)
+        geoms.append(shapely.Polygon([(x, y + h), (x + h, y), (x, y - h),
+                                                                (x - h, y)]))
+        geoms.append(shapely.Polygon([(x, y), (x + 4, y + 2*s),
+                                      (x + 4, y + 2*s + h), (x, y + h)]))
+
+    assertParity(geoms)
+
+def test_not_quads():
+
+    triangle = shapely.Polygon([(1000, 5000), (1010, 5000), (1000, 4990)])
+    square = shapely.box(1000, 4990, 1010, 5000)
+
+    assert quadCorners([square, triangle]) is None
+    assert quadCorners([square.buffer(5)]) is None
+    assert quadCorners([]) is None
+
+def test_save_load_round_trip(tmp_path):
+
+    geoms = rotatedRectangles(50) + [shapely.box(2000, 6000, 2010, 6010)]
+    index = CoverageIndex.build(geoms, GridRaster())
+
+    cacheFile = index.save(str(tmp_path / 'stack__coverage.npz'))
+    loaded = CoverageIndex.load(cacheFile)
+
+    np.testing.assert_array_equal(loaded.offsets, index.offsets)
+    np.testing.assert_array_equal(loaded.pixels, index.pixels)
+    assert loaded.pixels.dtype == np.uint32
+    assert (loaded.nRows, loaded.nColumns) == (N_ROWS, N_COLUMNS)
+    assert (loaded.signature, loaded.zoneHash) == (index.signature,
+                                                               index.zoneHash)
+
+    # Zone off the raster has no pixels
+    assert loaded.offsets[-1] == loaded.offsets[-2]
+
+def test_from_cache(tmp_path):
+
+    geoms = rotatedRectangles(20)
+    cacheFile = str(tmp_path / 'stack__coverage.npz')
+
+    assert CoverageIndex.fromCache(cacheFile, geoms, GridRaster()) is None
+
+    CoverageIndex.build(geoms, GridRaster()).save(cacheFile)
+
+    assert CoverageIndex.fromCache(cacheFile, geoms, GridRaster()) is not None
+
+    # Different zones, rasterization or grid
+    assert CoverageIndex.fromCache(cacheFile, geoms[:-1], GridRaster()) is None
+    assert CoverageIndex.fromCache(cacheFile, geoms, GridRaster(),
+                                                 allTouched = False) is None
+    assert CoverageIndex.fromCache(cacheFile, geoms,
+                                   GridRaster(nColumns = N_COLUMNS + 1)) is None
+
+    shifted = (GEOTRANSFORM[0] + 2,) + GEOTRANSFORM[1:]
+    assert CoverageIndex.fromCache(cacheFile, geoms,
+                                   GridRaster(geotransform = shifted)) is None
+
+def test_subset():
+
+    index = CoverageIndex.build(rotatedRectangles(30), GridRaster())
+    zones = [7, 2, 2, 29, 0]
+
+    sub = index.subset(zones)
+
+    assert sub.nZones == len(zones)
+    for i, zone in enumerate(zones):
+        np.testing.assert_array_equal(
+                     sub.pixels[sub.offsets[i]:sub.offsets[i+1]],
+                     index.pixels[index.offsets[zone]:index.offsets[zone+1]])
+
+    assert index.subset([]).nZones == 0
+
+def test_pixel_type():
+
+    assert pixelType(N_ROWS, N_COLUMNS) == np.uint32
+    assert pixelType(2**16, 2**16 - 1) == np.uint32
+    assert pixelType(2**16, 2**16) == np.int64
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for models/GranuleCache.py
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from models.GranuleCache import GranuleCache
+
+N_ROWS = 100
+
+def granuleFrame(value = 0.0):
+
+    return pd.DataFrame({'h_can': np.full(N_ROWS, value),
+                         'lat': np.arange(N_ROWS, dtype = np.float64)})
+
+def frameBytes():
+
+    return int(granuleFrame().memory_usage(deep = True).sum())
+
+#------------------------------------------------------------------------------
+# Write n empty granule files to directory and return their paths
+#------------------------------------------------------------------------------
+def granuleFiles(directory, n):
+
+    paths = []
+    for i in range(n):
+        path = str(directory / 'ATL08_{}.csv'.format(i))
+        open(path, 'w').close()
+        paths.append(path)
+
+    return paths
+
+#------------------------------------------------------------------------------
+# Reader that counts how often each granule is read
+#------------------------------------------------------------------------------
+class CountingReader(object):
+
+    def __init__(self):
+        self.reads = []
+
+    def __call__(self, path):
+        self.reads.append(path)
+        return granuleFrame(len(self.reads))
+
+def test_hits_and_misses(tmp_path):
+
+    (a, b) = granuleFiles(tmp_path, 2)
+    cache = GranuleCache(10 * frameBytes())
+    reader = CountingReader()
+
+    first = cache.get(a, reader)
+    assert cache.get(a, reader) is first
+    cache.get(b, reader)
+
+    assert reader.reads == [a, b]
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 2
+    assert cache.stats()['nBytes'] == 2 * frameBytes()
+
+def test_least_recently_used_evicted(tmp_path):
+
+    (a, b, c) = granuleFiles(tmp_path, 3)
+    cache = GranuleCache(2 * frameBytes())
+    reader = CountingReader()
+
+    cache.get(a, reader)
+    cache.get(b, reader)
+    cache.get(a, reader) # a is now more recent than b
+    cache.get(c, reader) # over the limit, b goes
+
+    assert cache.has(a) and cache.has(c) and not cache.has(b)
+    assert cache.stats()['entries'] == 2
+    assert cache.stats()['nBytes'] <= cache.maxBytes
+
+    cache.get(b, reader)
+    assert reader.reads == [a, b, c, b]
+    assert not cache.has(a)
+
+def test_too_big_not_cached(tmp_path):
+
+    (a,) = granuleFiles(tmp_path, 1)
+    cache = GranuleCache(frameBytes() - 1)
+    reader = CountingReader()
+
+    cache.get(a, reader)
+    cache.get(a, reader)
+
+    assert reader.reads == [a, a]
+    assert cache.stats()['entries'] == 0
+
+def test_columns_are_part_of_key(tmp_path):
+
+    (a,) = granuleFiles(tmp_path, 1)
+    cache = GranuleCache(10 * frameBytes())
+    reader = CountingReader()
+
+    cache.get(a, reader, columns = ['h_can'])
+    cache.get(a, reader, columns = ['h_can', 'lat'])
+    cache.get(a, reader, columns = ('h_can',))
+
+    assert len(reader.reads) == 2
+    assert cache.has(a, ['h_can']) and not cache.has(a)
+
+def test_rewritten_granule_read_again(tmp_path):
+
+    (a,) = granuleFiles(tmp_path, 1)
+    cache = GranuleCache(10 * frameBytes())
+    reader = CountingReader()
+
+    cache.get(a, reader)
+
+    mtime = os.path.getmtime(a)
+    os.utime(a, (mtime + 10, mtime + 10))
+
+    assert not cache.has(a)
+    assert cache.get(a, reader)['h_can'].iloc[0] == 2
+
+    # Old version was dropped
+    assert cache.stats()['entries'] == 1
+    assert cache.stats()['nBytes'] == frameBytes()
+
+def test_resize_and_clear(tmp_path):
+
+    paths = granuleFiles(tmp_path, 4)
+    cache = GranuleCache(10 * frameBytes())
+    reader = CountingReader()
+
+    for path in paths:
+        cache.get(path, reader)
+
+    cache.resize(2 * frameBytes())
+    assert [cache.has(path) for path in paths] == [False, False, True, True]
+
+    cache.clear()
+    assert cache.stats()['entries'] == 0 and cache.stats()['nBytes'] == 0
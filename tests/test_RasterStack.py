@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for models/RasterStack.py
+
+validDataFootprint (no mask.tif) has to keep every zone that has data in any
+    band, like running without a footprint does, also where band 1 is nodata
+"""
+import numpy as np
+import shapely
+import pytest
+
+gdal = pytest.importorskip("osgeo.gdal")
+osr = pytest.importorskip("osgeo.osr")
+
+from models.RasterStack import RasterStack
+
+EPSG = 32618
+GEOTRANSFORM = (500000.0, 30.0, 0.0, 4000000.0, 0.0, -30.0)
+N_COLUMNS, N_ROWS = 200, 160
+NODATA = -9999
+
+#------------------------------------------------------------------------------
+# Two band stack: band 1 has data in the upper left, band 2 in the lower
+# right (and a one pixel wide strip), nodata everywhere else
+#------------------------------------------------------------------------------
+def writeStack(outTif):
+
+    arr = np.full((2, N_ROWS, N_COLUMNS), NODATA, dtype = np.float32)
+    arr[0, 10:60, 10:70] = 5
+    arr[1, 90:150, 120:190] = 7
+    arr[1, 20:80, 150] = 9
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(EPSG)
+
+    ds = gdal.GetDriverByName('GTiff').Create(outTif, N_COLUMNS, N_ROWS, 2,
+                                                            gdal.GDT_Float32)
+    ds.SetGeoTransform(GEOTRANSFORM)
+    ds.SetProjection(srs.ExportToWkt())
+
+    for b in range(2):
+        band = ds.GetRasterBand(b + 1)
+        band.WriteArray(arr[b])
+        band.SetNoDataValue(NODATA)
+
+    ds = None
+
+    return arr
+
+def pixelCenters(rows, cols):
+
+    (ulx, xres, _, uly, _, yres) = GEOTRANSFORM
+
+    return shapely.points(ulx + (cols + 0.5) * xres, uly + (rows + 0.5) * yres)
+
+def test_footprint_keeps_data_in_any_band(tmp_path):
+
+    outTif = str(tmp_path / 'test_stack.tif')
+    arr = writeStack(outTif)
+
+    footprint = RasterStack(outTif).validDataFootprint(maxSize = 50)
+
+    # Every pixel with data in some band is in the footprint
+    (rows, cols) = np.nonzero((arr != NODATA).any(axis = 0))
+    assert shapely.contains(footprint, pixelCenters(rows, cols)).all()
+
+    # Far from any data is not
+    assert not shapely.contains(footprint, pixelCenters(np.array([140]),
+                                                         np.array([20])))[0]
+
+def test_footprint_cache(tmp_path):
+
+    outTif = str(tmp_path / 'test_stack.tif')
+    writeStack(outTif)
+
+    cacheFile = str(tmp_path / 'footprint.wkb')
+    footprint = RasterStack(outTif).validDataFootprint(cacheFile, maxSize = 50)
+
+    assert RasterStack(outTif).validDataFootprint(cacheFile).equals(footprint)
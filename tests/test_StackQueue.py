@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for models/StackQueue.py, on an SQLite file in a temp directory
+
+Claim expiry uses a fake clock instead of waiting for claimTimeout
+"""
+import time
+import types
+
+import pytest
+
+import models.StackQueue
+
+from models.StackQueue import StackQueue
+
+STACKS = ['stack_a', 'stack_b', 'stack_c']
+
+@pytest.fixture
+def clock(monkeypatch):
+
+    now = {'time': 1000.0}
+
+    monkeypatch.setattr(models.StackQueue, 'time',
+                        types.SimpleNamespace(time = lambda: now['time']))
+
+    return now
+
+def makeQueue(tmp_path, **kwargs):
+
+    queue = StackQueue(str(tmp_path / 'queue.sqlite'), **kwargs)
+    queue.addStacks(STACKS)
+
+    return queue
+
+def test_claim_in_order(tmp_path):
+
+    queue = makeQueue(tmp_path)
+
+    # Stacks already in the queue are left as they are
+    assert queue.addStacks(STACKS + ['stack_d']) == 1
+
+    claimed = [queue.claim('node1') for _ in range(5)]
+
+    assert claimed == STACKS + ['stack_d', None]
+    assert queue.counts() == {'claimed': 4}
+
+def test_workers_never_share_a_stack(tmp_path):
+
+    (queue1, queue2) = (makeQueue(tmp_path), makeQueue(tmp_path))
+
+    claimed = []
+    for _ in range(2):
+        claimed += [queue1.claim('node1'), queue2.claim('node2')]
+
+    assert sorted([s for s in claimed if s]) == STACKS
+    assert claimed.count(None) == 1
+
+def test_finish(tmp_path):
+
+    queue = makeQueue(tmp_path)
+
+    (a, b) = (queue.claim('node1'), queue.claim('node1'))
+
+    # Only the worker holding the claim can finish it
+    assert not queue.finish(a, 'node2')
+
+    assert queue.finish(a, 'node1')
+    assert queue.finish(b, 'node1', ok = False)
+    assert not queue.finish(a, 'node1')
+
+    assert queue.counts() == {'done': 1, 'failed': 1, 'pending': 1}
+
+def test_expired_claim_taken_back(tmp_path, clock):
+
+    queue = makeQueue(tmp_path, claimTimeout = 600)
+
+    stack = queue.claim('node1')
+
+    # Heartbeats keep the claim
+    clock['time'] += 500
+    assert queue.heartbeat(stack, 'node1')
+    clock['time'] += 500
+    assert queue.claim('node2') == 'stack_b'
+
+    # No heartbeat for longer than claimTimeout, stack goes to the next claim
+    clock['time'] += 601
+    assert queue.claim('node2') == stack
+
+    assert not queue.heartbeat(stack, 'node1')
+    assert not queue.finish(stack, 'node1')
+    assert queue.finish(stack, 'node2')
+
+def test_failed_after_max_attempts(tmp_path, clock):
+
+    queue = makeQueue(tmp_path, claimTimeout = 600, maxAttempts = 2)
+
+    for worker in ['node1', 'node2']:
+        assert queue.claim(worker) == 'stack_a'
+        clock['time'] += 601
+
+    # Claimed twice and expired again: failed instead of pending
+    assert queue.claim('node3') == 'stack_b'
+    assert queue.counts() == {'claimed': 1, 'failed': 1, 'pending': 1}
+
+def test_heartbeat_thread(tmp_path):
+
+    queue = makeQueue(tmp_path)
+    stack = queue.claim('node1')
+
+    query = 'SELECT heartbeat FROM stacks WHERE stack = ?'
+
+    (before,) = queue.connection.execute(query, (stack,)).fetchone()
+
+    with queue.beat(stack, 'node1', seconds = 0.05):
+        time.sleep(0.3)
+
+    (after,) = queue.connection.execute(query, (stack,)).fetchone()
+
+    assert after > before
+
+def test_heartbeat_thread_lost_claim(tmp_path, clock):
+
+    queue = makeQueue(tmp_path, claimTimeout = 600)
+    stack = queue.claim('node1')
+
+    # Taken back by another worker while node1 still runs the stack
+    clock['time'] += 601
+    assert queue.claim('node2') == stack
+
+    with queue.beat(stack, 'node1', seconds = 0.05) as heartbeat:
+        assert heartbeat.lost.wait(2)
+
+    assert not queue.finish(stack, 'node1')
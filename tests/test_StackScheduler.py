@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for models/StackScheduler.py
+
+Stacks run in real forked processes that record when they ran. Memory is
+    faked: MemAvailable is large and running stacks have no RSS unless a test
+    sets it, so admission only depends on the estimates and memLimit
+"""
+import os
+import sys
+import time
+
+import pytest
+
+from models.StackScheduler import StackScheduler
+
+GB = 1024**3
+
+#------------------------------------------------------------------------------
+# Stack function: write start/end time to <outDir>/<stack>.txt. Stacks
+# named long* take twice as long, fail* exit with 1, raise* raise
+#------------------------------------------------------------------------------
+def runFakeStack(stack, outDir, seconds = 0.3):
+
+    start = time.time()
+    time.sleep(2 * seconds if stack.startswith('long') else seconds)
+
+    with open(os.path.join(outDir, '{}.txt'.format(stack)), 'w') as f:
+        f.write('{} {}'.format(start, time.time()))
+
+    if stack.startswith('fail'):
+        sys.exit(1)
+    if stack.startswith('raise'):
+        raise RuntimeError(stack)
+
+def readTimes(outDir, stacks):
+
+    times = {}
+    for stack in stacks:
+        with open(os.path.join(outDir, '{}.txt'.format(stack))) as f:
+            times[stack] = tuple(float(t) for t in f.read().split())
+
+    return times
+
+def overlap(times, a, b):
+
+    return times[a][0] < times[b][1] and times[b][0] < times[a][1]
+
+@pytest.fixture
+def fakeMemory(monkeypatch):
+
+    rss = {'bytes': 0}
+
+    monkeypatch.setattr(StackScheduler, 'memAvailable',
+                                               staticmethod(lambda: 1000 * GB))
+    monkeypatch.setattr(StackScheduler, 'processRss',
+                                       staticmethod(lambda pid: rss['bytes']))
+
+    return rss
+
+def makeScheduler(memLimit, maxProcesses = 4):
+
+    return StackScheduler(memLimit = memLimit, maxProcesses = maxProcesses,
+                                                          pollSeconds = 0.02)
+
+def test_smaller_stack_fills_gap(tmp_path, fakeMemory, capsys):
+
+    stacks = ['a', 'b', 'c']
+    failed = makeScheduler(100 * GB).run(runFakeStack, stacks,
+                                    [60 * GB, 60 * GB, 30 * GB], str(tmp_path))
+
+    assert failed == []
+
+    # b does not fit next to a, c does and goes first
+    started = [line.split()[1] for line in capsys.readouterr().out.splitlines()
+                                                 if line.startswith('Started')]
+    assert started == ['a', 'c', 'b']
+
+    times = readTimes(str(tmp_path), stacks)
+    assert overlap(times, 'a', 'c')
+    assert not overlap(times, 'a', 'b')
+
+def test_stack_over_limit_runs_alone(tmp_path, fakeMemory):
+
+    stacks = ['big', 'small1', 'small2']
+    failed = makeScheduler(100 * GB).run(runFakeStack, stacks,
+                                    [200 * GB, 10 * GB, 10 * GB], str(tmp_path))
+
+    assert failed == []
+
+    times = readTimes(str(tmp_path), stacks)
+    assert overlap(times, 'small1', 'small2')
+    assert not overlap(times, 'big', 'small1')
+    assert not overlap(times, 'big', 'small2')
+
+def test_max_processes(tmp_path, fakeMemory):
+
+    stacks = ['a', 'b', 'c']
+    makeScheduler(100 * GB, maxProcesses = 1).run(runFakeStack, stacks,
+                                                 [GB] * 3, str(tmp_path))
+
+    times = readTimes(str(tmp_path), stacks)
+    assert not any(overlap(times, x, y) for x, y in [('a', 'b'), ('b', 'c'),
+                                                                 ('a', 'c')])
+
+def test_backoff_when_rss_over_limit(tmp_path, fakeMemory):
+
+    # A running stack uses more than BACKOFF_FRACTION of the limit, but
+    # still leaves room for the estimate of c. long and b start together,
+    # when b is done c waits for long to finish
+    fakeMemory['bytes'] = 95 * GB
+
+    stacks = ['long', 'b', 'c']
+    makeScheduler(100 * GB, maxProcesses = 2).run(runFakeStack, stacks, 
+                                                   [GB] * 3, str(tmp_path))
+
+    times = readTimes(str(tmp_path), stacks)
+    assert overlap(times, 'long', 'b')
+    assert not overlap(times, 'long', 'c')
+
+def test_failed_stacks(tmp_path, fakeMemory):
+
+    stacks = ['ok', 'fail', 'raise']
+    failed = makeScheduler(100 * GB).run(runFakeStack, stacks, [GB] * 3,
+                                                               str(tmp_path))
+
+    assert sorted(failed) == ['fail', 'raise']
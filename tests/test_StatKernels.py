@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for models/StatKernels.py
+
+groupedStats on the pixels of a CoverageIndex has to give the same stats as
+    rasterstats.zonal_stats (all_touched) for the same zones, with None for
+    zones without valid pixels coming back as NaN. The 'nodata' stat is only
+    compared for zones on the raster (see ZonalEngine, rasterstats also
+    counts the part of a zone off the raster edge)
+"""
+import numpy as np
+import shapely
+
+from affine import Affine
+from rasterstats import zonal_stats
+
+from models.CoverageIndex import CoverageIndex
+from models.StatKernels import groupedStats, countStats
+
+GEOTRANSFORM = (1000.0, 2.0, 0.0, 5000.0, 0.0, -2.0)
+N_COLUMNS, N_ROWS = 40, 30
+
+STATS = ['count', 'sum', 'mean', 'std', 'min', 'max', 'range', 'median',
+         'percentile_10', 'percentile_90', 'majority', 'minority', 'unique',
+         'nodata', 'nan']
+
+#------------------------------------------------------------------------------
+# Raster stand-in with what CoverageIndex reads from a Raster object
+#------------------------------------------------------------------------------
+class GridRaster(object):
+
+    ogrGeotransform = GEOTRANSFORM
+    nColumns = N_COLUMNS
+    nRows    = N_ROWS
+
+    def epsg(self):
+        return 32618
+
+def randomZones(seed = 0, n = 60):
+
+    rng = np.random.default_rng(seed)
+    (x, y) = (rng.uniform(990, 1080, n), rng.uniform(4930, 5005, n))
+    (w, h) = (rng.uniform(0.5, 20, n), rng.uniform(0.5, 20, n))
+
+    zones = [shapely.box(*b) for b in zip(x, y, x + w, y + h)]
+
+    # Off the raster: no pixels at all
+    zones.append(shapely.box(2000, 6000, 2010, 6010))
+
+    return zones
+
+def assertSameStats(arr, nodata, zones):
+
+    coverage = CoverageIndex.build(zones, GridRaster(), allTouched = True)
+    values = arr.ravel()[coverage.pixels]
+
+    stats = groupedStats(values, coverage.offsets, STATS, nodata)
+
+    expected = zonal_stats(zones, arr, affine = Affine.from_gdal(*GEOTRANSFORM),
+                           nodata = nodata, stats = STATS, all_touched = True)
+
+    (ulx, xres, xskew, uly, yskew, yres) = GEOTRANSFORM
+    rasterBox = shapely.box(ulx, uly + N_ROWS * yres, ulx + N_COLUMNS * xres, 
+                                                                          uly)
+    onRaster = shapely.within(np.asarray(zones, dtype = object), rasterBox)
+
+    for stat in STATS:
+        got = np.asarray(stats[stat], dtype = np.float64)
+        want = np.array([np.nan if e[stat] is None else e[stat]
+                                       for e in expected], dtype = np.float64)
+        if stat == 'nodata':
+            (got, want) = (got[onRaster], want[onRaster])
+
+        np.testing.assert_allclose(got, want, rtol = 1e-10, atol = 1e-10,
+                                   equal_nan = True, err_msg = stat)
+
+def test_integer_layer():
+
+    # Small value range (ageYear-like), uses the bincount majority path
+    rng = np.random.default_rng(1)
+    arr = rng.integers(1, 8, (N_ROWS, N_COLUMNS)).astype(np.int16)
+    arr[rng.random(arr.shape) < 0.1] = -1
+
+    # A block of nodata so some zones have no valid pixels
+    arr[:6, :6] = -1
+
+    zones = randomZones() + [shapely.box(1001, 4991, 1005, 4995)]
+
+    assertSameStats(arr, -1, zones)
+
+def test_float_layer():
+
+    rng = np.random.default_rng(2)
+    arr = np.round(rng.normal(10, 3, (N_ROWS, N_COLUMNS)), 1)
+    arr[rng.random(arr.shape) < 0.1] = -9999
+    arr[rng.random(arr.shape) < 0.1] = np.nan
+
+    assertSameStats(arr, -9999, randomZones(seed = 3))
+
+def test_count_stats_paths_agree():
+
+    # bincount path (integers) vs runs of the sorted array (same values as
+    # floats), ties go to the smallest value in both
+    rng = np.random.default_rng(4)
+    nZones = 50
+    zoneIds = np.sort(rng.integers(0, nZones, 2000))
+    values = rng.integers(0, 6, len(zoneIds))
+
+    (majority, minority, unique) = countStats(values, zoneIds, nZones)
+    (fMajority, fMinority, fUnique) = countStats(values.astype(np.float64),
+                                                             zoneIds, nZones)
+
+    hasData = np.bincount(zoneIds, minlength = nZones) > 0
+
+    np.testing.assert_array_equal(majority[hasData], fMajority[hasData])
+    np.testing.assert_array_equal(minority[hasData], fMinority[hasData])
+    np.testing.assert_array_equal(unique, fUnique)
+
+def test_empty_zones():
+
+    offsets = np.array([0, 0, 3, 3])
+    values = np.array([5.0, np.nan, 7.0])
+
+    stats = groupedStats(values, offsets, ['count', 'mean', 'max', 'nan'])
+
+    np.testing.assert_array_equal(stats['count'], [0, 2, 0])
+    np.testing.assert_array_equal(stats['mean'], [np.nan, 6.0, np.nan])
+    np.testing.assert_array_equal(stats['max'], [np.nan, 7.0, np.nan])
+    np.testing.assert_array_equal(stats['nan'], [0, 1, 0])
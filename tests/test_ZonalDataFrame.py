@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for models/ZonalDataFrame.py
+
+Point mode end to end: ZonalDataFrame.pointStats on ATL08-like points (in
+    lon/lat, with the granule column) and a small two band stack. Every point
+    gets the value of the pixel it falls on, points off the stack are dropped
+    and nodata/NaN come back as the stack's nodata value
+"""
+import numpy as np
+import geopandas as gpd
+import pytest
+
+gdal = pytest.importorskip("osgeo.gdal")
+osr = pytest.importorskip("osgeo.osr")
+
+from models.ZonalDataFrame import ZonalDataFrame
+
+EPSG = 32618
+GEOTRANSFORM = (500000.0, 30.0, 0.0, 4000000.0, 0.0, -30.0)
+N_COLUMNS, N_ROWS = 30, 20
+NODATA = -9999
+
+LAYER_DICT = {1: ['canopy', 'mean'], 2: ['cover', 'mean']}
+
+#------------------------------------------------------------------------------
+# Write arr (bands, rows, columns) to a Float32 GeoTIFF stack
+#------------------------------------------------------------------------------
+def writeStack(outTif, arr):
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(EPSG)
+
+    ds = gdal.GetDriverByName('GTiff').Create(outTif, N_COLUMNS, N_ROWS,
+                                            arr.shape[0], gdal.GDT_Float32)
+    ds.SetGeoTransform(GEOTRANSFORM)
+    ds.SetProjection(srs.ExportToWkt())
+
+    for b in range(arr.shape[0]):
+        band = ds.GetRasterBand(b + 1)
+        band.WriteArray(arr[b])
+        band.SetNoDataValue(NODATA)
+
+    ds = None
+
+    return outTif
+
+#------------------------------------------------------------------------------
+# Points on the centers of pixels (rows, cols), in EPSG:4326
+#------------------------------------------------------------------------------
+def pixelPoints(rows, cols):
+
+    (ulx, xres, _, uly, _, yres) = GEOTRANSFORM
+
+    x = ulx + (np.asarray(cols) + 0.5) * xres
+    y = uly + (np.asarray(rows) + 0.5) * yres
+
+    gdf = gpd.GeoDataFrame({'h_can': np.arange(len(x), dtype = float),
+                            'granule': 'ATL08_20200101000000_00000000_005_01'},
+                           geometry = gpd.points_from_xy(x, y),
+                           crs = 'EPSG:{}'.format(EPSG))
+
+    return gdf.to_crs(epsg = 4326)
+
+def test_point_stats(tmp_path):
+
+    rng = np.random.default_rng(0)
+    arr = np.round(rng.uniform(0, 50, (2, N_ROWS, N_COLUMNS)), 1)
+    arr = arr.astype(np.float32)
+
+    # Nodata in one band only, and in both bands
+    arr[0, 3, 4] = NODATA
+    arr[:, 5, 6] = NODATA
+    arr[1, 7, 8] = np.nan
+
+    stack = writeStack(str(tmp_path / 'stack.tif'), arr)
+
+    rows = list(rng.integers(0, N_ROWS, 40)) + [3, 5, 7, 2]
+    cols = list(rng.integers(0, N_COLUMNS, 40)) + [4, 6, 8, N_COLUMNS + 3]
+
+    points = pixelPoints(rows, cols)
+
+    zdf = ZonalDataFrame('ATL08-20m', None, EPSG, existingGdf = points)
+    out = zdf.pointStats(stack, LAYER_DICT)
+
+    # Point off the stack and point on nodata in all bands are dropped
+    assert len(out) == len(points) - 2
+    assert 'granule' not in out.columns
+    assert out.crs.to_epsg() == 4326
+
+    for (b, layerName) in enumerate(['canopy', 'cover']):
+
+        expected = arr[b][np.asarray(rows)[out.index],
+                          np.asarray(cols)[out.index]].astype(np.float64)
+        expected[np.isnan(expected)] = NODATA
+
+        np.testing.assert_array_equal(out[layerName].to_numpy(dtype = float),
+                                      expected, err_msg = layerName)
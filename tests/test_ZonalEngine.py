@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for models/ZonalEngine.py
+
+pointValuesMultiBand on a .vrt stack of bands with different types (Byte and
+    Float32) has to give every band its own values: fractions of the float
+    band are kept and bands with every point valid keep their own dtype
+"""
+import numpy as np
+import geopandas as gpd
+import pytest
+
+gdal = pytest.importorskip("osgeo.gdal")
+osr = pytest.importorskip("osgeo.osr")
+
+from models.ZonalEngine import pointValuesMultiBand
+
+EPSG = 32618
+GEOTRANSFORM = (500000.0, 30.0, 0.0, 4000000.0, 0.0, -30.0)
+N_COLUMNS, N_ROWS = 40, 30
+
+def writeBand(outTif, arr, gdalType):
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(EPSG)
+
+    ds = gdal.GetDriverByName('GTiff').Create(outTif, N_COLUMNS, N_ROWS, 1,
+                                                                     gdalType)
+    ds.SetGeoTransform(GEOTRANSFORM)
+    ds.SetProjection(srs.ExportToWkt())
+    ds.GetRasterBand(1).WriteArray(arr)
+    ds = None
+
+    return outTif
+
+def test_mixed_band_types(tmp_path):
+
+    rng = np.random.default_rng(0)
+    byteArr = rng.integers(0, 256, (N_ROWS, N_COLUMNS)).astype(np.uint8)
+    floatArr = rng.uniform(0, 1, (N_ROWS, N_COLUMNS)).astype(np.float32)
+
+    bandFiles = [writeBand(str(tmp_path / 'byte.tif'), byteArr, gdal.GDT_Byte),
+                 writeBand(str(tmp_path / 'float.tif'), floatArr,
+                                                             gdal.GDT_Float32)]
+
+    stack = str(tmp_path / 'stack.vrt')
+    gdal.BuildVRT(stack, bandFiles, separate = True)
+
+    (rows, cols) = (rng.integers(0, N_ROWS, 50), rng.integers(0, N_COLUMNS, 50))
+    (ulx, xres, _, uly, _, yres) = GEOTRANSFORM
+
+    points = gpd.GeoDataFrame(geometry = gpd.points_from_xy(
+                                               ulx + (cols + 0.5) * xres,
+                                               uly + (rows + 0.5) * yres),
+                                              crs = 'EPSG:{}'.format(EPSG))
+
+    values = pointValuesMultiBand(points, stack, [(1, 'byte'), (2, 'float')])
+
+    assert values['byte'].dtype == np.uint8
+    assert values['float'].dtype == np.float32
+
+    np.testing.assert_array_equal(values['byte'], byteArr[rows, cols])
+    np.testing.assert_array_equal(values['float'], floatArr[rows, cols])
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for functions/buildZdf_disturbance.py
+
+Patches from the patch store (getStorePatches) have to be the same as
+    polygonizing the .vrt mosaic of the stack's tiles (polygonizeArray), also
+    where tiles overlap or have nodata
+"""
+import numpy as np
+import shapely
+import geopandas as gpd
+import pytest
+
+gdal = pytest.importorskip("osgeo.gdal")
+osr = pytest.importorskip("osgeo.osr")
+
+from shapely.geometry import box
+
+from functions.buildZdf_disturbance import getStorePatches, readAgeYear, \
+                                    maskAgeYear, polygonizeArray, AGE_YEAR_FIELD
+
+EPSG = 32618
+
+#------------------------------------------------------------------------------
+# Write a blocky 30m age year tile (values 0-50 and 255 nodata) to outTif
+#------------------------------------------------------------------------------
+def writeTile(outTif, ulx, uly, seed, nBlocks = 8, blockSize = 5):
+
+    rng = np.random.default_rng(seed)
+
+    blocks = rng.choice([0, 3, 7, 12, 50], size = (nBlocks, nBlocks))
+    arr = np.kron(blocks, np.ones((blockSize, blockSize))).astype(np.uint8)
+    arr[rng.random(arr.shape) < 0.02] = 255
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(EPSG)
+
+    ds = gdal.GetDriverByName('GTiff').Create(outTif, arr.shape[1],
+                                            arr.shape[0], 1, gdal.GDT_Byte)
+    ds.SetGeoTransform((ulx, 30, 0, uly, 0, -30))
+    ds.SetProjection(srs.ExportToWkt())
+    ds.GetRasterBand(1).SetNoDataValue(255)
+    ds.GetRasterBand(1).WriteArray(arr)
+    ds = None
+
+    return outTif
+
+def sortedPatches(patches):
+
+    key = np.lexsort((np.round(patches.centroid.y, 3),
+                      np.round(patches.centroid.x, 3),
+                      np.round(patches.area, 3),
+                      patches[AGE_YEAR_FIELD].values))
+
+    return patches.iloc[key].reset_index(drop = True)
+
+def test_store_patches_two_tile_mosaic(tmp_path):
+
+    # Landsat-like 30m grids (origin on 15m), second tile overlaps the first
+    # by 20 x 10 pixels and has nodata pixels over it
+    inputFiles = [writeTile(str(tmp_path / 'tileA.tif'), 500015, 4500015, 1),
+                  writeTile(str(tmp_path / 'tileB.tif'), 500615, 4499715, 2)]
+
+    extentPoly = gpd.GeoDataFrame(geometry = [box(500103.3, 4498702.7,
+                                                  501707.1, 4499908.2)],
+                                                              crs = EPSG)
+
+    (ageArr, geotransform, projection, srcNoData) = readAgeYear(inputFiles,
+                                                                   extentPoly)
+    expected = polygonizeArray(maskAgeYear(ageArr, srcNoData), geotransform,
+                                                                   projection)
+
+    got = getStorePatches(inputFiles, extentPoly, str(tmp_path / 'store'))
+
+    assert len(expected.index) > 0
+    assert len(got.index) == len(expected.index)
+
+    (expected, got) = (sortedPatches(expected), sortedPatches(got))
+
+    np.testing.assert_array_equal(got[AGE_YEAR_FIELD].values,
+                                  expected[AGE_YEAR_FIELD].values)
+    assert shapely.equals(np.asarray(got.geometry),
+                          np.asarray(expected.geometry)).all()
+
+    # Second run reads both tiles from the store
+    again = sortedPatches(getStorePatches(inputFiles, extentPoly,
+                                                  str(tmp_path / 'store')))
+    assert shapely.equals(np.asarray(again.geometry),
+                          np.asarray(got.geometry)).all()